@@ -6,7 +6,8 @@ import sys
 import time
 
 from channel import channel_factory
-from common import const
+from common import const, http_server, metrics
+from bot import session_store
 from config import load_config
 from plugins import *
 import threading
@@ -17,7 +18,9 @@ def sigterm_handler_wrap(_signo):
 
     def func(_signo, _stack_frame):
         logger.info("signal {} received, exiting...".format(_signo))
+        http_server.shutdown_all()
         conf().save_user_datas()
+        session_store.flush_all()
         if callable(old_handler):  #  check old_handler
             return old_handler(_signo, _stack_frame)
         sys.exit(0)
@@ -25,11 +28,18 @@ def sigterm_handler_wrap(_signo):
     signal.signal(_signo, func)
 
 
-def start_channel(channel_name: str):
+def prepare_channel(channel_name: str):
+    """创建渠道并加载插件，返回后即可开始接收消息，启动耗时基准测试也调用这里"""
     channel = channel_factory.create_channel(channel_name)
-    if channel_name in ["wx", "wxy", "terminal", "wechatmp","web", "wechatmp_service", "wechatcom_app", "wework",
+    metrics.start_metrics_server()
+    if channel_name in ["wx", "wxy", "terminal", "loadtest", "wechatmp","web", "wechatmp_service", "wechatcom_app", "wework",
                         const.FEISHU, const.DINGTALK]:
         PluginManager().load_plugins()
+    return channel
+
+
+def start_channel(channel_name: str):
+    channel = prepare_channel(channel_name)
 
     if conf().get("use_linkai"):
         try:
@@ -1,9 +1,10 @@
 # encoding:utf-8
 
-import requests
+from common import http_client
 
 from bot.bot import Bot
 from bridge.reply import Reply, ReplyType
+from common.token_cache import get_access_token
 
 
 # Baidu Unit对话接口 (可用, 但能力较弱)
@@ -18,7 +19,7 @@ class BaiduUnitBot(Bot):
         )
         print(post_data)
         headers = {"content-type": "application/x-www-form-urlencoded"}
-        response = requests.post(url, data=post_data.encode(), headers=headers)
+        response = http_client.post(url, data=post_data.encode(), headers=headers)
         if response:
             reply = Reply(
                 ReplyType.TEXT,
@@ -29,8 +30,12 @@ class BaiduUnitBot(Bot):
     def get_token(self):
         access_key = "YOUR_ACCESS_KEY"
         secret_key = "YOUR_SECRET_KEY"
+        return get_access_token("baidu_unit", (access_key, secret_key), lambda: self._fetch_token(access_key, secret_key))
+
+    def _fetch_token(self, access_key, secret_key):
         host = "https://aip.baidubce.com/oauth/2.0/token?grant_type=client_credentials&client_id=" + access_key + "&client_secret=" + secret_key
-        response = requests.get(host)
+        response = http_client.get(host)
         if response:
             print(response.json())
-            return response.json()["access_token"]
+            return response.json()["access_token"], response.json().get("expires_in")
+        return None, 0
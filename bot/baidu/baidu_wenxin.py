@@ -1,6 +1,6 @@
 # encoding:utf-8
 
-import requests
+from common import http_client
 import json
 from common import const
 from bot.bot import Bot
@@ -8,6 +8,7 @@ from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
+from common.token_cache import get_access_token, invalidate_access_token
 from config import conf
 from bot.baidu.baidu_wenxin_session import BaiduWenxinSession
 
@@ -90,9 +91,11 @@ class BaiduWenxinBot(Bot):
                 'Content-Type': 'application/json'
             }
             payload = {'messages': session.messages, 'system': self.prompt} if self.prompt_enabled else {'messages': session.messages}
-            response = requests.request("POST", url, headers=headers, data=json.dumps(payload))
+            response = http_client.request("POST", url, headers=headers, data=json.dumps(payload))
             response_text = json.loads(response.text)
             logger.info(f"[BAIDU] response text={response_text}")
+            if response_text.get("error_code") in [110, 111]:  # access token无效或已过期
+                invalidate_access_token("baidu_wenxin", (BAIDU_API_KEY, BAIDU_SECRET_KEY))
             res_content = response_text["result"]
             total_tokens = response_text["usage"]["total_tokens"]
             completion_tokens = response_text["usage"]["completion_tokens"]
@@ -115,6 +118,10 @@ class BaiduWenxinBot(Bot):
         使用 AK，SK 生成鉴权签名（Access Token）
         :return: access_token，或是None(如果错误)
         """
+        return str(get_access_token("baidu_wenxin", (BAIDU_API_KEY, BAIDU_SECRET_KEY), self._fetch_access_token))
+
+    def _fetch_access_token(self):
         url = "https://aip.baidubce.com/oauth/2.0/token"
         params = {"grant_type": "client_credentials", "client_id": BAIDU_API_KEY, "client_secret": BAIDU_SECRET_KEY}
-        return str(requests.post(url, params=params).json().get("access_token"))
+        res = http_client.post(url, params=params).json()
+        return res.get("access_token"), res.get("expires_in")
@@ -2,9 +2,11 @@
 Auto-replay chat robot abstract class
 """
 
+import asyncio
 
 from bridge.context import Context
 from bridge.reply import Reply
+from common.worker_pool import HANDLER_POOL_LLM, get_handler_pool
 
 
 class Bot(object):
@@ -15,3 +17,12 @@ class Bot(object):
         :return: reply content
         """
         raise NotImplementedError
+
+    async def async_reply(self, query, context: Context = None) -> Reply:
+        """
+        bot auto-reply content in asyncio mode, bots without native async support run reply in the llm worker pool
+        :param req: received message
+        :return: reply content
+        """
+        pool = get_handler_pool(HANDLER_POOL_LLM)
+        return await asyncio.wrap_future(pool.submit(self.reply, query, context))
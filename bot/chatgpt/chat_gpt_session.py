@@ -1,3 +1,5 @@
+import functools
+
 from bot.session_manager import Session
 from common.log import logger
 from common import const
@@ -16,8 +18,25 @@ class ChatGPTSession(Session):
     def __init__(self, session_id, system_prompt=None, model="gpt-3.5-turbo"):
         super().__init__(session_id, system_prompt)
         self.model = model
+        # 每条消息的token数与self.messages一一对应，total_tokens为其总和(不含回复前缀)
+        # 在add_query、add_reply和discard_exceeding中增量维护，token_counts为None表示需要重新计算
+        self.token_counts = None
+        self.total_tokens = 0
+        self.token_model = None
+        self._counted_messages = None  # 计数时的消息列表，用于发现消息在上述方法之外被修改
+        self._last_counted = None
         self.reset()
 
+    def add_query(self, query):
+        tracked = self._tokens_tracked()
+        super().add_query(query)
+        self._track_message(tracked)
+
+    def add_reply(self, reply):
+        tracked = self._tokens_tracked()
+        super().add_reply(reply)
+        self._track_message(tracked)
+
     def discard_exceeding(self, max_tokens, cur_tokens=None):
         precise = True
         try:
@@ -29,9 +48,9 @@ class ChatGPTSession(Session):
             logger.debug("Exception when counting tokens precisely for query: {}".format(e))
         while cur_tokens > max_tokens:
             if len(self.messages) > 2:
-                self.messages.pop(1)
+                self._pop_message(1)
             elif len(self.messages) == 2 and self.messages[1]["role"] == "assistant":
-                self.messages.pop(1)
+                self._pop_message(1)
                 if precise:
                     cur_tokens = self.calc_tokens()
                 else:
@@ -45,57 +64,119 @@ class ChatGPTSession(Session):
                 break
             if precise:
                 cur_tokens = self.calc_tokens()
-            else:
-                cur_tokens = cur_tokens - max_tokens
         return cur_tokens
 
     def calc_tokens(self):
-        return num_tokens_from_messages(self.messages, self.model)
+        token_model = resolve_token_model(self.model)
+        if not self._tokens_tracked(token_model):
+            self._recount_tokens(token_model)
+        return self.total_tokens + reply_primer_tokens(token_model)
+
+    def _tokens_tracked(self, token_model=None):
+        """计数是否与当前消息一致，消息列表被替换(如从存储恢复)、在外部增删或模型变化时返回False"""
+        if self.token_counts is None or self._counted_messages is not self.messages:
+            return False
+        if self.token_model != (token_model or resolve_token_model(self.model)):
+            return False
+        return len(self.token_counts) == len(self.messages) and (not self.messages or self.messages[-1] is self._last_counted)
+
+    def _recount_tokens(self, token_model):
+        self.token_counts = None
+        counts = [num_tokens_from_message(message, token_model) for message in self.messages]
+        self.token_counts = counts
+        self.total_tokens = sum(counts)
+        self.token_model = token_model
+        self._counted_messages = self.messages
+        self._last_counted = self.messages[-1] if self.messages else None
+
+    def _track_message(self, tracked):
+        """新消息追加后累加其token数，之前的计数已失效或计数出错时留给calc_tokens重新计算"""
+        message = self.messages[-1]
+        if not tracked:
+            self.token_counts = None
+            return
+        try:
+            tokens = num_tokens_from_message(message, self.token_model)
+        except Exception as e:
+            logger.debug("Exception when counting tokens for message: {}".format(e))
+            self.token_counts = None
+            return
+        self.token_counts.append(tokens)
+        self.total_tokens += tokens
+        self._last_counted = message
+
+    def _pop_message(self, index):
+        tracked = self._tokens_tracked()
+        removed = self.messages.pop(index)
+        if tracked:
+            self.total_tokens -= self.token_counts.pop(index)
+            self._last_counted = self.messages[-1] if self.messages else None
+        else:
+            self.token_counts = None
+        return removed
 
 
 # refer to https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
 def num_tokens_from_messages(messages, model):
     """Returns the number of tokens used by a list of messages."""
+    token_model = resolve_token_model(model)
+    num_tokens = 0
+    for message in messages:
+        num_tokens += num_tokens_from_message(message, token_model)
+    return num_tokens + reply_primer_tokens(token_model)
 
+
+def resolve_token_model(model):
+    """将模型名映射为计算token时使用的模型: gpt-3.5-turbo、gpt-4，或按字符数计算的character"""
     if model in ["wenxin", "xunfei"] or model.startswith(const.GEMINI):
-        return num_tokens_by_character(messages)
+        return "character"
+    if model in ["gpt-4", "gpt-4-0314", "gpt-4-0613", "gpt-4-32k", "gpt-4-32k-0613", "gpt-3.5-turbo-0613",
+                 "gpt-3.5-turbo-16k", "gpt-3.5-turbo-16k-0613", "gpt-35-turbo-16k", "gpt-4-turbo-preview",
+                 "gpt-4-1106-preview", const.GPT4_TURBO_PREVIEW, const.GPT4_VISION_PREVIEW, const.GPT4_TURBO_01_25,
+                 const.GPT_4o, const.GPT_4O_0806, const.GPT_4o_MINI, const.LINKAI_4o, const.LINKAI_4_TURBO]:
+        return "gpt-4"
+    if model != "gpt-3.5-turbo":
+        logger.debug(f"num_tokens_from_messages() is not implemented for model {model}. Returning num tokens assuming gpt-3.5-turbo.")
+    return "gpt-3.5-turbo"
+
 
+@functools.lru_cache(maxsize=None)
+def get_encoding(token_model):
+    """每个模型只加载一次tiktoken编码"""
     import tiktoken
 
-    if model in ["gpt-3.5-turbo-0301", "gpt-35-turbo", "gpt-3.5-turbo-1106", "moonshot", const.LINKAI_35]:
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
-    elif model in ["gpt-4-0314", "gpt-4-0613", "gpt-4-32k", "gpt-4-32k-0613", "gpt-3.5-turbo-0613",
-                   "gpt-3.5-turbo-16k", "gpt-3.5-turbo-16k-0613", "gpt-35-turbo-16k", "gpt-4-turbo-preview",
-                   "gpt-4-1106-preview", const.GPT4_TURBO_PREVIEW, const.GPT4_VISION_PREVIEW, const.GPT4_TURBO_01_25,
-                   const.GPT_4o, const.GPT_4O_0806, const.GPT_4o_MINI, const.LINKAI_4o, const.LINKAI_4_TURBO]:
-        return num_tokens_from_messages(messages, model="gpt-4")
-    elif model.startswith("claude-3"):
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
     try:
-        encoding = tiktoken.encoding_for_model(model)
+        return tiktoken.encoding_for_model(token_model)
     except KeyError:
         logger.debug("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
-    if model == "gpt-3.5-turbo":
-        tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-        tokens_per_name = -1  # if there's a name, the role is omitted
-    elif model == "gpt-4":
-        tokens_per_message = 3
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def num_tokens_from_message(message, token_model):
+    """Returns the number of tokens used by a single message, token_model comes from resolve_token_model."""
+    if token_model == "character":
+        return len(message["content"])
+    if token_model == "gpt-4":
+        tokens_per_message = 3  # every message follows <|start|>{role/name}\n{content}<|end|>\n
         tokens_per_name = 1
     else:
-        logger.debug(f"num_tokens_from_messages() is not implemented for model {model}. Returning num tokens assuming gpt-3.5-turbo.")
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += tokens_per_name
-    num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
+        tokens_per_message = 4
+        tokens_per_name = -1  # if there's a name, the role is omitted
+    encoding = get_encoding(token_model)
+    num_tokens = tokens_per_message
+    for key, value in message.items():
+        num_tokens += len(encoding.encode(value))
+        if key == "name":
+            num_tokens += tokens_per_name
     return num_tokens
 
 
+def reply_primer_tokens(token_model):
+    if token_model == "character":
+        return 0
+    return 3  # every reply is primed with <|start|>assistant<|message|>
+
+
 def num_tokens_by_character(messages):
     """Returns the number of tokens used by a list of messages."""
     tokens = 0
@@ -1,3 +1,4 @@
+from bot.session_store import create_session_store
 from common.expired_dict import ExpiredDict
 from common.log import logger
 from config import conf
@@ -45,6 +46,7 @@ class SessionManager(object):
         self.sessions = sessions
         self.sessioncls = sessioncls
         self.session_args = session_args
+        self.store = create_session_store(sessioncls.__name__)
 
     def build_session(self, session_id, system_prompt=None):
         """
@@ -54,13 +56,45 @@ class SessionManager(object):
         if session_id is None:
             return self.sessioncls(session_id, system_prompt, **self.session_args)
 
-        if session_id not in self.sessions:
-            self.sessions[session_id] = self.sessioncls(session_id, system_prompt, **self.session_args)
-        elif system_prompt is not None:  # 如果有新的system_prompt，更新并重置session
-            self.sessions[session_id].set_system_prompt(system_prompt)
-        session = self.sessions[session_id]
+        session = self.sessions.get(session_id)
+        if session is None:
+            session = self._load_session(session_id)
+            if session is None:
+                session = self.sessioncls(session_id, system_prompt, **self.session_args)
+                self.sessions[session_id] = session
+                if system_prompt is not None:
+                    self.save_session(session)
+                return session
+            self.sessions[session_id] = session
+        if system_prompt is not None:  # 如果有新的system_prompt，更新并重置session
+            session.set_system_prompt(system_prompt)
+            self.save_session(session)
         return session
 
+    def _load_session(self, session_id):
+        # 内存中没有时从存储中恢复，例如重启后或会话由其他副本创建
+        try:
+            data = self.store.load(session_id)
+        except Exception as e:
+            logger.warning("[SessionManager] load session {} failed: {}".format(session_id, e))
+            return None
+        if data is None:
+            return None
+        session = self.sessioncls(session_id, data.get("system_prompt"), **self.session_args)
+        session.messages = data.get("messages", [])
+        return session
+
+    def save_session(self, session):
+        """
+        将会话写入存储，会话内容变化后调用，实际写入由存储在后台批量完成
+        """
+        if session.session_id is None:
+            return
+        try:
+            self.store.save(session.session_id, {"system_prompt": session.system_prompt, "messages": session.messages})
+        except Exception as e:
+            logger.warning("[SessionManager] save session {} failed: {}".format(session.session_id, e))
+
     def session_query(self, query, session_id):
         session = self.build_session(session_id)
         session.add_query(query)
@@ -70,6 +104,7 @@ class SessionManager(object):
             logger.debug("prompt tokens used={}".format(total_tokens))
         except Exception as e:
             logger.warning("Exception when counting tokens precisely for prompt: {}".format(str(e)))
+        self.save_session(session)
         return session
 
     def session_reply(self, reply, session_id, total_tokens=None):
@@ -81,11 +116,14 @@ class SessionManager(object):
             logger.debug("raw total_tokens={}, savesession tokens={}".format(total_tokens, tokens_cnt))
         except Exception as e:
             logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+        self.save_session(session)
         return session
 
     def clear_session(self, session_id):
         if session_id in self.sessions:
             del self.sessions[session_id]
+        self.store.delete(session_id)
 
     def clear_all_session(self):
         self.sessions.clear()
+        self.store.clear()
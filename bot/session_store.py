@@ -0,0 +1,254 @@
+"""
+会话持久化存储，SessionManager在内存中缓存会话，通过SessionStore在重启或多副本部署时恢复会话
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from common.log import logger
+from config import conf, get_appdata_dir
+
+_stores = {}  # (存储类型, 位置, 命名空间) -> 存储，同一命名空间只创建一个，退出时统一刷盘
+_stores_lock = threading.Lock()
+
+
+class SessionStore(object):
+    def load(self, session_id):
+        """
+        读取会话数据
+        :return: {"system_prompt": str, "messages": list}，不存在或已过期时返回None
+        """
+        raise NotImplementedError
+
+    def save(self, session_id, data: dict):
+        raise NotImplementedError
+
+    def delete(self, session_id):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+
+class MemorySessionStore(SessionStore):
+    """只使用SessionManager的内存缓存，不做持久化"""
+
+    def load(self, session_id):
+        return None
+
+    def save(self, session_id, data: dict):
+        pass
+
+    def delete(self, session_id):
+        pass
+
+    def clear(self):
+        pass
+
+
+class WriteBehindSessionStore(SessionStore):
+    """
+    写入先进入待写队列，由后台线程按时间间隔或数量批量写入，回复流程不会等待磁盘或网络IO
+    同一会话在一个批次内的多次写入只保留最后一次
+    正在写入的批次保留在inflight中直到写入完成，期间读取不会读到存储中的旧数据
+    """
+
+    _DELETED = object()
+
+    def __init__(self, flush_interval=1.0, batch_size=100):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.pending = {}  # session_id -> 序列化后的会话数据或_DELETED
+        self.inflight = {}  # 正在写入的批次
+        self.cond = threading.Condition()
+        self.flush_lock = threading.Lock()  # 同一时间只有一个批次在写入，clear等待写入完成
+        _thread = threading.Thread(target=self._flush_loop, name="session-store-flush", daemon=True)
+        _thread.start()
+
+    def load(self, session_id):
+        with self.cond:
+            data = self.pending.get(session_id)
+            if data is None:
+                data = self.inflight.get(session_id)
+        if data is self._DELETED:
+            return None
+        if data is None:
+            data = self._read(session_id)
+        return json.loads(data) if data else None
+
+    def save(self, session_id, data: dict):
+        self._put(session_id, json.dumps(data, ensure_ascii=False))
+
+    def delete(self, session_id):
+        self._put(session_id, self._DELETED)
+
+    def clear(self):
+        with self.flush_lock:  # 等待正在写入的批次完成，避免清空后又被写回
+            with self.cond:
+                self.pending.clear()
+                self._clear()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.cond:
+                batch, self.pending = self.pending, {}
+                self.inflight = batch
+            if not batch:
+                return
+            try:
+                self._write([(k, v) for k, v in batch.items() if v is not self._DELETED], [k for k, v in batch.items() if v is self._DELETED])
+            except Exception as e:
+                logger.error("[SessionStore] flush {} sessions failed: {}".format(len(batch), e))
+                with self.cond:  # 写入失败时放回队列，不覆盖期间产生的新数据
+                    for k, v in batch.items():
+                        self.pending.setdefault(k, v)
+            finally:
+                with self.cond:
+                    self.inflight = {}
+
+    def _put(self, session_id, value):
+        with self.cond:
+            self.pending[session_id] = value
+            if len(self.pending) >= self.batch_size:
+                self.cond.notify()
+
+    def _flush_loop(self):
+        while True:
+            with self.cond:
+                self.cond.wait(self.flush_interval)
+            self.flush()
+
+    def _read(self, session_id):
+        raise NotImplementedError
+
+    def _write(self, items, deleted):
+        raise NotImplementedError
+
+    def _clear(self):
+        raise NotImplementedError
+
+
+class SqliteSessionStore(WriteBehindSessionStore):
+    def __init__(self, namespace, path, expires_in_seconds=None, **kwargs):
+        self.namespace = namespace
+        self.expires_in_seconds = expires_in_seconds
+        self.db_lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (namespace TEXT NOT NULL, session_id TEXT NOT NULL, data TEXT NOT NULL, "
+            "updated_at REAL NOT NULL, PRIMARY KEY (namespace, session_id))"
+        )
+        self.db.commit()
+        super().__init__(**kwargs)
+
+    def _read(self, session_id):
+        with self.db_lock:
+            row = self.db.execute("SELECT data, updated_at FROM sessions WHERE namespace=? AND session_id=?", (self.namespace, session_id)).fetchone()
+        if row is None:
+            return None
+        if self.expires_in_seconds and row[1] + self.expires_in_seconds < time.time():
+            return None
+        return row[0]
+
+    def _write(self, items, deleted):
+        now = time.time()
+        with self.db_lock:
+            with self.db:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO sessions (namespace, session_id, data, updated_at) VALUES (?, ?, ?, ?)",
+                    [(self.namespace, k, v, now) for k, v in items],
+                )
+                self.db.executemany("DELETE FROM sessions WHERE namespace=? AND session_id=?", [(self.namespace, k) for k in deleted])
+                if self.expires_in_seconds:
+                    self.db.execute("DELETE FROM sessions WHERE namespace=? AND updated_at<?", (self.namespace, now - self.expires_in_seconds))
+
+    def _clear(self):
+        with self.db_lock:
+            with self.db:
+                self.db.execute("DELETE FROM sessions WHERE namespace=?", (self.namespace,))
+
+
+class RedisSessionStore(WriteBehindSessionStore):
+    """
+    兼容redis协议的存储，client可传入redis.Redis或fakeredis.FakeRedis实例
+    """
+
+    def __init__(self, namespace, url=None, client=None, expires_in_seconds=None, **kwargs):
+        if client is None:
+            import redis
+
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = "cow:session:{}:".format(namespace)
+        self.expires_in_seconds = expires_in_seconds
+        super().__init__(**kwargs)
+
+    def _read(self, session_id):
+        data = self.client.get(self.prefix + session_id)
+        if data is None:
+            return None
+        return data.decode("utf-8") if isinstance(data, bytes) else data
+
+    def _write(self, items, deleted):
+        pipe = self.client.pipeline(transaction=False)
+        for k, v in items:
+            if self.expires_in_seconds:
+                pipe.setex(self.prefix + k, int(self.expires_in_seconds), v)
+            else:
+                pipe.set(self.prefix + k, v)
+        if deleted:
+            pipe.delete(*[self.prefix + k for k in deleted])
+        pipe.execute()
+
+    def _clear(self):
+        keys = list(self.client.scan_iter(match=self.prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+
+def create_session_store(namespace: str) -> SessionStore:
+    """
+    根据配置返回会话存储，相同存储位置和命名空间的SessionManager共用一个实例
+    重置机器人时会重新创建SessionManager，复用存储避免遗留刷盘线程和连接，也避免两个写缓冲互相覆盖同一批会话
+    :param namespace: 命名空间，不同格式的会话互不影响，一般使用会话类名
+    """
+    store_type = conf().get("session_store", "memory")
+    if store_type == "sqlite":
+        location = conf().get("session_store_path") or os.path.join(get_appdata_dir(), "sessions.db")
+    elif store_type == "redis":
+        location = conf().get("session_store_redis_url")
+    else:
+        return MemorySessionStore()
+    expires_in_seconds = conf().get("expires_in_seconds")
+    flush_interval = conf().get("session_store_flush_interval", 1)
+    key = (store_type, location, namespace)
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is not None:
+            # 配置重载后沿用已有的存储，只更新过期时间和刷盘间隔
+            store.expires_in_seconds = expires_in_seconds
+            store.flush_interval = flush_interval
+            return store
+        if store_type == "sqlite":
+            store = SqliteSessionStore(namespace, location, expires_in_seconds=expires_in_seconds, flush_interval=flush_interval)
+        else:
+            store = RedisSessionStore(namespace, url=location, expires_in_seconds=expires_in_seconds, flush_interval=flush_interval)
+        _stores[key] = store
+    logger.info("[SessionStore] use {} session store, namespace={}".format(store_type, namespace))
+    return store
+
+
+def flush_all():
+    """将所有存储中待写入的会话立即写入，用于退出前"""
+    with _stores_lock:
+        stores = list(_stores.values())
+    for store in stores:
+        store.flush()
@@ -1,12 +1,18 @@
+import asyncio
+import time
+
 from bot.bot_factory import create_bot
-from bridge.context import Context
-from bridge.reply import Reply
+from bridge.context import Context, ContextType
+from bridge.reply import Reply, ReplyType
+from bridge.reply_cache import lookup_reply, store_reply
 from common import const
 from common.log import logger
 from common.singleton import singleton
+from common.token_bucket import get_rate_limiter, reserve_request
 from config import conf
 from translate.factory import create_translator
 from voice.factory import create_voice
+from voice.tts_cache import cached_text_to_voice
 
 
 @singleton
@@ -80,13 +86,51 @@ class Bridge(object):
         return self.btype[typename]
 
     def fetch_reply_content(self, query, context: Context) -> Reply:
-        return self.get_bot("chat").reply(query, context)
+        bot = self.get_bot("chat")
+        cache, key, reply = lookup_reply(bot, self.btype["chat"], query, context)
+        if reply:
+            return reply
+        wait = self._reserve_quota(bot, query, context)
+        if wait is None:
+            return Reply(ReplyType.ERROR, "提问太快啦，请休息一下再问我吧")
+        if wait > 0:
+            time.sleep(wait)
+        start = time.monotonic()
+        reply = bot.reply(query, context)
+        store_reply(cache, key, reply, time.monotonic() - start)
+        return reply
+
+    async def fetch_reply_content_async(self, query, context: Context) -> Reply:
+        bot = self.get_bot("chat")
+        cache, key, reply = lookup_reply(bot, self.btype["chat"], query, context)
+        if reply:
+            return reply
+        wait = self._reserve_quota(bot, query, context)
+        if wait is None:
+            return Reply(ReplyType.ERROR, "提问太快啦，请休息一下再问我吧")
+        if wait > 0:
+            await asyncio.sleep(wait)
+        start = time.monotonic()
+        reply = await bot.async_reply(query, context)
+        store_reply(cache, key, reply, time.monotonic() - start)
+        return reply
+
+    def _reserve_quota(self, bot, query, context: Context):
+        """按全局、机器人、群、用户分层限流，token数按会话历史加本次提问估算"""
+        if not get_rate_limiter().enabled:
+            return 0
+        messages = [query]
+        sessions = getattr(bot, "sessions", None)
+        session_id = context.get("session_id")
+        if context.type == ContextType.TEXT and session_id is not None and hasattr(sessions, "build_session"):
+            messages = sessions.build_session(session_id).messages + messages
+        return reserve_request(self.btype["chat"], context, messages)
 
     def fetch_voice_to_text(self, voiceFile) -> Reply:
         return self.get_bot("voice_to_text").voiceToText(voiceFile)
 
     def fetch_text_to_voice(self, text) -> Reply:
-        return self.get_bot("text_to_voice").textToVoice(text)
+        return cached_text_to_voice(self.get_bot("text_to_voice"), self.btype["text_to_voice"], text)
 
     def fetch_translate(self, text, from_lang="", to_lang="en") -> Reply:
         return self.get_bot("translate").translate(text, from_lang, to_lang)
@@ -0,0 +1,184 @@
+"""
+无上下文问答的回复缓存
+群里的常见问题往往是同一个人设、同一个模型下没有历史消息的相同问题，每次都要完整调用一次大模型
+以 (机器人类型, 模型, 人设摘要, 归一化后的消息列表) 为key缓存文本回复，命中时直接返回并写入会话，保持会话状态与实际调用一致
+会话已有历史消息、携带图片文件、流式输出等情况自动跳过缓存
+"""
+
+import hashlib
+import re
+import threading
+import time
+import unicodedata
+
+from bridge.context import Context, ContextType
+from bridge.reply import Reply, ReplyType
+from common import memory
+from common.expired_dict import ExpiredDict
+from common.log import logger
+from config import conf, subscribe
+
+_SPACES = re.compile(r"\s+")
+_TRAILING_PUNCTUATION = "?!.。~～…"
+
+
+def normalize_query(query):
+    """全半角统一、忽略大小写、合并空白并去掉句末标点，"怎么退款？"与"怎么退款"视为同一问题"""
+    text = unicodedata.normalize("NFKC", query).casefold()
+    text = _SPACES.sub(" ", text).strip()
+    return text.rstrip(_TRAILING_PUNCTUATION).rstrip()
+
+
+class ReplyCache:
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        # ExpiredDict读取时会刷新过期时间，这里只用它做数量上限，过期按写入时间判断
+        self.entries = ExpiredDict(ttl, maxsize=max_entries)  # key -> (回复内容, 写入时间, 调用耗时)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.saved_seconds = 0.0
+
+    @staticmethod
+    def make_key(bot_type, model, system_prompt, query):
+        prompt_digest = hashlib.sha256((system_prompt or "").encode("utf-8")).hexdigest()[:16]
+        return (bot_type, model or "", prompt_digest, normalize_query(query))
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and time.monotonic() - entry[1] > self.ttl:
+            self.entries.pop(key, None)
+            entry = None
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.saved_seconds += entry[2]
+        return entry[0]
+
+    def put(self, key, content, elapsed):
+        self.entries[key] = (content, time.monotonic(), elapsed)
+
+    def bypass(self):
+        with self.lock:
+            self.bypassed += 1
+
+    def resize(self, ttl, max_entries):
+        self.ttl = ttl
+        self.entries.expires_in_seconds = ttl
+        self.entries.maxsize = max_entries
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "hit_rate": self.hits / total if total else 0,
+            "entries": len(self.entries),
+            "saved_seconds": self.saved_seconds,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_reply_cache():
+    """返回全局缓存，reply_cache未开启时返回None"""
+    global _cache
+    if not conf().get("reply_cache", False):
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ReplyCache(conf().get("reply_cache_ttl", 3600), conf().get("reply_cache_max_entries", 1000))
+    return _cache
+
+
+@subscribe
+def _on_config(config):
+    # 配置重载后调整过期时间和容量，已缓存的回复保留
+    if _cache is not None:
+        _cache.resize(config.get("reply_cache_ttl", 3600), config.get("reply_cache_max_entries", 1000))
+
+
+def _chat_enabled(context: Context):
+    if not context.get("isgroup", False):
+        return conf().get("reply_cache_single_chat", True)
+    white_list = conf().get("reply_cache_group_white_list") or []
+    if "ALL_GROUP" in white_list:
+        return True
+    msg = context.get("msg")
+    return msg is not None and msg.other_user_nickname in white_list
+
+
+def _cache_key(bot, bot_type, query, context: Context):
+    """
+    返回缓存key，不适合缓存时返回None
+    只缓存无历史消息的文本问答，缓存命中时不调用大模型，因此携带图片、文件或需要流式输出的请求都不缓存
+    """
+    if context.type != ContextType.TEXT or context.get("stream") or not _chat_enabled(context):
+        return None
+    session_id = context.get("session_id")
+    sessions = getattr(bot, "sessions", None)
+    if session_id is None or sessions is None or not hasattr(sessions, "build_session"):
+        return None
+    if memory.USER_IMAGE_CACHE.get(session_id):  # 用户刚发送的图片会随本次提问一起发给模型
+        return None
+    session = sessions.build_session(session_id)
+    if any(message.get("role") != "system" for message in session.messages):
+        return None
+    model = context.get("gpt_model") or conf().get("model")
+    app_code = context.get("app_code")  # LinkAI应用决定了实际的人设和知识库
+    if app_code:
+        model = "{}:{}".format(model, app_code)
+    return ReplyCache.make_key(bot_type, model, session.system_prompt, query)
+
+
+def lookup_reply(bot, bot_type, query, context: Context):
+    """
+    查询缓存，返回 (缓存, key, 命中的回复)
+    未命中时由调用方请求机器人后调用store_reply写入，不适合缓存的请求key为None
+    :param bot: 对话机器人实例
+    :param bot_type: 机器人类型，如 chatGPT、linkai
+    """
+    cache = get_reply_cache()
+    if cache is None:
+        return None, None, None
+    try:
+        key = _cache_key(bot, bot_type, query, context)
+    except Exception as e:
+        logger.warning("[ReplyCache] build key failed: {}".format(e))
+        key = None
+    if key is None:
+        cache.bypass()
+        return None, None, None
+    content = cache.get(key)
+    if content is None:
+        return cache, key, None
+    logger.info("[ReplyCache] hit, bot={}, query={}".format(bot_type, query))
+    # 与实际调用一样记录问答，后续提问能看到这轮对话
+    session_id = context["session_id"]
+    try:
+        bot.sessions.session_query(query, session_id)
+        bot.sessions.session_reply(content, session_id)
+    except Exception as e:
+        logger.warning("[ReplyCache] record session failed: {}".format(e))
+    return cache, key, Reply(ReplyType.TEXT, content)
+
+
+def store_reply(cache, key, reply: Reply, elapsed):
+    """缓存文本回复，elapsed为本次调用耗时，命中时计入节省的耗时"""
+    if cache is not None and key is not None and reply is not None and reply.type == ReplyType.TEXT and isinstance(reply.content, str):
+        cache.put(key, reply.content, elapsed)
+
+
+def format_reply_cache_stats() -> str:
+    cache = _cache
+    if cache is None:
+        return "回复缓存: 未启用或暂无记录"
+    s = cache.stats()
+    return "回复缓存: 命中 {hits}, 未命中 {misses}, 跳过 {bypassed}, 命中率 {hit_rate:.0%}, 条目 {entries}, 节省耗时 {saved_seconds:.1f}s".format(**s)
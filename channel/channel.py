@@ -10,6 +10,7 @@ from bridge.reply import *
 class Channel(object):
     channel_type = ""
     NOT_SUPPORT_REPLYTYPE = [ReplyType.VOICE, ReplyType.IMAGE]
+    SUPPORT_STREAM_REPLY = False  # 是否支持流式回复，支持的通道在send中处理ReplyType.STREAM，content为按句切分后的文本片段迭代器
 
     def startup(self):
         """
@@ -37,6 +38,9 @@ class Channel(object):
     def build_reply_content(self, query, context: Context = None) -> Reply:
         return Bridge().fetch_reply_content(query, context)
 
+    async def build_reply_content_async(self, query, context: Context = None) -> Reply:
+        return await Bridge().fetch_reply_content_async(query, context)
+
     def build_voice_to_text(self, voice_file) -> Reply:
         return Bridge().fetch_voice_to_text(voice_file)
 
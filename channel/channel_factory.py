@@ -21,6 +21,9 @@ def create_channel(channel_type) -> Channel:
     elif channel_type == "terminal":
         from channel.terminal.terminal_channel import TerminalChannel
         ch = TerminalChannel()
+    elif channel_type == "loadtest":
+        from channel.loadtest.loadtest_channel import LoadTestChannel
+        ch = LoadTestChannel()
     elif channel_type == 'web':
         from channel.web.web_channel import WebChannel
         ch = WebChannel()
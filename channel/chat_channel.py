@@ -1,40 +1,48 @@
+import asyncio
 import os
-import re
 import threading
 import time
-from asyncio import CancelledError
-from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import CancelledError, Future
+from queue import Queue
 
+from bridge.bridge import Bridge
 from bridge.context import *
 from bridge.reply import *
 from channel.channel import Channel
+from channel.trigger_matcher import get_trigger_matcher, remove_mention
 from common.dequeue import Dequeue
-from common import memory
+from common import memory, metrics
+from common.utils import iter_sentences
+from common.worker_pool import HANDLER_POOL_LLM, HANDLER_POOL_MEDIA, HANDLER_POOL_PLUGIN, current_worker_pool, get_handler_pool
 from plugins import *
 
 try:
-    from voice.audio_convert import any_to_wav
+    from voice.audio_convert import decode_audio
 except Exception as e:
     pass
 
-handler_pool = ThreadPoolExecutor(max_workers=8)  # 处理消息的线程池
-
-
 # 抽象类, 它包含了与消息通道无关的通用处理逻辑
 class ChatChannel(Channel):
     name = None  # 登录的用户名
     user_id = None  # 登录的用户id
     futures = {}  # 记录每个session_id提交到线程池的future对象, 用于重置会话时把没执行的future取消掉，正在执行的不会被取消
     sessions = {}  # 用于控制并发，每个session_id同时只能有一个context在处理
-    lock = threading.Lock()  # 用于控制对sessions的访问
+    ready_queue = Queue()  # 就绪队列，存放有待处理消息且占用了并发额度的session_id，由produce和任务完成回调写入
+    lock = threading.RLock()  # 用于控制对sessions的访问，取消future时回调会在同一线程内重入
+    async_loop = None  # 异步模式下执行模型调用的事件循环，首次使用时在单独线程中启动
+    async_semaphore = None  # 异步模式下限制同时进行中的模型调用数
 
     def __init__(self):
         _thread = threading.Thread(target=self.consume)
         _thread.setDaemon(True)
         _thread.start()
 
-    # 根据消息构造context，消息内容相关的触发项写在这里
     def _compose_context(self, ctype: ContextType, content, **kwargs):
+        with metrics.span("compose_context", self.channel_type, ctype=ctype):
+            return self._build_context(ctype, content, **kwargs)
+
+    # 根据消息构造context，消息内容相关的触发项写在这里
+    def _build_context(self, ctype: ContextType, content, **kwargs):
         context = Context(ctype, content)
         context.kwargs = kwargs
         # context首次传入时，origin_ctype是None,
@@ -47,6 +55,7 @@ class ChatChannel(Channel):
         # 群名匹配过程，设置session_id和receiver
         if first_in:  # context首次传入时，receiver是None，根据类型设置receiver
             config = conf()
+            matcher = get_trigger_matcher()
             cmsg = context["msg"]
             user_data = conf().get_user_data(cmsg.from_user_id)
             context["openai_api_key"] = user_data.get("openai_api_key")
@@ -55,23 +64,9 @@ class ChatChannel(Channel):
                 group_name = cmsg.other_user_nickname
                 group_id = cmsg.other_user_id
 
-                group_name_white_list = config.get("group_name_white_list", [])
-                group_name_keyword_white_list = config.get("group_name_keyword_white_list", [])
-                if any(
-                    [
-                        group_name in group_name_white_list,
-                        "ALL_GROUP" in group_name_white_list,
-                        check_contain(group_name, group_name_keyword_white_list),
-                    ]
-                ):
-                    group_chat_in_one_session = conf().get("group_chat_in_one_session", [])
+                if matcher.group_allowed(group_name):
                     session_id = cmsg.actual_user_id
-                    if any(
-                        [
-                            group_name in group_chat_in_one_session,
-                            "ALL_GROUP" in group_chat_in_one_session,
-                        ]
-                    ):
+                    if matcher.group_in_one_session(group_name):
                         session_id = group_id
                 else:
                     logger.debug(f"No need reply, groupName not in whitelist, group_name={group_name}")
@@ -96,20 +91,19 @@ class ChatChannel(Channel):
                 logger.debug("[chat_channel]reference query skipped")
                 return None
 
-            nick_name_black_list = conf().get("nick_name_black_list", [])
+            matcher = get_trigger_matcher()
             if context.get("isgroup", False):  # 群聊
                 # 校验关键字
-                match_prefix = check_prefix(content, conf().get("group_chat_prefix"))
-                match_contain = check_contain(content, conf().get("group_chat_keyword"))
+                match_prefix = matcher.group_chat_prefix.match(content)
                 flag = False
                 if context["msg"].to_user_id != context["msg"].actual_user_id:
-                    if match_prefix is not None or match_contain is not None:
+                    if match_prefix is not None or matcher.group_chat_keyword.contains(content):
                         flag = True
                         if match_prefix:
                             content = content.replace(match_prefix, "", 1).strip()
                     if context["msg"].is_at:
                         nick_name = context["msg"].actual_user_nickname
-                        if nick_name and nick_name in nick_name_black_list:
+                        if matcher.in_black_list(nick_name):
                             # 黑名单过滤
                             logger.warning(f"[chat_channel] Nickname {nick_name} in In BlackList, ignore")
                             return None
@@ -118,16 +112,13 @@ class ChatChannel(Channel):
                         if not conf().get("group_at_off", False):
                             flag = True
                         self.name = self.name if self.name is not None else ""  # 部分渠道self.name可能没有赋值
-                        pattern = f"@{re.escape(self.name)}(\u2005|\u0020)"
-                        subtract_res = re.sub(pattern, r"", content)
+                        subtract_res = remove_mention(content, self.name)
                         if isinstance(context["msg"].at_list, list):
                             for at in context["msg"].at_list:
-                                pattern = f"@{re.escape(at)}(\u2005|\u0020)"
-                                subtract_res = re.sub(pattern, r"", subtract_res)
+                                subtract_res = remove_mention(subtract_res, at)
                         if subtract_res == content and context["msg"].self_display_name:
                             # 前缀移除后没有变化，使用群昵称再次移除
-                            pattern = f"@{re.escape(context['msg'].self_display_name)}(\u2005|\u0020)"
-                            subtract_res = re.sub(pattern, r"", content)
+                            subtract_res = remove_mention(content, context["msg"].self_display_name)
                         content = subtract_res
                 if not flag:
                     if context["origin_ctype"] == ContextType.VOICE:
@@ -135,12 +126,12 @@ class ChatChannel(Channel):
                     return None
             else:  # 单聊
                 nick_name = context["msg"].from_user_nickname
-                if nick_name and nick_name in nick_name_black_list:
+                if matcher.in_black_list(nick_name):
                     # 黑名单过滤
                     logger.warning(f"[chat_channel] Nickname '{nick_name}' in In BlackList, ignore")
                     return None
 
-                match_prefix = check_prefix(content, conf().get("single_chat_prefix", [""]))
+                match_prefix = matcher.single_chat_prefix.match(content)
                 if match_prefix is not None:  # 判断如果匹配到自定义前缀，则返回过滤掉前缀+空格后的内容
                     content = content.replace(match_prefix, "", 1).strip()
                 elif context["origin_ctype"] == ContextType.VOICE:  # 如果源消息是私聊的语音消息，允许不匹配前缀，放宽条件
@@ -148,7 +139,7 @@ class ChatChannel(Channel):
                 else:
                     return None
             content = content.strip()
-            img_match_prefix = check_prefix(content, conf().get("image_create_prefix",[""]))
+            img_match_prefix = matcher.image_create_prefix.match(content)
             if img_match_prefix:
                 content = content.replace(img_match_prefix, "", 1)
                 context.type = ContextType.IMAGE_CREATE
@@ -162,52 +153,112 @@ class ChatChannel(Channel):
                 context["desire_rtype"] = ReplyType.VOICE
         return context
 
-    def _handle(self, context: Context):
+    def _handle(self, context: Context, e_context: EventContext = None):
         if context is None or not context.content:
             return
-        logger.debug("[chat_channel] ready to handle context: {}".format(context))
+        if e_context is None:
+            logger.debug("[chat_channel] ready to handle context: {}".format(context))
+            e_context = self._emit_handle_context(context)
+            pool_name = self._route_handler_pool(context, e_context)
+            if pool_name == HANDLER_POOL_LLM and conf().get("async_pipeline", False):
+                # 异步模式下模型调用交给事件循环，返回的future由_thread_pool_callback接管
+                return asyncio.run_coroutine_threadsafe(self._handle_async(context, e_context), self._get_async_loop())
+            if pool_name and pool_name != current_worker_pool():
+                # 插件处理完毕，转交给对应的线程池继续处理，返回的future由_thread_pool_callback接管
+                logger.debug("[chat_channel] hand over context to pool {}".format(pool_name))
+                return get_handler_pool(pool_name).submit(self._handle, context, e_context)
         # reply的构建步骤
-        reply = self._generate_reply(context)
-
+        reply = self._generate_reply(context, e_context=e_context)
+        self._deliver_reply(context, reply)
+
+    async def _handle_async(self, context: Context, e_context: EventContext):
+        if self.async_semaphore is None:  # 只在事件循环线程中创建和访问
+            self.async_semaphore = asyncio.Semaphore(conf().get("async_max_inflight", 1000))
+        async with self.async_semaphore:
+            context["channel"] = e_context["channel"]
+            if self._need_stream(context):
+                context["stream"] = True
+            with metrics.span("fetch_reply", self.channel_type, Bridge().get_bot_type("chat"), ctype=context.type):
+                reply = await super().build_reply_content_async(context.content, context)
+        # 装饰和发送包含插件逻辑和阻塞IO，交回线程池执行，流式回复在发送时才读取模型输出，交给llm线程池
+        pool_name = HANDLER_POOL_LLM if reply and reply.type == ReplyType.STREAM else HANDLER_POOL_PLUGIN
+        await asyncio.wrap_future(get_handler_pool(pool_name).submit(self._deliver_reply, context, reply))
+
+    def _get_async_loop(self):
+        with self.lock:
+            if self.async_loop is None:
+                loop = asyncio.new_event_loop()
+                _thread = threading.Thread(target=loop.run_forever)
+                _thread.setDaemon(True)
+                _thread.start()
+                self.async_loop = loop
+                logger.info("[chat_channel] async pipeline started")
+        return self.async_loop
+
+    def _deliver_reply(self, context: Context, reply: Reply):
         logger.debug("[chat_channel] ready to decorate reply: {}".format(reply))
 
         # reply的包装步骤
         if reply and reply.content:
-            reply = self._decorate_reply(context, reply)
+            with metrics.span("decorate_reply", self.channel_type, ctype=context.type):
+                reply = self._decorate_reply(context, reply)
 
             # reply的发送步骤
             self._send_reply(context, reply)
 
-    def _generate_reply(self, context: Context, reply: Reply = Reply()) -> Reply:
-        e_context = PluginManager().emit_event(
+    def _emit_handle_context(self, context: Context, reply: Reply = Reply()) -> EventContext:
+        return PluginManager().emit_event(
             EventContext(
                 Event.ON_HANDLE_CONTEXT,
                 {"channel": self, "context": context, "reply": reply},
             )
         )
+
+    # 选择处理context的线程池，e_context为None时按消息类型选择，否则根据插件的处理结果选择，返回None表示留在当前线程
+    def _route_handler_pool(self, context: Context, e_context: EventContext = None):
+        if e_context is None:
+            if context.type in [ContextType.VOICE, ContextType.IMAGE, ContextType.FILE, ContextType.VIDEO]:
+                return HANDLER_POOL_MEDIA
+            return HANDLER_POOL_PLUGIN
+        breaked_by = e_context.econtext.get("breaked_by")
+        if breaked_by:
+            for plugin_name, pool_name in (conf().get("handler_pool_routes") or {}).items():
+                if plugin_name.upper() == breaked_by:
+                    return pool_name
+        if e_context.is_pass():
+            return None
+        if context.type == ContextType.TEXT or context.type == ContextType.IMAGE_CREATE:
+            return HANDLER_POOL_LLM
+        return None
+
+    def _generate_reply(self, context: Context, reply: Reply = Reply(), e_context: EventContext = None) -> Reply:
+        if e_context is None:
+            e_context = self._emit_handle_context(context, reply)
         reply = e_context["reply"]
         if not e_context.is_pass():
             logger.debug("[chat_channel] ready to handle context: type={}, content={}".format(context.type, context.content))
             if context.type == ContextType.TEXT or context.type == ContextType.IMAGE_CREATE:  # 文字和图片消息
                 context["channel"] = e_context["channel"]
-                reply = super().build_reply_content(context.content, context)
+                if self._need_stream(context):
+                    context["stream"] = True
+                with metrics.span("fetch_reply", self.channel_type, Bridge().get_bot_type("chat"), ctype=context.type):
+                    reply = super().build_reply_content(context.content, context)
             elif context.type == ContextType.VOICE:  # 语音消息
                 cmsg = context["msg"]
                 cmsg.prepare()
                 file_path = context.content
-                wav_path = os.path.splitext(file_path)[0] + ".wav"
+                # 按语音识别引擎需要的格式直接解码到内存，不再生成wav临时文件
+                asr = Bridge().get_bot("voice_to_text")
                 try:
-                    any_to_wav(file_path, wav_path)
-                except Exception as e:  # 转换失败，直接使用mp3，对于某些api，mp3也可以识别
-                    logger.warning("[chat_channel]any to wav error, use raw path. " + str(e))
-                    wav_path = file_path
+                    voice = decode_audio(file_path, asr.asr_sample_rate, asr.asr_channels)
+                except Exception as e:  # 转换失败，直接使用原文件，对于某些api，mp3也可以识别
+                    logger.warning("[chat_channel]decode voice error, use raw path. " + str(e))
+                    voice = file_path
                 # 语音识别
-                reply = super().build_voice_to_text(wav_path)
+                reply = super().build_voice_to_text(voice)
                 # 删除临时文件
                 try:
                     os.remove(file_path)
-                    if wav_path != file_path:
-                        os.remove(wav_path)
                 except Exception as e:
                     pass
                     # logger.warning("[chat_channel]delete temp file error: " + str(e))
@@ -232,7 +283,17 @@ class ChatChannel(Channel):
                 return
         return reply
 
+    # 是否请求模型流式输出，只有通道支持流式回复且不需要转语音时才开启
+    def _need_stream(self, context: Context) -> bool:
+        if not self.SUPPORT_STREAM_REPLY or not conf().get("stream_reply", False):
+            return False
+        return context.type == ContextType.TEXT and context.get("desire_rtype") != ReplyType.VOICE
+
     def _decorate_reply(self, context: Context, reply: Reply) -> Reply:
+        if reply and reply.type == ReplyType.STREAM:
+            if self.SUPPORT_STREAM_REPLY and context.get("desire_rtype") != ReplyType.VOICE:
+                return Reply(ReplyType.STREAM, self._decorate_stream(context, reply.content))
+            reply = Reply(ReplyType.TEXT, "".join(reply.content))  # 通道不支持流式回复，拼接为完整文本
         if reply and reply.type:
             e_context = PluginManager().emit_event(
                 EventContext(
@@ -271,6 +332,37 @@ class ChatChannel(Channel):
                 logger.warning("[chat_channel] desire_rtype: {}, but reply type: {}".format(context.get("desire_rtype"), reply.type))
             return reply
 
+    # 将模型的流式输出按句切分，每段分别经过插件装饰，前缀加在第一段，后缀作为最后一段
+    def _decorate_stream(self, context: Context, chunks):
+        first = True
+        for segment in iter_sentences(chunks, conf().get("stream_segment_min_len", 10)):
+            e_context = PluginManager().emit_event(
+                EventContext(
+                    Event.ON_DECORATE_REPLY,
+                    {"channel": self, "context": context, "reply": Reply(ReplyType.TEXT, segment)},
+                )
+            )
+            reply = e_context["reply"]
+            if not reply or not reply.content:  # 插件拦截了回复，已发送的片段无法撤回，停止后续发送
+                logger.info("[chat_channel] stream reply stopped by plugin")
+                return
+            text = reply.content
+            if first and not e_context.is_pass():
+                if context.get("isgroup", False):
+                    if not context.get("no_need_at", False):
+                        text = "@" + context["msg"].actual_user_nickname + "\n" + text.lstrip()
+                    text = conf().get("group_chat_reply_prefix", "") + text
+                else:
+                    text = conf().get("single_chat_reply_prefix", "") + text
+            first = False
+            yield text
+        if context.get("isgroup", False):
+            suffix = conf().get("group_chat_reply_suffix", "")
+        else:
+            suffix = conf().get("single_chat_reply_suffix", "")
+        if suffix and not first:
+            yield suffix
+
     def _send_reply(self, context: Context, reply: Reply):
         if reply and reply.type:
             e_context = PluginManager().emit_event(
@@ -282,7 +374,8 @@ class ChatChannel(Channel):
             reply = e_context["reply"]
             if not e_context.is_pass() and reply and reply.type:
                 logger.debug("[chat_channel] ready to send reply: {}, context: {}".format(reply, context))
-                self._send(reply, context)
+                with metrics.span("send", self.channel_type, ctype=context.type):  # 包含失败重试的等待时间
+                    self._send(reply, context)
 
     def _send(self, reply: Reply, context: Context, retry_cnt=0):
         try:
@@ -292,7 +385,7 @@ class ChatChannel(Channel):
             if isinstance(e, NotImplementedError):
                 return
             logger.exception(e)
-            if retry_cnt < 2:
+            if retry_cnt < 2 and reply.type != ReplyType.STREAM:  # 流式回复已被读取，无法重发
                 time.sleep(3 + 3 * retry_cnt)
                 self._send(reply, context, retry_cnt + 1)
 
@@ -302,20 +395,35 @@ class ChatChannel(Channel):
     def _fail_callback(self, session_id, exception, **kwargs):  # 线程异常结束时的回调函数
         logger.exception("Worker return exception: {}".format(exception))
 
+    def _cancel_callback(self, session_id, **kwargs):  # 任务被取消时的回调函数
+        logger.info("Worker cancelled, session_id = {}".format(session_id))
+
     def _thread_pool_callback(self, session_id, **kwargs):
         def func(worker: Future):
             try:
                 worker_exception = worker.exception()
                 if worker_exception:
                     self._fail_callback(session_id, exception=worker_exception, **kwargs)
+                elif isinstance(worker.result(), Future):  # 已转交给其他线程池，等其完成后再释放会话
+                    next_worker = worker.result()
+                    with self.lock:
+                        if worker in self.futures.get(session_id, []):
+                            self.futures[session_id].remove(worker)
+                            self.futures[session_id].append(next_worker)
+                    next_worker.add_done_callback(self._thread_pool_callback(session_id, **kwargs))
+                    return
                 else:
                     self._success_callback(session_id, **kwargs)
             except CancelledError as e:
-                logger.info("Worker cancelled, session_id = {}".format(session_id))
+                self._cancel_callback(session_id, **kwargs)
             except Exception as e:
                 logger.exception("Worker raise exception: {}".format(e))
             with self.lock:
-                self.sessions[session_id][1].release()
+                if worker in self.futures.get(session_id, []):
+                    self.futures[session_id].remove(worker)
+                if session_id in self.sessions:
+                    self.sessions[session_id][1].release()
+                    self._arm_session(session_id)  # 任务完成后释放的并发额度，交给同一会话中排队的消息
 
         return func
 
@@ -331,40 +439,47 @@ class ChatChannel(Channel):
                 self.sessions[session_id][0].putleft(context)  # 优先处理管理命令
             else:
                 self.sessions[session_id][0].put(context)
+            self._arm_session(session_id)
+
+    # 会话中有待处理的消息且还有并发额度时，占用一个额度并把session_id放入就绪队列，需在持有self.lock时调用
+    def _arm_session(self, session_id):
+        context_queue, semaphore = self.sessions[session_id]
+        if context_queue.empty():
+            if semaphore._initial_value == semaphore._value:  # 没有排队和处理中的消息，清理会话
+                self.futures.pop(session_id, None)
+                del self.sessions[session_id]
+            return
+        if semaphore.acquire(blocking=False):
+            self.ready_queue.put(session_id)
 
-    # 消费者函数，单独线程，用于从消息队列中取出消息并处理
+    # 消费者函数，单独线程，阻塞等待就绪队列中的session_id，取出对应会话的消息并提交到线程池处理
     def consume(self):
         while True:
+            session_id = self.ready_queue.get()
             with self.lock:
-                session_ids = list(self.sessions.keys())
-            for session_id in session_ids:
-                with self.lock:
-                    context_queue, semaphore = self.sessions[session_id]
-                if semaphore.acquire(blocking=False):  # 等线程处理完毕才能删除
-                    if not context_queue.empty():
-                        context = context_queue.get()
-                        logger.debug("[chat_channel] consume context: {}".format(context))
-                        future: Future = handler_pool.submit(self._handle, context)
-                        future.add_done_callback(self._thread_pool_callback(session_id, context=context))
-                        with self.lock:
-                            if session_id not in self.futures:
-                                self.futures[session_id] = []
-                            self.futures[session_id].append(future)
-                    elif semaphore._initial_value == semaphore._value + 1:  # 除了当前，没有任务再申请到信号量，说明所有任务都处理完毕
-                        with self.lock:
-                            self.futures[session_id] = [t for t in self.futures[session_id] if not t.done()]
-                            assert len(self.futures[session_id]) == 0, "thread pool error"
-                            del self.sessions[session_id]
-                    else:
-                        semaphore.release()
-            time.sleep(0.2)
+                if session_id not in self.sessions:
+                    continue
+                context_queue, semaphore = self.sessions[session_id]
+                if context_queue.empty():  # 排队的消息已被取消，归还额度
+                    semaphore.release()
+                    self._arm_session(session_id)
+                    continue
+                context = context_queue.get()
+                logger.debug("[chat_channel] consume context: {}".format(context))
+                future: Future = get_handler_pool(self._route_handler_pool(context)).submit(self._handle, context)
+                if session_id not in self.futures:
+                    self.futures[session_id] = []
+                self.futures[session_id].append(future)
+            future.add_done_callback(self._thread_pool_callback(session_id, context=context))
 
     # 取消session_id对应的所有任务，只能取消排队的消息和已提交线程池但未执行的任务
     def cancel_session(self, session_id):
         with self.lock:
             if session_id in self.sessions:
-                for future in self.futures[session_id]:
+                for future in list(self.futures.get(session_id, [])):
                     future.cancel()
+                if session_id not in self.sessions:
+                    return
                 cnt = self.sessions[session_id][0].qsize()
                 if cnt > 0:
                     logger.info("Cancel {} messages in session {}".format(cnt, session_id))
@@ -372,9 +487,11 @@ class ChatChannel(Channel):
 
     def cancel_all_session(self):
         with self.lock:
-            for session_id in self.sessions:
-                for future in self.futures[session_id]:
+            for session_id in list(self.sessions.keys()):
+                for future in list(self.futures.get(session_id, [])):
                     future.cancel()
+                if session_id not in self.sessions:
+                    continue
                 cnt = self.sessions[session_id][0].qsize()
                 if cnt > 0:
                     logger.info("Cancel {} messages in session {}".format(cnt, session_id))
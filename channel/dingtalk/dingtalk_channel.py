@@ -15,6 +15,7 @@ from dingtalk_stream import AckMessage
 from dingtalk_stream.card_replier import AICardReplier
 from dingtalk_stream.card_replier import AICardStatus
 from dingtalk_stream.card_replier import CardReplier
+from dingtalk_stream.card_instance import AIMarkdownCardInstance
 
 from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
@@ -24,7 +25,7 @@ from common.expired_dict import ExpiredDict
 from common.log import logger
 from common.singleton import singleton
 from common.time_check import time_checker
-from config import conf
+from config import conf, update_config
 
 
 class CustomAICardReplier(CardReplier):
@@ -101,12 +102,12 @@ class DingTalkChanel(ChatChannel, dingtalk_stream.ChatbotHandler):
         self.logger = self.setup_logger()
         # 历史消息id暂存，用于幂等控制
         self.receivedMsgs = ExpiredDict(conf().get("expires_in_seconds", 3600))
+        # AI卡片支持流式更新内容
+        self.SUPPORT_STREAM_REPLY = conf().get("dingtalk_card_enabled", False)
         logger.info("[DingTalk] client_id={}, client_secret={} ".format(
             self.dingtalk_client_id, self.dingtalk_client_secret))
-        # 无需群校验和前缀
-        conf()["group_name_white_list"] = ["ALL_GROUP"]
-        # 单聊无需前缀
-        conf()["single_chat_prefix"] = [""]
+        # 无需群校验和前缀，单聊无需前缀
+        update_config({"group_name_white_list": ["ALL_GROUP"], "single_chat_prefix": [""]})
 
     def startup(self):
         credential = dingtalk_stream.Credential(self.dingtalk_client_id, self.dingtalk_client_secret)
@@ -187,7 +188,11 @@ class DingTalkChanel(ChatChannel, dingtalk_stream.ChatbotHandler):
                 button_list, markdown_content = self.generate_button_markdown_content(context, reply)
                 self.reply_ai_markdown_button(incoming_message, markdown_content, button_list, "", "📌 内容由AI生成", "",[incoming_message.sender_staff_id])
 
-            if reply.type in [ReplyType.IMAGE_URL, ReplyType.IMAGE, ReplyType.TEXT]:
+            if reply.type == ReplyType.STREAM:
+                self.reply_ai_markdown_stream(incoming_message, reply.content, [incoming_message.sender_staff_id])
+                if isgroup:
+                    reply_with_at_text()
+            elif reply.type in [ReplyType.IMAGE_URL, ReplyType.IMAGE, ReplyType.TEXT]:
                 if isgroup:
                     reply_with_ai_markdown()
                     reply_with_at_text()
@@ -200,6 +205,25 @@ class DingTalkChanel(ChatChannel, dingtalk_stream.ChatbotHandler):
             self.reply_text(reply.content, incoming_message)
 
 
+    def reply_ai_markdown_stream(self, incoming_message, segments, recipients=None):
+        """
+        创建AI卡片后随着回复片段的到达刷新卡片内容
+        :param segments: 回复文本片段迭代器
+        """
+        card_instance = AIMarkdownCardInstance(self.dingtalk_client, incoming_message)
+        card_instance.set_title_and_logo("📌 内容由AI生成", "")
+        card_instance.ai_start(recipients=recipients)
+        markdown = ""
+        try:
+            for segment in segments:
+                markdown += segment
+                card_instance.ai_streaming(markdown=markdown, append=False)
+        except Exception as e:
+            logger.error("[Dingtalk] stream reply error: {}".format(e))
+            card_instance.ai_fail()
+            return
+        card_instance.ai_finish(markdown=markdown, button_list=[], tips="")
+
     def generate_button_markdown_content(self, context, reply):
         image_url = context.kwargs.get("image_url")
         promptEn = context.kwargs.get("promptEn")
@@ -6,28 +6,30 @@
 """
 
 # -*- coding=utf-8 -*-
-import uuid
 
-import requests
+from common import http_client
 import web
 from channel.feishu.feishu_message import FeishuMessage
 from bridge.context import Context
 from bridge.reply import Reply, ReplyType
+from common.http_server import serve_wsgi
 from common.log import logger
+from common.media_cache import cached_upload, fetch_media
 from common.singleton import singleton
-from config import conf
+from config import conf, update_config
 from common.expired_dict import ExpiredDict
+from common.token_cache import get_access_token, invalidate_access_token
 from bridge.context import ContextType
 from channel.chat_channel import ChatChannel, check_prefix
 from common import utils
 import json
-import os
 
 URL_VERIFICATION = "url_verification"
 
 
 @singleton
 class FeiShuChanel(ChatChannel):
+    IMAGE_KEY_CACHE_SECONDS = 30 * 24 * 3600  # 上传图片得到的image_key的复用时间
     feishu_app_id = conf().get('feishu_app_id')
     feishu_app_secret = conf().get('feishu_app_secret')
     feishu_token = conf().get('feishu_token')
@@ -39,8 +41,7 @@ class FeiShuChanel(ChatChannel):
         logger.info("[FeiShu] app_id={}, app_secret={} verification_token={}".format(
             self.feishu_app_id, self.feishu_app_secret, self.feishu_token))
         # 无需群校验和前缀
-        conf()["group_name_white_list"] = ["ALL_GROUP"]
-        conf()["single_chat_prefix"] = [""]
+        update_config({"group_name_white_list": ["ALL_GROUP"], "single_chat_prefix": [""]})
 
     def startup(self):
         urls = (
@@ -48,7 +49,7 @@ class FeiShuChanel(ChatChannel):
         )
         app = web.application(urls, globals(), autoreload=False)
         port = conf().get("feishu_port", 9891)
-        web.httpserver.runsimple(app.wsgifunc(), ("0.0.0.0", port))
+        serve_wsgi(app.wsgifunc(), port)
 
     def send(self, reply: Reply, context: Context):
         msg = context.get("msg")
@@ -80,7 +81,7 @@ class FeiShuChanel(ChatChannel):
                 "msg_type": msg_type,
                 "content": json.dumps({content_key: reply_content})
             }
-            res = requests.post(url=url, headers=headers, json=data, timeout=(5, 10))
+            res = http_client.post(url=url, headers=headers, json=data, timeout=(5, 10))
         else:
             url = "https://open.feishu.cn/open-apis/im/v1/messages"
             params = {"receive_id_type": context.get("receive_id_type") or "open_id"}
@@ -89,15 +90,21 @@ class FeiShuChanel(ChatChannel):
                 "msg_type": msg_type,
                 "content": json.dumps({content_key: reply_content})
             }
-            res = requests.post(url=url, headers=headers, params=params, json=data, timeout=(5, 10))
+            res = http_client.post(url=url, headers=headers, params=params, json=data, timeout=(5, 10))
         res = res.json()
         if res.get("code") == 0:
             logger.info(f"[FeiShu] send message success")
         else:
             logger.error(f"[FeiShu] send message failed, code={res.get('code')}, msg={res.get('msg')}")
+            if res.get("code") in [99991661, 99991663]:  # tenant_access_token缺失或无效
+                invalidate_access_token("feishu", (self.feishu_app_id, self.feishu_app_secret))
 
 
     def fetch_access_token(self) -> str:
+        token = get_access_token("feishu", (self.feishu_app_id, self.feishu_app_secret), self._fetch_access_token)
+        return token or ""
+
+    def _fetch_access_token(self):
         url = "https://open.feishu.cn/open-apis/auth/v3/tenant_access_token/internal/"
         headers = {
             "Content-Type": "application/json"
@@ -107,41 +114,38 @@ class FeiShuChanel(ChatChannel):
             "app_secret": self.feishu_app_secret
         }
         data = bytes(json.dumps(req_body), encoding='utf8')
-        response = requests.post(url=url, data=data, headers=headers)
+        response = http_client.post(url=url, data=data, headers=headers)
         if response.status_code == 200:
             res = response.json()
             if res.get("code") != 0:
                 logger.error(f"[FeiShu] get tenant_access_token error, code={res.get('code')}, msg={res.get('msg')}")
-                return ""
+                return None, 0
             else:
-                return res.get("tenant_access_token")
+                return res.get("tenant_access_token"), res.get("expire")
         else:
             logger.error(f"[FeiShu] fetch token error, res={response}")
+            return None, 0
 
 
     def _upload_image_url(self, img_url, access_token):
-        logger.debug(f"[WX] start download image, img_url={img_url}")
-        response = requests.get(img_url)
+        logger.debug(f"[FeiShu] start download image, img_url={img_url}")
+        media = fetch_media(img_url)
         suffix = utils.get_path_suffix(img_url)
-        temp_name = str(uuid.uuid4()) + "." + suffix
-        if response.status_code == 200:
-            # 将图片内容保存为临时文件
-            with open(temp_name, "wb") as file:
-                file.write(response.content)
-
-        # upload
-        upload_url = "https://open.feishu.cn/open-apis/im/v1/images"
-        data = {
-            'image_type': 'message'
-        }
-        headers = {
-            'Authorization': f'Bearer {access_token}',
-        }
-        with open(temp_name, "rb") as file:
-            upload_response = requests.post(upload_url, files={"image": file}, data=data, headers=headers)
+
+        def upload():
+            upload_url = "https://open.feishu.cn/open-apis/im/v1/images"
+            data = {
+                'image_type': 'message'
+            }
+            headers = {
+                'Authorization': f'Bearer {access_token}',
+            }
+            upload_response = http_client.post(upload_url, files={"image": (media.digest + "." + suffix, media.open())}, data=data, headers=headers)
             logger.info(f"[FeiShu] upload file, res={upload_response.content}")
-            os.remove(temp_name)
-            return upload_response.json().get("data").get("image_key")
+            return (upload_response.json().get("data") or {}).get("image_key")
+
+        # image_key长期有效
+        return cached_upload("feishu:{}".format(self.feishu_app_id), media, upload, expires_in=self.IMAGE_KEY_CACHE_SECONDS)
 
 
 
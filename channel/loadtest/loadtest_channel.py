@@ -0,0 +1,355 @@
+# encoding:utf-8
+"""
+压测渠道，按目标速率向ChatChannel发送合成或回放的消息，统计端到端延迟、吞吐和丢弃数
+消息经过与真实渠道相同的处理流程: 构造context、插件、模型调用、装饰和发送，send只记录不真正发出
+发送按预定时间开环进行，处理变慢时不会降低发送速率，排队的时间计入延迟
+发送结束后等待loadtest_drain_timeout秒，仍未处理完的消息计为丢弃，输出报告后退出进程
+"""
+
+import json
+import os
+import random
+import shutil
+import sys
+import threading
+import time
+import wave
+from collections import Counter
+
+from bridge.context import *
+from bridge.reply import Reply, ReplyType
+from channel.chat_channel import ChatChannel
+from channel.chat_message import ChatMessage
+from common.log import logger
+from common.tmp_dir import TmpDir
+from common.worker_pool import worker_pools
+from config import conf
+
+BOT_ID = "loadtest_bot"
+BOT_NAME = "bot"
+
+# 消息类型: single 私聊, group 群聊中未@机器人的消息, group_at 群聊@机器人, command 管理指令, voice 私聊语音, image 私聊图片
+KINDS = ["single", "group", "group_at", "command", "voice", "image"]
+DEFAULT_MIX = {"single": 40, "group": 10, "group_at": 25, "command": 5, "voice": 10, "image": 10}
+
+# 问题按权重1/(i+1)抽取，常见问题重复出现，与实际群聊接近
+QUESTIONS = [
+    "你好",
+    "怎么退款？",
+    "今天天气怎么样",
+    "帮我写一首关于秋天的诗",
+    "What can you do?",
+    "请用三句话介绍一下量子计算",
+    "推荐几本适合入门的编程书",
+    "把这句话翻译成英文：我们下周再聊",
+]
+QUESTION_WEIGHTS = [1 / (i + 1) for i in range(len(QUESTIONS))]
+COMMANDS = ["#help", "#id", "#reset"]
+
+# 1x1像素的png图片
+PNG_1X1 = bytes.fromhex(
+    "89504e470d0a1a0a0000000d49484452000000010000000108060000001f15c489"
+    "0000000d4944415478da63f8cfc0f01f0005000201c2a3a6b60000000049454e44ae426082"
+)
+
+
+class LoadTestMessage(ChatMessage):
+    def __init__(self, msg_id, kind, ctype, content, user_id, group_id=None, is_at=False, prepare_fn=None):
+        super().__init__(None)
+        self.msg_id = msg_id
+        self.kind = kind
+        self.create_time = int(time.time())
+        self.sent_at = None  # 交给渠道处理的时间，用于计算端到端延迟
+        self.replied = False
+        self.ctype = ctype
+        self.content = content
+        self.from_user_id = user_id
+        self.from_user_nickname = user_id
+        self.to_user_id = BOT_ID
+        self.to_user_nickname = BOT_NAME
+        self._prepare_fn = prepare_fn
+        if group_id:
+            self.is_group = True
+            self.is_at = is_at
+            self.other_user_id = group_id
+            self.other_user_nickname = group_id
+            self.actual_user_id = user_id
+            self.actual_user_nickname = user_id
+        else:
+            self.other_user_id = user_id
+            self.other_user_nickname = user_id
+
+
+class LoadStats:
+    """按消息类型统计发送、过滤、完成、失败的数量和延迟"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.send_end = None  # 最后一条消息发出的时间
+        self.last_done = None  # 最后一条消息处理完成的时间
+        self.sent = Counter()  # 发出的消息数，包括被过滤的
+        self.filtered = Counter()  # 构造context时被过滤，不需要回复的消息，如未@机器人的群消息
+        self.completed = Counter()
+        self.failed = Counter()
+        self.replies = Counter()
+        self.error_replies = Counter()
+        self.latencies = {kind: [] for kind in KINDS}  # 发出到处理完成
+        self.reply_latencies = {kind: [] for kind in KINDS}  # 发出到第一条回复
+        self.pending = {}  # msg_id -> 消息，已交给渠道但未处理完成
+
+    def on_sent(self, msg: LoadTestMessage, accepted):
+        with self.lock:
+            self.sent[msg.kind] += 1
+            if accepted:
+                self.pending[msg.msg_id] = msg
+            else:
+                self.filtered[msg.kind] += 1
+
+    def on_reply(self, msg: LoadTestMessage, reply: Reply):
+        now = time.perf_counter()
+        with self.lock:
+            self.replies[msg.kind] += 1
+            if reply.type == ReplyType.ERROR:
+                self.error_replies[msg.kind] += 1
+            if not msg.replied:
+                msg.replied = True
+                self.reply_latencies[msg.kind].append(now - msg.sent_at)
+
+    def on_done(self, msg: LoadTestMessage, success):
+        now = time.perf_counter()
+        with self.lock:
+            if self.pending.pop(msg.msg_id, None) is None:
+                return
+            self.last_done = now
+            if success:
+                self.completed[msg.kind] += 1
+                self.latencies[msg.kind].append(now - msg.sent_at)
+            else:
+                self.failed[msg.kind] += 1
+
+    def pending_count(self):
+        with self.lock:
+            return len(self.pending)
+
+    def report(self) -> dict:
+        with self.lock:
+            send_duration = (self.send_end or time.perf_counter()) - self.start
+            done_duration = (self.last_done or self.start) - self.start
+            dropped = Counter(msg.kind for msg in self.pending.values())
+            kinds = {}
+            for kind in KINDS:
+                if not self.sent[kind]:
+                    continue
+                kinds[kind] = {
+                    "sent": self.sent[kind],
+                    "filtered": self.filtered[kind],
+                    "completed": self.completed[kind],
+                    "failed": self.failed[kind],
+                    "dropped": dropped[kind],
+                    "replies": self.replies[kind],
+                    "error_replies": self.error_replies[kind],
+                    "latency_ms": _summary(self.latencies[kind]),
+                    "first_reply_ms": _summary(self.reply_latencies[kind]),
+                }
+            completed = sum(self.completed.values())
+            return {
+                "sent": sum(self.sent.values()),
+                "filtered": sum(self.filtered.values()),
+                "completed": completed,
+                "failed": sum(self.failed.values()),
+                "dropped": sum(dropped.values()),
+                "replies": sum(self.replies.values()),
+                "error_replies": sum(self.error_replies.values()),
+                "offered_rate": sum(self.sent.values()) / send_duration if send_duration > 0 else 0.0,
+                "throughput": completed / done_duration if done_duration > 0 else 0.0,
+                "latency_ms": _summary([t for kind in KINDS for t in self.latencies[kind]]),
+                "first_reply_ms": _summary([t for kind in KINDS for t in self.reply_latencies[kind]]),
+                "kinds": kinds,
+                "pools": [pool.stats() for pool in worker_pools()],
+            }
+
+
+def _summary(samples):
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))] * 1000
+    return {"p50": pick(0.5), "p90": pick(0.9), "p99": pick(0.99), "max": samples[-1] * 1000}
+
+
+def format_report(report: dict) -> str:
+    def latency(s):
+        return "p50={p50:.1f} p90={p90:.1f} p99={p99:.1f} max={max:.1f}".format(**s) if s else "-"
+
+    lines = [
+        "sent={sent} filtered={filtered} completed={completed} failed={failed} dropped={dropped} replies={replies} errors={error_replies}".format(**report),
+        "offered={:.1f} msg/s  throughput={:.1f} msg/s".format(report["offered_rate"], report["throughput"]),
+        "latency(ms)      {}".format(latency(report["latency_ms"])),
+        "first reply(ms)  {}".format(latency(report["first_reply_ms"])),
+    ]
+    for kind, s in report["kinds"].items():
+        lines.append(
+            "  {:<9} sent={} filtered={} completed={} failed={} dropped={}  latency(ms) {}".format(
+                kind, s["sent"], s["filtered"], s["completed"], s["failed"], s["dropped"], latency(s["latency_ms"])
+            )
+        )
+    for s in report["pools"]:
+        lines.append("  pool {name}: completed={completed} avg_wait={avg_wait_ms:.1f}ms max_wait={max_wait_ms:.1f}ms".format(**s))
+    return "\n".join(lines)
+
+
+class LoadTestChannel(ChatChannel):
+    NOT_SUPPORT_REPLYTYPE = []
+    SUPPORT_STREAM_REPLY = True
+
+    def __init__(self):
+        super().__init__()
+        self.name = BOT_NAME
+        self.user_id = BOT_ID
+        self.stats = None
+
+    def send(self, reply: Reply, context: Context):
+        if reply.type == ReplyType.STREAM:
+            for _ in reply.content:  # 读完模型的流式输出才算回复完成
+                pass
+        msg = context.get("msg")
+        if isinstance(msg, LoadTestMessage):
+            self.stats.on_reply(msg, reply)
+
+    def _success_callback(self, session_id, **kwargs):
+        super()._success_callback(session_id, **kwargs)
+        self._on_done(kwargs.get("context"), True)
+
+    def _fail_callback(self, session_id, exception, **kwargs):
+        super()._fail_callback(session_id, exception, **kwargs)
+        self._on_done(kwargs.get("context"), False)
+
+    def _on_done(self, context, success):
+        msg = context.get("msg") if context else None
+        if isinstance(msg, LoadTestMessage):
+            self.stats.on_done(msg, success)
+
+    def startup(self):
+        specs = self._load_specs()
+        self._prepare_media()
+        self.stats = LoadStats()
+        logger.info("[LoadTest] start, rate={}, duration={}s".format(conf().get("loadtest_rate", 20), conf().get("loadtest_duration", 60)))
+        stop = threading.Event()
+        threading.Thread(target=self._report_progress, args=(stop,), daemon=True).start()
+        msg_id = 0
+        for offset, spec in specs:
+            delay = self.stats.start + offset - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            msg_id += 1
+            self._dispatch(self._make_message(msg_id, spec))
+        self.stats.send_end = time.perf_counter()
+
+        deadline = time.perf_counter() + conf().get("loadtest_drain_timeout", 60)
+        while self.stats.pending_count() and time.perf_counter() < deadline:
+            time.sleep(0.1)
+        stop.set()
+        report = self.stats.report()
+        print(format_report(report))
+        report_file = conf().get("loadtest_report_file")
+        if report_file:
+            with open(report_file, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2, ensure_ascii=False)
+            logger.info("[LoadTest] report saved to {}".format(report_file))
+        sys.stdout.flush()
+        # 未处理完的消息已计为丢弃，不再等待线程池中的任务
+        os._exit(0)
+
+    def _dispatch(self, msg: LoadTestMessage):
+        msg.sent_at = time.perf_counter()
+        try:
+            context = self._compose_context(msg.ctype, msg.content, isgroup=msg.is_group, msg=msg)
+        except Exception as e:
+            logger.exception("[LoadTest] compose context failed: {}".format(e))
+            self.stats.on_sent(msg, True)
+            self.stats.on_done(msg, False)
+            return
+        self.stats.on_sent(msg, context is not None)
+        if context is not None:
+            self.produce(context)
+
+    def _report_progress(self, stop: threading.Event):
+        interval = conf().get("loadtest_report_interval", 10)
+        while interval > 0 and not stop.wait(interval):
+            report = self.stats.report()
+            logger.info(
+                "[LoadTest] sent={sent} completed={completed} failed={failed} pending={dropped} throughput={throughput:.1f}/s p99={p99:.1f}ms".format(
+                    p99=report["latency_ms"].get("p99", 0.0), **report
+                )
+            )
+
+    def _load_specs(self):
+        """返回按发送时间排列的 [(相对开始的秒数, 消息描述)]"""
+        rate = conf().get("loadtest_rate", 20)
+        replay_file = conf().get("loadtest_replay_file")
+        if replay_file:
+            specs = []
+            with open(replay_file, encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    spec = json.loads(line)
+                    if spec.get("kind") not in KINDS:
+                        raise ValueError("unknown loadtest message kind: {}".format(spec.get("kind")))
+                    specs.append((spec.get("offset", len(specs) / rate), spec))
+            specs.sort(key=lambda item: item[0])
+            logger.info("[LoadTest] replay {} messages from {}".format(len(specs), replay_file))
+            return specs
+        return list(self._synthesize(rate, conf().get("loadtest_duration", 60)))
+
+    def _synthesize(self, rate, duration):
+        rnd = random.Random(conf().get("loadtest_seed", 0))
+        mix = conf().get("loadtest_mix") or DEFAULT_MIX
+        kinds = [kind for kind in KINDS if mix.get(kind)]
+        weights = [mix[kind] for kind in kinds]
+        users = conf().get("loadtest_sessions", 1000)
+        groups = conf().get("loadtest_groups", 50)
+        poisson = conf().get("loadtest_poisson", True)
+        offset = 0.0
+        while offset < duration:
+            kind = rnd.choices(kinds, weights)[0]
+            spec = {"kind": kind, "user": "user_{}".format(rnd.randrange(users))}
+            if kind in ("group", "group_at"):
+                spec["group"] = "group_{}".format(rnd.randrange(groups))
+            if kind == "command":
+                spec["content"] = rnd.choice(COMMANDS)
+            elif kind not in ("voice", "image"):
+                spec["content"] = rnd.choices(QUESTIONS, QUESTION_WEIGHTS)[0]
+            yield offset, spec
+            # 泊松到达的间隔服从指数分布，否则匀速发送
+            offset += rnd.expovariate(rate) if poisson else 1 / rate
+
+    def _prepare_media(self):
+        self.voice_template = os.path.join(TmpDir().path(), "loadtest_voice.wav")
+        with wave.open(self.voice_template, "wb") as wav:  # 1秒静音
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(16000)
+            wav.writeframes(b"\x00\x00" * 16000)
+        self.image_path = os.path.join(TmpDir().path(), "loadtest_image.png")
+        with open(self.image_path, "wb") as f:
+            f.write(PNG_1X1)
+
+    def _make_message(self, msg_id, spec) -> LoadTestMessage:
+        kind = spec["kind"]
+        user = spec.get("user", "user_0")
+        content = spec.get("content", "")
+        prefix = (conf().get("single_chat_prefix") or [""])[0]
+        if kind == "voice":
+            # 语音处理完会删除文件，每条消息在prepare时复制一份，和真实渠道收到消息后再下载一致
+            path = os.path.join(TmpDir().path(), "loadtest_voice_{}.wav".format(msg_id))
+            return LoadTestMessage(msg_id, kind, ContextType.VOICE, path, user, prepare_fn=lambda: shutil.copyfile(self.voice_template, path))
+        if kind == "image":
+            return LoadTestMessage(msg_id, kind, ContextType.IMAGE, self.image_path, user)
+        if kind == "group":
+            return LoadTestMessage(msg_id, kind, ContextType.TEXT, content, user, group_id=spec.get("group", "group_0"))
+        if kind == "group_at":
+            return LoadTestMessage(msg_id, kind, ContextType.TEXT, "@{} {}".format(BOT_NAME, content), user, group_id=spec.get("group", "group_0"), is_at=True)
+        return LoadTestMessage(msg_id, kind, ContextType.TEXT, prefix + content, user)
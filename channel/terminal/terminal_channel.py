@@ -40,17 +40,11 @@ class TerminalChannel(ChatChannel):
             print("<IMAGE>")
             img.show()
         elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
-            import io
-
-            import requests
+            from common.media_cache import fetch_media
             from PIL import Image
 
             img_url = reply.content
-            pic_res = requests.get(img_url, stream=True)
-            image_storage = io.BytesIO()
-            for block in pic_res.iter_content(1024):
-                image_storage.write(block)
-            image_storage.seek(0)
+            image_storage = fetch_media(img_url).open()
             img = Image.open(image_storage)
             print(img_url)
             img.show()
@@ -0,0 +1,159 @@
+"""
+消息触发规则的预编译匹配器
+群白名单、前缀、关键词、昵称黑名单等规则在配置快照生成后编译一次:
+    精确名单使用集合，前缀使用字典树，关键词使用Aho-Corasick自动机，@提及的正则按名称缓存
+每条消息的匹配开销与名单长度无关
+"""
+
+import re
+import threading
+from functools import lru_cache
+
+from config import conf, subscribe
+
+
+class PrefixMatcher:
+    """与check_prefix语义一致：返回列表中第一个匹配的前缀，没有则返回None"""
+
+    def __init__(self, prefix_list):
+        self.root = {}
+        self.max_len = 0
+        self.empty = None  # 空前缀在列表中的位置，空前缀匹配任何内容
+        for index, prefix in enumerate(prefix_list or []):
+            if not isinstance(prefix, str):
+                continue
+            if prefix == "":
+                if self.empty is None:
+                    self.empty = index
+                continue
+            node = self.root
+            for ch in prefix:
+                node = node.setdefault(ch, {})
+            node.setdefault(None, (index, prefix))  # 重复前缀保留第一次出现的位置
+            self.max_len = max(self.max_len, len(prefix))
+
+    def match(self, content):
+        best = None
+        node = self.root
+        for ch in content[: self.max_len]:
+            node = node.get(ch)
+            if node is None:
+                break
+            hit = node.get(None)
+            if hit is not None and (best is None or hit[0] < best[0]):
+                best = hit
+        if self.empty is not None and (best is None or self.empty < best[0]):
+            return ""
+        return best[1] if best else None
+
+
+class KeywordMatcher:
+    """Aho-Corasick自动机，判断内容是否包含任一关键词"""
+
+    def __init__(self, keyword_list):
+        keywords = [k for k in (keyword_list or []) if isinstance(k, str)]
+        self.always = "" in keywords
+        self.goto = [{}]
+        self.output = [False]
+        for keyword in keywords:
+            state = 0
+            for ch in keyword:
+                nxt = self.goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[state][ch] = nxt
+                    self.goto.append({})
+                    self.output.append(False)
+                state = nxt
+            self.output[state] = True
+        self.empty = len(self.goto) == 1 and not self.always
+        # 广度优先计算失败指针，并合并失败链上的输出
+        self.fail = [0] * len(self.goto)
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for ch, nxt in self.goto[state].items():
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                f = self.goto[f].get(ch, 0)
+                self.fail[nxt] = f if f != nxt else 0
+                self.output[nxt] = self.output[nxt] or self.output[self.fail[nxt]]
+                queue.append(nxt)
+
+    def contains(self, content):
+        if self.always:
+            return True
+        if self.empty or not content:
+            return False
+        goto, fail, output = self.goto, self.fail, self.output
+        root = goto[0]
+        state = 0
+        for ch in content:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0) if state else root.get(ch, 0)
+            if output[state]:
+                return True
+        return False
+
+
+@lru_cache(maxsize=1024)
+def mention_pattern(name):
+    """@某人 后跟特殊空格或普通空格的正则，按名称缓存编译结果"""
+    return re.compile(f"@{re.escape(name)}(\u2005|\u0020)")
+
+
+def remove_mention(content, name):
+    if name is None or "@" not in content:
+        return content
+    return mention_pattern(name).sub("", content)
+
+
+class TriggerMatcher:
+    def __init__(self, config):
+        group_white_list = config.get("group_name_white_list") or []
+        self.group_white_names = frozenset(group_white_list)
+        self.all_group = "ALL_GROUP" in self.group_white_names
+        self.group_white_keywords = KeywordMatcher(config.get("group_name_keyword_white_list"))
+        one_session = config.get("group_chat_in_one_session") or []
+        self.one_session_names = frozenset(one_session)
+        self.all_group_one_session = "ALL_GROUP" in self.one_session_names
+        self.nick_name_black_list = frozenset(config.get("nick_name_black_list") or [])
+        self.group_chat_prefix = PrefixMatcher(config.get("group_chat_prefix"))
+        self.group_chat_keyword = KeywordMatcher(config.get("group_chat_keyword"))
+        self.single_chat_prefix = PrefixMatcher(config.get("single_chat_prefix", [""]))
+        self.image_create_prefix = PrefixMatcher(config.get("image_create_prefix", [""]))
+
+    def group_allowed(self, group_name):
+        if self.all_group or group_name in self.group_white_names:
+            return True
+        return group_name is not None and self.group_white_keywords.contains(group_name)
+
+    def group_in_one_session(self, group_name):
+        return self.all_group_one_session or group_name in self.one_session_names
+
+    def in_black_list(self, nick_name):
+        return bool(nick_name) and nick_name in self.nick_name_black_list
+
+
+_current = (None, None)  # (配置快照, 匹配器)，整体替换保证两者一致
+_lock = threading.Lock()
+
+
+def get_trigger_matcher() -> TriggerMatcher:
+    """返回当前配置快照对应的匹配器"""
+    config = conf()
+    source, matcher = _current
+    if source is config:
+        return matcher
+    return _rebuild(config)
+
+
+@subscribe
+def _rebuild(config):
+    # 配置快照不可修改，按快照身份缓存，配置替换时立即重建
+    global _current
+    with _lock:
+        if _current[0] is not config:
+            _current = (config, TriggerMatcher(config))
+        return _current[1]
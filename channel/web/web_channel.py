@@ -1,12 +1,15 @@
+import asyncio
 import sys
+import threading
 import time
 import web
 import json
-from queue import Queue
+from collections import deque
 from bridge.context import *
 from bridge.reply import Reply, ReplyType
 from channel.chat_channel import ChatChannel, check_prefix
 from channel.chat_message import ChatMessage
+from common.http_server import serve_wsgi, wait_disconnect
 from common.log import logger
 from common.singleton import singleton
 from config import conf
@@ -34,6 +37,7 @@ class WebMessage(ChatMessage):
 @singleton
 class WebChannel(ChatChannel):
     NOT_SUPPORT_REPLYTYPE = [ReplyType.VOICE]
+    SUPPORT_STREAM_REPLY = True
     _instance = None
     
     # def __new__(cls):
@@ -43,7 +47,10 @@ class WebChannel(ChatChannel):
 
     def __init__(self):
         super().__init__()
-        self.message_queues = {}  # 为每个用户存储一个消息队列
+        self.message_queues = {}  # 为每个用户存储一个待推送的消息队列
+        self.sse_events = {}  # user_id -> 该用户所有SSE连接的asyncio.Event，有新消息时唤醒
+        self.sse_lock = threading.Lock()
+        self.sse_loop = None
         self.msg_id_counter = 0  # 添加消息ID计数器
 
     def _generate_msg_id(self):
@@ -53,6 +60,17 @@ class WebChannel(ChatChannel):
 
     def send(self, reply: Reply, context: Context):
         try:
+            if reply.type == ReplyType.STREAM:
+                # 同一条流式回复的片段使用相同的stream_id，由页面追加到同一个消息框中
+                stream_id = self._generate_msg_id()
+                for segment in reply.content:
+                    self._put_message(context["receiver"], {
+                        "type": str(ReplyType.TEXT),
+                        "content": segment,
+                        "stream_id": stream_id,
+                        "timestamp": time.time()
+                    })
+                return
             if reply.type == ReplyType.IMAGE:
                 from PIL import Image
 
@@ -62,17 +80,11 @@ class WebChannel(ChatChannel):
                 print("<IMAGE>")
                 img.show()
             elif reply.type == ReplyType.IMAGE_URL:
-                import io
-
-                import requests
+                from common.media_cache import fetch_media
                 from PIL import Image
 
                 img_url = reply.content
-                pic_res = requests.get(img_url, stream=True)
-                image_storage = io.BytesIO()
-                for block in pic_res.iter_content(1024):
-                    image_storage.write(block)
-                image_storage.seek(0)
+                image_storage = fetch_media(img_url).open()
                 img = Image.open(image_storage)
                 print(img_url)
                 img.show()
@@ -82,55 +94,75 @@ class WebChannel(ChatChannel):
             # 获取用户ID，如果没有则使用默认值
             # user_id = getattr(context.get("session", None), "session_id", "default_user")
             user_id = context["receiver"]
-            # 确保用户有对应的消息队列
-            if user_id not in self.message_queues:
-                self.message_queues[user_id] = Queue()
-                
             # 将消息放入对应用户的队列
             message_data = {
                 "type": str(reply.type),
                 "content": reply.content,
                 "timestamp": time.time()
             }
-            self.message_queues[user_id].put(message_data)
-            logger.debug(f"Message queued for user {user_id}")
+            self._put_message(user_id, message_data)
             
         except Exception as e:
             logger.error(f"Error in send method: {e}")
             raise
 
-    def sse_handler(self, user_id):
+    def _put_message(self, user_id, message_data):
+        # 可能在任意线程调用，消息入队后通知事件循环唤醒该用户的SSE连接
+        with self.sse_lock:
+            if user_id not in self.message_queues:
+                self.message_queues[user_id] = deque(maxlen=conf().get("web_sse_max_pending", 1000))
+            self.message_queues[user_id].append(message_data)
+            events = list(self.sse_events.get(user_id, ()))
+        for event in events:
+            self.sse_loop.call_soon_threadsafe(event.set)
+        logger.debug(f"Message queued for user {user_id}")
+
+    async def sse_handler(self, request, user_id):
         """
         Handle Server-Sent Events (SSE) for real-time communication.
+        在事件循环中运行，有新消息时立即推送，空闲时才发送心跳，客户端断开后清理该用户的队列
         """
-        web.header('Content-Type', 'text/event-stream')
-        web.header('Cache-Control', 'no-cache')
-        web.header('Connection', 'keep-alive')
-        
-        # 确保用户有消息队列
-        if user_id not in self.message_queues:
-            self.message_queues[user_id] = Queue()
-        
-        try:    
-            while True:
-                try:
-                    # 发送心跳
-                    yield f": heartbeat\n\n"
-                    
-                    # 非阻塞方式获取消息
-                    if not self.message_queues[user_id].empty():
-                        message = self.message_queues[user_id].get_nowait()
-                        yield f"data: {json.dumps(message)}\n\n"
-                    time.sleep(0.5)
-                except Exception as e:
-                    logger.error(f"SSE Error: {e}")
-                    break
+        self.sse_loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        with self.sse_lock:
+            queue = self.message_queues.setdefault(user_id, deque(maxlen=conf().get("web_sse_max_pending", 1000)))
+            self.sse_events.setdefault(user_id, set()).add(event)
+        writer = request.writer
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\nConnection: keep-alive\r\n\r\n: heartbeat\n\n")
+        disconnected = asyncio.ensure_future(wait_disconnect(request))
+        heartbeat = conf().get("web_sse_heartbeat", 15)
+        try:
+            while not disconnected.done():
+                event.clear()  # 先清除再取消息，避免取完后到达的消息丢失唤醒
+                with self.sse_lock:
+                    messages = list(queue)
+                    queue.clear()
+                if messages:
+                    writer.write("".join(f"data: {json.dumps(message)}\n\n" for message in messages).encode("utf-8"))
+                else:
+                    woken = asyncio.ensure_future(event.wait())
+                    await asyncio.wait({woken, disconnected}, timeout=heartbeat, return_when=asyncio.FIRST_COMPLETED)
+                    if woken.done() or disconnected.done():
+                        woken.cancel()
+                        continue
+                    woken.cancel()
+                    writer.write(b": heartbeat\n\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        except Exception as e:
+            logger.error(f"SSE Error: {e}")
         finally:
-            # 清理资源
-            if user_id in self.message_queues:
-                # 只有当队列为空时才删除
-                if self.message_queues[user_id].empty():
-                    del self.message_queues[user_id]
+            disconnected.cancel()
+            with self.sse_lock:
+                events = self.sse_events.get(user_id)
+                if events is not None:
+                    events.discard(event)
+                    if not events:
+                        del self.sse_events[user_id]
+                # 没有其他连接且没有未推送的消息时删除队列
+                if user_id not in self.sse_events and not self.message_queues.get(user_id):
+                    self.message_queues.pop(user_id, None)
 
     def post_message(self):
         """
@@ -180,18 +212,13 @@ class WebChannel(ChatChannel):
         print("\nWeb Channel is running, please visit http://localhost:9899/chat")
         
         urls = (
-            '/sse/(.+)', 'SSEHandler',  # 修改路由以接收用户ID
             '/message', 'MessageHandler',
             '/chat', 'ChatHandler', 
         )
         port = conf().get("web_port", 9899)
         app = web.application(urls, globals(), autoreload=False)
-        web.httpserver.runsimple(app.wsgifunc(), ("0.0.0.0", port))
-
-
-class SSEHandler:
-    def GET(self, user_id):
-        return WebChannel().sse_handler(user_id)
+        # SSE长连接在事件循环中处理，其余请求由线程池中的web.py应用处理
+        serve_wsgi(app.wsgifunc(), port, stream_routes=[("/sse/(.+)", self.sse_handler)])
 
 
 class MessageHandler:
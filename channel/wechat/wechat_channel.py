@@ -9,18 +9,18 @@ import json
 import os
 import threading
 import time
-import requests
 
 from bridge.context import *
 from bridge.reply import *
 from channel.chat_channel import ChatChannel
-from channel import chat_channel
 from channel.wechat.wechat_message import *
 from common.expired_dict import ExpiredDict
 from common.log import logger
+from common.media_cache import fetch_media
 from common.singleton import singleton
 from common.time_check import time_checker
 from common.utils import convert_webp_to_png, remove_markdown_symbol
+from common.worker_pool import worker_pools
 from config import conf, get_appdata_dir
 from lib import itchat
 from lib.itchat.content import *
@@ -155,7 +155,8 @@ class WechatChannel(ChatChannel):
                 time.sleep(2)
                 self.auto_login_times += 1
                 if self.auto_login_times < 100:
-                    chat_channel.handler_pool._shutdown = False
+                    for pool in worker_pools():
+                        pool.executor._shutdown = False
                     self.startup()
         except Exception as e:
             pass
@@ -236,14 +237,9 @@ class WechatChannel(ChatChannel):
         elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
             img_url = reply.content
             logger.debug(f"[WX] start download image, img_url={img_url}")
-            pic_res = requests.get(img_url, stream=True)
-            image_storage = io.BytesIO()
-            size = 0
-            for block in pic_res.iter_content(1024):
-                size += len(block)
-                image_storage.write(block)
-            logger.info(f"[WX] download image success, size={size}, img_url={img_url}")
-            image_storage.seek(0)
+            media = fetch_media(img_url)
+            image_storage = media.open()
+            logger.info(f"[WX] download image success, size={media.size}, img_url={img_url}")
             if ".webp" in img_url:
                 try:
                     image_storage = convert_webp_to_png(image_storage)
@@ -268,14 +264,9 @@ class WechatChannel(ChatChannel):
         elif reply.type == ReplyType.VIDEO_URL:  # 新增视频URL回复类型
             video_url = reply.content
             logger.debug(f"[WX] start download video, video_url={video_url}")
-            video_res = requests.get(video_url, stream=True)
-            video_storage = io.BytesIO()
-            size = 0
-            for block in video_res.iter_content(1024):
-                size += len(block)
-                video_storage.write(block)
-            logger.info(f"[WX] download video success, size={size}, video_url={video_url}")
-            video_storage.seek(0)
+            media = fetch_media(video_url)
+            video_storage = media.open()
+            logger.info(f"[WX] download video success, size={media.size}, video_url={video_url}")
             itchat.send_video(video_storage, toUserName=receiver)
             logger.info("[WX] sendVideo url={}, receiver={}".format(video_url, receiver))
 
@@ -20,6 +20,7 @@ from channel.chat_channel import ChatChannel
 from channel.wechat.wechaty_message import WechatyMessage
 from common.log import logger
 from common.singleton import singleton
+from common.worker_pool import DEFAULT_HANDLER_POOLS, get_handler_pool
 from config import conf
 
 try:
@@ -44,7 +45,8 @@ class WechatyChannel(ChatChannel):
     async def main(self):
         loop = asyncio.get_event_loop()
         # 将asyncio的loop传入处理线程
-        self.handler_pool._initializer = lambda: asyncio.set_event_loop(loop)
+        for pool_name in DEFAULT_HANDLER_POOLS:
+            get_handler_pool(pool_name).executor._initializer = lambda: asyncio.set_event_loop(loop)
         self.bot = Wechaty()
         self.bot.on("login", self.on_login)
         self.bot.on("message", self.on_message)
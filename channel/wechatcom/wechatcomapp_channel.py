@@ -1,9 +1,7 @@
 # -*- coding=utf-8 -*-
-import io
 import os
 import time
 
-import requests
 import web
 from wechatpy.enterprise import create_reply, parse_message
 from wechatpy.enterprise.crypto import WeChatCrypto
@@ -15,7 +13,9 @@ from bridge.reply import Reply, ReplyType
 from channel.chat_channel import ChatChannel
 from channel.wechatcom.wechatcomapp_client import WechatComAppClient
 from channel.wechatcom.wechatcomapp_message import WechatComAppMessage
+from common.http_server import serve_wsgi
 from common.log import logger
+from common.media_cache import cached_upload, fetch_media
 from common.singleton import singleton
 from common.utils import compress_imgfile, fsize, split_string_by_utf8_length, convert_webp_to_png, remove_markdown_symbol
 from config import conf, subscribe_msg
@@ -41,13 +41,14 @@ class WechatComAppChannel(ChatChannel):
         )
         self.crypto = WeChatCrypto(self.token, self.aes_key, self.corp_id)
         self.client = WechatComAppClient(self.corp_id, self.secret)
+        self.media_namespace = "wechatcom:{}:{}".format(self.corp_id, self.agent_id)  # 临时素材media_id的缓存空间
 
     def startup(self):
         # start message listener
         urls = ("/wxcomapp/?", "channel.wechatcom.wechatcomapp_channel.Query")
         app = web.application(urls, globals(), autoreload=False)
         port = conf().get("wechatcomapp_port", 9898)
-        web.httpserver.runsimple(app.wsgifunc(), ("0.0.0.0", port))
+        serve_wsgi(app.wsgifunc(), port)
 
     def send(self, reply: Reply, context: Context):
         receiver = context["receiver"]
@@ -89,30 +90,33 @@ class WechatComAppChannel(ChatChannel):
             logger.info("[wechatcom] sendVoice={}, receiver={}".format(reply.content, receiver))
         elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
             img_url = reply.content
-            pic_res = requests.get(img_url, stream=True)
-            image_storage = io.BytesIO()
-            for block in pic_res.iter_content(1024):
-                image_storage.write(block)
-            sz = fsize(image_storage)
-            if sz >= 10 * 1024 * 1024:
-                logger.info("[wechatcom] image too large, ready to compress, sz={}".format(sz))
-                image_storage = compress_imgfile(image_storage, 10 * 1024 * 1024 - 1)
-                logger.info("[wechatcom] image compressed, sz={}".format(fsize(image_storage)))
-            image_storage.seek(0)
-            if ".webp" in img_url:
-                try:
+            media = fetch_media(img_url)
+
+            def upload_image():
+                # 压缩和格式转换只在上传时进行，相同内容的图片复用上传结果
+                image_storage = media.open()
+                sz = fsize(image_storage)
+                if sz >= 10 * 1024 * 1024:
+                    logger.info("[wechatcom] image too large, ready to compress, sz={}".format(sz))
+                    image_storage = compress_imgfile(image_storage, 10 * 1024 * 1024 - 1)
+                    logger.info("[wechatcom] image compressed, sz={}".format(fsize(image_storage)))
+                image_storage.seek(0)
+                if ".webp" in img_url:
                     image_storage = convert_webp_to_png(image_storage)
-                except Exception as e:
-                    logger.error(f"Failed to convert image: {e}")
-                    return
-            try:
                 response = self.client.media.upload("image", image_storage)
                 logger.debug("[wechatcom] upload image response: {}".format(response))
+                return response["media_id"]
+
+            try:
+                media_id = cached_upload(self.media_namespace, media, upload_image)
             except WeChatClientException as e:
                 logger.error("[wechatcom] upload image failed: {}".format(e))
                 return
+            except Exception as e:
+                logger.error(f"Failed to convert image: {e}")
+                return
 
-            self.client.message.send_image(self.agent_id, receiver, response["media_id"])
+            self.client.message.send_image(self.agent_id, receiver, media_id)
             logger.info("[wechatcom] sendImage url={}, receiver={}".format(img_url, receiver))
         elif reply.type == ReplyType.IMAGE:  # 从文件读取图片
             image_storage = reply.content
@@ -50,7 +50,7 @@ class Query:
                 # New request
                 if (
                     channel.cache_dict.get(from_user) is None
-                    and from_user not in channel.running
+                    and not channel.is_running(from_user)
                     or content.startswith("#")
                     and message_id not in channel.request_cnt  # insert the godcmd
                 ):
@@ -62,7 +62,7 @@ class Query:
                     logger.debug("[wechatmp] context: {} {} {}".format(context, wechatmp_msg, supported))
 
                     if supported and context:
-                        channel.running.add(from_user)
+                        channel.start_running(from_user, message_id)
                         channel.produce(context)
                     else:
                         trigger_prefix = conf().get("single_chat_prefix", [""])[0]
@@ -92,6 +92,7 @@ class Query:
 
                 # Wechat official server will request 3 times (5 seconds each), with the same message_id.
                 # Because the interval is 5 seconds, here assumed that do not have multithreading problems.
+                # request_cnt expires after REQUEST_CNT_SECONDS so that message ids never fetched again are dropped.
                 request_cnt = channel.request_cnt.get(message_id, 0) + 1
                 channel.request_cnt[message_id] = request_cnt
                 logger.info(
@@ -100,21 +101,19 @@ class Query:
                     )
                 )
 
-                task_running = True
-                waiting_until = request_time + 4
-                while time.time() < waiting_until:
-                    if from_user in channel.running:
-                        time.sleep(0.1)
-                    else:
-                        task_running = False
-                        break
+                # the send path sets the event as soon as the reply is cached, so wake up immediately instead of polling
+                done = channel.get_running(from_user, message_id)
+                task_running = done is not None and not done.wait(max(0, request_time + 4 - time.time()))
 
                 reply_text = ""
+                if task_running and request_cnt < 3 and done.wait(max(0, request_time + 5 - time.time())):
+                    # the reply finished before Wechat official server closes the request, return it in this request
+                    task_running = False
                 if task_running:
                     if request_cnt < 3:
-                        # waiting for timeout (the POST request will be closed by Wechat official server)
-                        time.sleep(2)
-                        # and do nothing, waiting for the next request
+                        # keep the request open past the 5 seconds timeout so that Wechat official server will retry,
+                        # returning "success" before that would be taken as the final answer
+                        time.sleep(max(0, request_time + 6 - time.time()))
                         return "success"
                     else:  # request_cnt == 3:
                         # return timeout message
@@ -123,19 +122,20 @@ class Query:
                         return encrypt_func(replyPost.render())
 
                 # reply is ready
-                channel.request_cnt.pop(message_id)
+                channel.request_cnt.pop(message_id, None)
 
                 # no return because of bandwords or other reasons
-                if from_user not in channel.cache_dict and from_user not in channel.running:
+                if from_user not in channel.cache_dict and not channel.is_running(from_user):
                     return "success"
 
                 # Only one request can access to the cached data
-                try:
-                    (reply_type, reply_content) = channel.cache_dict[from_user].pop(0)
-                    if not channel.cache_dict[from_user]:  # If popping the message makes the list empty, delete the user entry from cache
-                        del channel.cache_dict[from_user]
-                except IndexError:
-                    return "success"
+                with channel.cache_lock:
+                    replies = channel.cache_dict.get(from_user)
+                    if not replies:
+                        return "success"
+                    (reply_type, reply_content) = replies.pop(0)
+                    if not replies:  # If popping the message makes the list empty, delete the user entry from cache
+                        channel.cache_dict.pop(from_user, None)
 
                 if reply_type == "text":
                     if len(reply_content.encode("utf8")) <= MAX_UTF8_LEN:
@@ -148,7 +148,7 @@ class Query:
                             max_split=1,
                         )
                         reply_text = splits[0] + continue_text
-                        channel.cache_dict[from_user].append(("text", splits[1]))
+                        channel.cache_reply(from_user, ("text", splits[1]))
 
                     logger.info(
                         "[wechatmp] Request {} do send to {} {}: {}\n{}".format(
@@ -1,23 +1,23 @@
 # -*- coding: utf-8 -*-
 import asyncio
 import imghdr
-import io
 import os
 import threading
 import time
 
-import requests
 import web
 from wechatpy.crypto import WeChatCrypto
 from wechatpy.exceptions import WeChatClientException
-from collections import defaultdict
 
 from bridge.context import *
 from bridge.reply import *
 from channel.chat_channel import ChatChannel
 from channel.wechatmp.common import *
 from channel.wechatmp.wechatmp_client import WechatMPClient
+from common.expired_dict import ExpiredDict
+from common.http_server import serve_wsgi
 from common.log import logger
+from common.media_cache import cached_upload, fetch_media
 from common.singleton import singleton
 from common.utils import split_string_by_utf8_length, remove_markdown_symbol
 from config import conf
@@ -33,25 +33,36 @@ from voice.audio_convert import any_to_mp3, split_audio
 
 @singleton
 class WechatMPChannel(ChatChannel):
+    REPLY_CACHE_SECONDS = 3600  # 未取走的回复的保存时间
+    REQUEST_CNT_SECONDS = 60  # 微信对同一消息最多重试3次，每次5秒
+    RUNNING_SECONDS = 600  # 处理中消息的记录时间，任务丢失时过期后用户可以重新提问
+    MAX_TRACKED_USERS = 10000
+
     def __init__(self, passive_reply=True):
         super().__init__()
         self.passive_reply = passive_reply
         self.NOT_SUPPORT_REPLYTYPE = []
+        # 被动回复只能回复一次，主动回复模式可以逐段发送
+        self.SUPPORT_STREAM_REPLY = not passive_reply
         appid = conf().get("wechatmp_app_id")
         secret = conf().get("wechatmp_app_secret")
         token = conf().get("wechatmp_token")
         aes_key = conf().get("wechatmp_aes_key")
         self.client = WechatMPClient(appid, secret)
+        self.media_namespace = "wechatmp:{}".format(appid)  # 临时素材media_id的缓存空间
         self.crypto = None
         if aes_key:
             self.crypto = WeChatCrypto(token, aes_key, appid)
         if self.passive_reply:
-            # Cache the reply to the user's first message
-            self.cache_dict = defaultdict(list)
-            # Record whether the current message is being processed
-            self.running = set()
+            # Cache the reply to the user's first message, user -> [(reply_type, reply_content)]
+            self.cache_dict = ExpiredDict(self.REPLY_CACHE_SECONDS, maxsize=self.MAX_TRACKED_USERS)
+            self.cache_lock = threading.Lock()
+            # Messages being processed, message_id -> threading.Event set when the reply is ready
+            self.running = ExpiredDict(self.RUNNING_SECONDS, maxsize=self.MAX_TRACKED_USERS)
+            # The query a user's follow-up requests wait for, user -> message_id
+            self.running_users = ExpiredDict(self.RUNNING_SECONDS, maxsize=self.MAX_TRACKED_USERS)
             # Count the request from wechat official server by message_id
-            self.request_cnt = dict()
+            self.request_cnt = ExpiredDict(self.REQUEST_CNT_SECONDS, maxsize=self.MAX_TRACKED_USERS)
             # The permanent media need to be deleted to avoid media number limit
             self.delete_media_loop = asyncio.new_event_loop()
             t = threading.Thread(target=self.start_loop, args=(self.delete_media_loop,))
@@ -65,7 +76,7 @@ class WechatMPChannel(ChatChannel):
             urls = ("/wx", "channel.wechatmp.active_reply.Query")
         app = web.application(urls, globals(), autoreload=False)
         port = conf().get("wechatmp_port", 8080)
-        web.httpserver.runsimple(app.wsgifunc(), ("0.0.0.0", port))
+        serve_wsgi(app.wsgifunc(), port)
 
     def start_loop(self, loop):
         asyncio.set_event_loop(loop)
@@ -83,7 +94,7 @@ class WechatMPChannel(ChatChannel):
             if reply.type == ReplyType.TEXT or reply.type == ReplyType.INFO or reply.type == ReplyType.ERROR:
                 reply_text = remove_markdown_symbol(reply.content)
                 logger.info("[wechatmp] text cached, receiver {}\n{}".format(receiver, reply_text))
-                self.cache_dict[receiver].append(("text", reply_text))
+                self.cache_reply(receiver, ("text", reply_text))
             elif reply.type == ReplyType.VOICE:
                 voice_file_path = reply.content
                 duration, files = split_audio(voice_file_path, 60 * 1000)
@@ -104,15 +115,11 @@ class WechatMPChannel(ChatChannel):
                         return
                     media_id = response["media_id"]
                     logger.info("[wechatmp] voice uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                    self.cache_dict[receiver].append(("voice", media_id))
+                    self.cache_reply(receiver, ("voice", media_id))
 
             elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
                 img_url = reply.content
-                pic_res = requests.get(img_url, stream=True)
-                image_storage = io.BytesIO()
-                for block in pic_res.iter_content(1024):
-                    image_storage.write(block)
-                image_storage.seek(0)
+                image_storage = fetch_media(img_url).open()
                 image_type = imghdr.what(image_storage)
                 filename = receiver + "-" + str(context["msg"].msg_id) + "." + image_type
                 content_type = "image/" + image_type
@@ -124,7 +131,7 @@ class WechatMPChannel(ChatChannel):
                     return
                 media_id = response["media_id"]
                 logger.info("[wechatmp] image uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                self.cache_dict[receiver].append(("image", media_id))
+                self.cache_reply(receiver, ("image", media_id))
             elif reply.type == ReplyType.IMAGE:  # 从文件读取图片
                 image_storage = reply.content
                 image_storage.seek(0)
@@ -139,14 +146,10 @@ class WechatMPChannel(ChatChannel):
                     return
                 media_id = response["media_id"]
                 logger.info("[wechatmp] image uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                self.cache_dict[receiver].append(("image", media_id))
+                self.cache_reply(receiver, ("image", media_id))
             elif reply.type == ReplyType.VIDEO_URL:  # 从网络下载视频
                 video_url = reply.content
-                video_res = requests.get(video_url, stream=True)
-                video_storage = io.BytesIO()
-                for block in video_res.iter_content(1024):
-                    video_storage.write(block)
-                video_storage.seek(0)
+                video_storage = fetch_media(video_url).open()
                 video_type = 'mp4'
                 filename = receiver + "-" + str(context["msg"].msg_id) + "." + video_type
                 content_type = "video/" + video_type
@@ -158,7 +161,7 @@ class WechatMPChannel(ChatChannel):
                     return
                 media_id = response["media_id"]
                 logger.info("[wechatmp] video uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                self.cache_dict[receiver].append(("video", media_id))
+                self.cache_reply(receiver, ("video", media_id))
 
             elif reply.type == ReplyType.VIDEO:  # 从文件读取视频
                 video_storage = reply.content
@@ -174,10 +177,15 @@ class WechatMPChannel(ChatChannel):
                     return
                 media_id = response["media_id"]
                 logger.info("[wechatmp] video uploaded, receiver {}, media_id {}".format(receiver, media_id))
-                self.cache_dict[receiver].append(("video", media_id))
+                self.cache_reply(receiver, ("video", media_id))
 
         else:
-            if reply.type == ReplyType.TEXT or reply.type == ReplyType.INFO or reply.type == ReplyType.ERROR:
+            if reply.type == ReplyType.STREAM:
+                for segment in reply.content:
+                    for text in split_string_by_utf8_length(segment, MAX_UTF8_LEN):
+                        self.client.message.send_text(receiver, text)
+                logger.info("[wechatmp] Do send stream text to {}".format(receiver))
+            elif reply.type == ReplyType.TEXT or reply.type == ReplyType.INFO or reply.type == ReplyType.ERROR:
                 reply_text = reply.content
                 texts = split_string_by_utf8_length(reply_text, MAX_UTF8_LEN)
                 if len(texts) > 1:
@@ -228,21 +236,23 @@ class WechatMPChannel(ChatChannel):
                 logger.info("[wechatmp] Do send voice to {}".format(receiver))
             elif reply.type == ReplyType.IMAGE_URL:  # 从网络下载图片
                 img_url = reply.content
-                pic_res = requests.get(img_url, stream=True)
-                image_storage = io.BytesIO()
-                for block in pic_res.iter_content(1024):
-                    image_storage.write(block)
-                image_storage.seek(0)
-                image_type = imghdr.what(image_storage)
-                filename = receiver + "-" + str(context["msg"].msg_id) + "." + image_type
-                content_type = "image/" + image_type
-                try:
+                media = fetch_media(img_url)
+
+                def upload_image():
+                    image_storage = media.open()
+                    image_type = imghdr.what(image_storage)
+                    filename = receiver + "-" + str(context["msg"].msg_id) + "." + image_type
+                    content_type = "image/" + image_type
                     response = self.client.media.upload("image", (filename, image_storage, content_type))
                     logger.debug("[wechatmp] upload image response: {}".format(response))
+                    return response["media_id"]
+
+                try:
+                    media_id = cached_upload(self.media_namespace, media, upload_image)
                 except WeChatClientException as e:
                     logger.error("[wechatmp] upload image failed: {}".format(e))
                     return
-                self.client.message.send_image(receiver, response["media_id"])
+                self.client.message.send_image(receiver, media_id)
                 logger.info("[wechatmp] Do send image to {}".format(receiver))
             elif reply.type == ReplyType.IMAGE:  # 从文件读取图片
                 image_storage = reply.content
@@ -260,21 +270,22 @@ class WechatMPChannel(ChatChannel):
                 logger.info("[wechatmp] Do send image to {}".format(receiver))
             elif reply.type == ReplyType.VIDEO_URL:  # 从网络下载视频
                 video_url = reply.content
-                video_res = requests.get(video_url, stream=True)
-                video_storage = io.BytesIO()
-                for block in video_res.iter_content(1024):
-                    video_storage.write(block)
-                video_storage.seek(0)
-                video_type = 'mp4'
-                filename = receiver + "-" + str(context["msg"].msg_id) + "." + video_type
-                content_type = "video/" + video_type
-                try:
-                    response = self.client.media.upload("video", (filename, video_storage, content_type))
+                media = fetch_media(video_url)
+
+                def upload_video():
+                    video_type = 'mp4'
+                    filename = receiver + "-" + str(context["msg"].msg_id) + "." + video_type
+                    content_type = "video/" + video_type
+                    response = self.client.media.upload("video", (filename, media.open(), content_type))
                     logger.debug("[wechatmp] upload video response: {}".format(response))
+                    return response["media_id"]
+
+                try:
+                    media_id = cached_upload(self.media_namespace, media, upload_video)
                 except WeChatClientException as e:
                     logger.error("[wechatmp] upload video failed: {}".format(e))
                     return
-                self.client.message.send_video(receiver, response["media_id"])
+                self.client.message.send_video(receiver, media_id)
                 logger.info("[wechatmp] Do send video to {}".format(receiver))
             elif reply.type == ReplyType.VIDEO:  # 从文件读取视频
                 video_storage = reply.content
@@ -292,13 +303,68 @@ class WechatMPChannel(ChatChannel):
                 logger.info("[wechatmp] Do send video to {}".format(receiver))
         return
 
-    def _success_callback(self, session_id, context, **kwargs):  # 线程异常结束时的回调函数
+    def cache_reply(self, receiver, item):
+        """缓存被动回复的内容，等待微信服务器的请求取走"""
+        with self.cache_lock:
+            replies = self.cache_dict.get(receiver)
+            if replies is None:
+                replies = []
+                self.cache_dict[receiver] = replies
+            replies.append(item)
+
+    def start_running(self, session_id, message_id):
+        """记录开始处理的消息，插入的管理指令使用自己的记录，不替换用户正在等待的提问"""
+        self.running[message_id] = threading.Event()
+        if self.running_users.get(session_id) not in self.running:
+            self.running_users[session_id] = message_id
+
+    def is_running(self, session_id):
+        return self.running_users.get(session_id) in self.running
+
+    def get_running(self, session_id, message_id):
+        """返回请求需要等待的事件，微信重试同一消息时等待该消息，用户发送新消息时等待正在处理的提问"""
+        done = self.running.get(message_id)
+        if done is None:
+            done = self.running.get(self.running_users.get(session_id))
+        return done
+
+    def _finish_running(self, session_id, context):
+        # 唤醒正在等待该消息回复的请求
+        message_id = context["msg"].msg_id
+        done = self.running.pop(message_id, None)
+        if done is not None:
+            done.set()
+        if self.running_users.get(session_id) == message_id:
+            self.running_users.pop(session_id, None)
+
+    def _success_callback(self, session_id, context, **kwargs):  # 线程正常结束时的回调函数
         logger.debug("[wechatmp] Success to generate reply, msgId={}".format(context["msg"].msg_id))
         if self.passive_reply:
-            self.running.remove(session_id)
+            self._finish_running(session_id, context)
 
     def _fail_callback(self, session_id, exception, context, **kwargs):  # 线程异常结束时的回调函数
         logger.exception("[wechatmp] Fail to generate reply to user, msgId={}, exception={}".format(context["msg"].msg_id, exception))
         if self.passive_reply:
-            assert session_id not in self.cache_dict
-            self.running.remove(session_id)
+            self._finish_running(session_id, context)
+
+    def _cancel_callback(self, session_id, context, **kwargs):  # 任务被取消时的回调函数
+        logger.info("[wechatmp] Generate reply cancelled, msgId={}".format(context["msg"].msg_id))
+        if self.passive_reply:
+            self._finish_running(session_id, context)
+
+    def cancel_session(self, session_id):
+        # 排队中被丢弃的消息不会触发回调，取消后同样唤醒等待它们的请求
+        with self.lock:
+            queued = list(self.sessions[session_id][0].queue) if session_id in self.sessions else []
+            super().cancel_session(session_id)
+        if self.passive_reply:
+            for context in queued:
+                self._finish_running(session_id, context)
+
+    def cancel_all_session(self):
+        with self.lock:
+            queued = [(session_id, context) for session_id, (queue, _) in self.sessions.items() for context in list(queue.queue)]
+            super().cancel_all_session()
+        if self.passive_reply:
+            for session_id, context in queued:
+                self._finish_running(session_id, context)
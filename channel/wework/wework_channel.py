@@ -1,11 +1,9 @@
-import io
 import os
 import random
 import tempfile
 import threading
 os.environ['ntwork_LOG'] = "ERROR"
 import ntwork
-import requests
 import uuid
 
 from bridge.context import *
@@ -15,12 +13,12 @@ from channel.wework.wework_message import *
 from channel.wework.wework_message import WeworkMessage
 from common.singleton import singleton
 from common.log import logger
+from common.media_cache import MediaTooLarge, fetch_media
 from common.time_check import time_checker
 from common.utils import compress_imgfile, fsize
 from config import conf
 from channel.wework.run import wework
 from channel.wework import run
-from PIL import Image
 
 
 def get_wxid_by_name(room_members, group_wxid, name):
@@ -39,10 +37,7 @@ def download_and_compress_image(url, filename, quality=30):
         os.makedirs(directory)
 
     # 下载图片
-    pic_res = requests.get(url, stream=True)
-    image_storage = io.BytesIO()
-    for block in pic_res.iter_content(1024):
-        image_storage.write(block)
+    image_storage = fetch_media(url).open()
 
     # 检查图片大小并可能进行压缩
     sz = fsize(image_storage)
@@ -55,6 +50,8 @@ def download_and_compress_image(url, filename, quality=30):
     image_storage.seek(0)
 
     # 读取并保存图片
+    from PIL import Image
+
     image = Image.open(image_storage)
     image_path = os.path.join(directory, f"{filename}.png")
     image.save(image_path, "png")
@@ -69,23 +66,16 @@ def download_video(url, filename):
     if not os.path.exists(directory):
         os.makedirs(directory)
 
-    # 下载视频
-    response = requests.get(url, stream=True)
-    total_size = 0
+    # 下载视频，如果视频的总大小超过30MB (30 * 1024 * 1024 bytes)，则停止下载并返回
+    try:
+        media = fetch_media(url, max_size=30 * 1024 * 1024)
+    except MediaTooLarge:
+        logger.info("[WX] Video is larger than 30MB, skipping...")
+        return None
 
     video_path = os.path.join(directory, f"{filename}.mp4")
-
-    with open(video_path, 'wb') as f:
-        for block in response.iter_content(1024):
-            total_size += len(block)
-
-            # 如果视频的总大小超过30MB (30 * 1024 * 1024 bytes)，则停止下载并返回
-            if total_size > 30 * 1024 * 1024:
-                logger.info("[WX] Video is larger than 30MB, skipping...")
-                return None
-
-            f.write(block)
-
+    with open(video_path, "wb") as f:
+        f.write(media.read())
     return video_path
 
 
@@ -3,7 +3,6 @@ import json
 import os
 import re
 import time
-import pilk
 
 from bridge.context import ContextType
 from channel.chat_message import ChatMessage
@@ -93,6 +92,8 @@ def c2c_download_and_convert(wework, message, file_name):
     # 在下载完SILK文件之后，立即将其转换为WAV文件
     base_name, _ = os.path.splitext(save_path)
     wav_file = base_name + ".wav"
+    import pilk
+
     pilk.silk_to_wav(save_path, wav_file, rate=24000)
 
     # 删除SILK文件
@@ -1,22 +1,50 @@
-from datetime import datetime, timedelta
+import threading
+import time
+import weakref
+from collections import OrderedDict
 
 
-class ExpiredDict(dict):
-    def __init__(self, expires_in_seconds):
+class ExpiredDict(OrderedDict):
+    """
+    带过期时间的字典，读写都会刷新过期时间
+    按最近访问顺序保存，最早过期的key总在最前面，清理过期key的均摊复杂度为O(1)
+    :param expires_in_seconds: 过期时间
+    :param maxsize: 最多保存的key数量，超过时淘汰最久未访问的key，0表示不限制
+    """
+
+    sweep_interval = 60  # 后台清理线程的运行间隔，单位秒
+    _instances = []  # 所有实例的弱引用，供后台清理线程遍历
+    _sweeper = None
+    _sweeper_lock = threading.Lock()
+
+    def __init__(self, expires_in_seconds, maxsize=0):
         super().__init__()
         self.expires_in_seconds = expires_in_seconds
+        self.maxsize = maxsize
+        self.lock = threading.RLock()
+        self._start_sweeper(self)
 
     def __getitem__(self, key):
-        value, expiry_time = super().__getitem__(key)
-        if datetime.now() > expiry_time:
-            del self[key]
-            raise KeyError("expired {}".format(key))
-        self.__setitem__(key, value)
-        return value
+        with self.lock:
+            value, expiry_time = OrderedDict.__getitem__(self, key)
+            now = time.monotonic()
+            if now > expiry_time:
+                OrderedDict.__delitem__(self, key)
+                raise KeyError("expired {}".format(key))
+            OrderedDict.__setitem__(self, key, (value, now + self.expires_in_seconds))
+            self.move_to_end(key)
+            return value
 
     def __setitem__(self, key, value):
-        expiry_time = datetime.now() + timedelta(seconds=self.expires_in_seconds)
-        super().__setitem__(key, (value, expiry_time))
+        with self.lock:
+            now = time.monotonic()
+            OrderedDict.__setitem__(self, key, (value, now + self.expires_in_seconds))
+            self.move_to_end(key)
+            self._evict(now)
+
+    def __delitem__(self, key):
+        with self.lock:
+            OrderedDict.__delitem__(self, key)
 
     def get(self, key, default=None):
         try:
@@ -31,12 +59,80 @@ class ExpiredDict(dict):
         except KeyError:
             return False
 
+    def pop(self, key, *default):
+        with self.lock:
+            try:
+                value = self[key]
+            except KeyError:
+                if default:
+                    return default[0]
+                raise
+            OrderedDict.__delitem__(self, key)
+            return value
+
     def keys(self):
-        keys = list(super().keys())
-        return [key for key in keys if key in self]
+        with self.lock:
+            self._evict(time.monotonic())
+            return list(OrderedDict.keys(self))
+
+    def values(self):
+        with self.lock:
+            self._evict(time.monotonic())
+            return [value for value, _ in OrderedDict.values(self)]
 
     def items(self):
-        return [(key, self[key]) for key in self.keys()]
+        with self.lock:
+            self._evict(time.monotonic())
+            return [(key, value) for key, (value, _) in OrderedDict.items(self)]
 
     def __iter__(self):
         return self.keys().__iter__()
+
+    def __len__(self):
+        with self.lock:
+            self._evict(time.monotonic())
+            return OrderedDict.__len__(self)
+
+    def clear(self):
+        with self.lock:
+            OrderedDict.clear(self)
+
+    def sweep(self):
+        """清理所有已过期的key"""
+        with self.lock:
+            self._evict(time.monotonic())
+
+    def _evict(self, now):
+        # 从最久未访问的key开始检查，遇到未过期的key即可停止
+        while OrderedDict.__len__(self) > 0:
+            key = next(OrderedDict.__iter__(self))
+            if OrderedDict.__getitem__(self, key)[1] >= now:
+                break
+            OrderedDict.__delitem__(self, key)
+        if self.maxsize:
+            while OrderedDict.__len__(self) > self.maxsize:
+                OrderedDict.__delitem__(self, next(OrderedDict.__iter__(self)))
+
+    @classmethod
+    def _start_sweeper(cls, instance):
+        with cls._sweeper_lock:
+            cls._instances.append(weakref.ref(instance))
+        if cls._sweeper is not None:
+            return
+        with cls._sweeper_lock:
+            if cls._sweeper is None:
+                cls._sweeper = threading.Thread(target=cls._sweep_loop, name="expired-dict-sweeper")
+                cls._sweeper.setDaemon(True)
+                cls._sweeper.start()
+
+    @classmethod
+    def _sweep_loop(cls):
+        while True:
+            time.sleep(cls.sweep_interval)
+            with cls._sweeper_lock:
+                cls._instances = [ref for ref in cls._instances if ref() is not None]
+                refs = list(cls._instances)
+            for ref in refs:
+                instance = ref()
+                if instance is not None:
+                    instance.sweep()
@@ -0,0 +1,127 @@
+"""
+共享的HTTP客户端，按host复用requests.Session及其连接池，避免每次请求都重新建立TCP和TLS连接
+用法与requests一致: http_client.get(url, ...) / http_client.post(url, ...)
+requests在第一次请求时才导入，只导入本模块的插件和渠道不会拖慢启动
+"""
+
+import http.cookiejar
+import threading
+from urllib.parse import urlsplit
+
+from common.log import logger
+from config import conf
+
+_sessions = {}  # host -> requests.Session
+_sessions_lock = threading.Lock()
+
+
+def _build_retry():
+    from urllib3.util.retry import Retry
+
+    kwargs = {
+        "total": conf().get("http_max_retries", 2),
+        "connect": conf().get("http_max_retries", 2),
+        "backoff_factor": conf().get("http_retry_backoff", 0.5),
+        "status_forcelist": [502, 503, 504],
+        "raise_on_status": False,
+    }
+    # 默认只重试幂等请求，避免模型调用等POST请求被重复提交
+    methods = frozenset(m.upper() for m in conf().get("http_retry_methods", ["GET", "HEAD", "OPTIONS"]))
+    try:
+        return Retry(allowed_methods=methods, **kwargs)
+    except TypeError:  # urllib3<1.26
+        return Retry(method_whitelist=methods, **kwargs)
+
+
+def _create_session() -> "requests.Session":
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    # Session按host在所有用户、机器人和api key之间共享，只复用连接，不保存服务端下发的cookie
+    session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=conf().get("http_pool_maxsize", 20),
+        max_retries=_build_retry(),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session(url: str) -> "requests.Session":
+    """返回url所在host的共享Session，不同host使用独立的连接池"""
+    parts = urlsplit(url)
+    host = "{}://{}".format(parts.scheme, parts.netloc)
+    session = _sessions.get(host)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(host)
+            if session is None:
+                session = _create_session()
+                _sessions[host] = session
+                logger.debug("[HTTP] create session for {}".format(host))
+    return session
+
+
+def request(method, url, **kwargs) -> "requests.Response":
+    """同requests.request，未指定timeout时使用配置的默认超时"""
+    if "timeout" not in kwargs:
+        kwargs["timeout"] = (conf().get("http_connect_timeout", 10), conf().get("http_read_timeout", 300))
+    return get_session(url).request(method, url, **kwargs)
+
+
+def get(url, params=None, **kwargs) -> "requests.Response":
+    return request("GET", url, params=params, **kwargs)
+
+
+def post(url, data=None, json=None, **kwargs) -> "requests.Response":
+    return request("POST", url, data=data, json=json, **kwargs)
+
+
+def put(url, data=None, **kwargs) -> "requests.Response":
+    return request("PUT", url, data=data, **kwargs)
+
+
+def delete(url, **kwargs) -> "requests.Response":
+    return request("DELETE", url, **kwargs)
+
+
+def stats() -> list:
+    """
+    各host连接池的统计信息
+    requests: 发出的请求数, connections: 新建的连接数, reuse_ratio: 连接复用率, idle: 池中空闲的连接数
+    """
+    result = []
+    with _sessions_lock:
+        sessions = list(_sessions.items())
+    for host, session in sessions:
+        adapter = session.get_adapter(host)
+        num_requests, num_connections, idle = 0, 0, 0
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            num_requests += pool.num_requests
+            num_connections += pool.num_connections
+            if pool.pool is not None:
+                idle += sum(1 for conn in list(pool.pool.queue) if conn is not None and conn.sock is not None)
+        result.append(
+            {
+                "host": host,
+                "requests": num_requests,
+                "connections": num_connections,
+                "reuse_ratio": 1 - num_connections / num_requests if num_requests else 0.0,
+                "idle": idle,
+            }
+        )
+    return result
+
+
+def format_http_stats() -> str:
+    lines = []
+    for s in stats():
+        lines.append("{host}: 请求 {requests}, 新建连接 {connections}, 复用率 {reuse_ratio:.0%}, 空闲连接 {idle}".format(**s))
+    return "\n".join(lines) if lines else "暂无HTTP连接"
@@ -0,0 +1,338 @@
+"""
+webhook渠道共用的HTTP服务，按配置http_server选择后端:
+    simple: web.py自带的开发服务器
+    threaded: cheroot线程池服务，可配置线程数、连接数和keep-alive
+    async: 基于asyncio的HTTP/1.1服务，普通请求交给WSGI应用在线程池中处理，
+           流式接口(如SSE)直接在事件循环中以协程处理，长连接不占用线程
+收到SIGTERM时通过shutdown_all停止接收新请求，并等待处理中的请求完成
+"""
+
+import asyncio
+import io
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+
+from common.log import logger
+from config import conf
+
+_servers = []  # 运行中的服务，退出时统一停止
+
+
+class HTTPRequest:
+    def __init__(self, method, path, query, version, headers, body, reader, writer):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.version = version
+        self.headers = headers  # header名均为小写
+        self.body = body
+        self.reader = reader
+        self.writer = writer
+
+
+class AsyncWSGIServer:
+    """
+    :param wsgi_app: WSGI应用
+    :param stream_routes: [(路径正则, 协程函数)]，匹配的请求由 handler(request, *groups) 直接处理，处理结束后关闭连接
+    :param max_workers: 执行WSGI应用的线程数
+    :param max_connections: 最大并发连接数，超过时直接返回503
+    """
+
+    def __init__(
+        self,
+        wsgi_app,
+        host="0.0.0.0",
+        port=8080,
+        stream_routes=None,
+        max_workers=16,
+        max_connections=1000,
+        keepalive_timeout=75,
+        max_body_size=10 * 1024 * 1024,
+    ):
+        self.wsgi_app = wsgi_app
+        self.host = host
+        self.port = port
+        self.stream_routes = [(re.compile(pattern), handler) for pattern, handler in (stream_routes or [])]
+        self.max_workers = max_workers
+        self.max_connections = max_connections
+        self.keepalive_timeout = keepalive_timeout
+        self.max_body_size = max_body_size
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="http")
+        self.loop = None
+        self.server = None
+        self.started = threading.Event()
+        self.stopped = threading.Event()
+        self.draining = False
+        self.connections = set()  # 所有连接的处理任务
+        self.inflight = 0  # 正在由WSGI应用处理的请求数
+
+    def serve_forever(self):
+        """在后台线程运行事件循环，当前线程阻塞直到服务停止，以便信号处理函数能在当前线程调用shutdown"""
+        thread = threading.Thread(target=self._run_loop, name="http-loop")
+        thread.setDaemon(True)
+        thread.start()
+        self.started.wait()
+        self.stopped.wait()
+
+    def _run_loop(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.server = self.loop.run_until_complete(
+                asyncio.start_server(self._handle_connection, self.host, self.port, backlog=min(self.max_connections, 4096))
+            )
+        except Exception:
+            self.started.set()
+            self.stopped.set()
+            raise
+        logger.info("[HTTPServer] async server listening on {}:{}, max_workers={}".format(self.host, self.port, self.max_workers))
+        self.started.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.executor.shutdown(wait=False)
+            self.stopped.set()
+
+    def shutdown(self, timeout=10):
+        """停止接收新连接，空闲和流式连接立即关闭，等待处理中的请求最多timeout秒"""
+        if self.loop is None or self.stopped.is_set():
+            return
+        self.draining = True
+        self.loop.call_soon_threadsafe(self._close_idle)
+        deadline = time.monotonic() + timeout
+        while self.inflight > 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        if self.inflight > 0:
+            logger.warning("[HTTPServer] {} requests still running after {}s, force stop".format(self.inflight, timeout))
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.stopped.wait(1)
+
+    def _close_idle(self):
+        self.server.close()
+        for task in list(self.connections):
+            if not getattr(task, "busy", False):
+                task.cancel()
+
+    async def _handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        if len(self.connections) >= self.max_connections or self.draining:
+            await self._write_response(writer, "503 Service Unavailable", [], b"", False)
+            writer.close()
+            return
+        self.connections.add(task)
+        try:
+            while not self.draining:
+                request = await self._read_request(reader, writer)
+                if request is None:
+                    break
+                for pattern, handler in self.stream_routes:
+                    m = pattern.fullmatch(request.path)
+                    if m:
+                        await handler(request, *m.groups())
+                        return
+                keep_alive = self._keep_alive(request)
+                task.busy = True
+                self.inflight += 1
+                try:
+                    status, headers, body = await self.loop.run_in_executor(self.executor, self._call_wsgi, request)
+                finally:
+                    self.inflight -= 1
+                await self._write_response(writer, status, headers, body, keep_alive and not self.draining)
+                task.busy = False
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        except Exception as e:
+            logger.exception("[HTTPServer] connection error: {}".format(e))
+        finally:
+            self.connections.discard(task)
+            writer.close()
+
+    async def _read_request(self, reader, writer):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.keepalive_timeout)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            return None
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, version = lines[0].split(" ", 2)
+        except ValueError:
+            await self._write_response(writer, "400 Bad Request", [], b"", False)
+            return None
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            body = await self._read_chunked(reader)
+        else:
+            length = int(headers.get("content-length") or 0)
+            if length > self.max_body_size:
+                await self._write_response(writer, "413 Payload Too Large", [], b"", False)
+                return None
+            body = await reader.readexactly(length) if length else b""
+        path, _, query = target.partition("?")
+        return HTTPRequest(method.upper(), unquote(path), query, version, headers, body, reader, writer)
+
+    async def _read_chunked(self, reader):
+        chunks = []
+        size = 0
+        while True:
+            line = await reader.readline()
+            length = int(line.split(b";")[0].strip() or b"0", 16)
+            if length == 0:
+                await reader.readuntil(b"\r\n")  # 忽略trailer
+                break
+            size += length
+            if size > self.max_body_size:
+                raise ConnectionError("request body too large")
+            chunks.append(await reader.readexactly(length))
+            await reader.readexactly(2)
+        return b"".join(chunks)
+
+    @staticmethod
+    def _keep_alive(request):
+        connection = request.headers.get("connection", "").lower()
+        if request.version == "HTTP/1.1":
+            return connection != "close"
+        return connection == "keep-alive"
+
+    def _call_wsgi(self, request):
+        environ = {
+            "REQUEST_METHOD": request.method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": request.path,
+            "QUERY_STRING": request.query,
+            "SERVER_NAME": self.host,
+            "SERVER_PORT": str(self.port),
+            "SERVER_PROTOCOL": request.version,
+            "REMOTE_ADDR": (request.writer.get_extra_info("peername") or ("", 0))[0],
+            "CONTENT_TYPE": request.headers.get("content-type", ""),
+            "CONTENT_LENGTH": str(len(request.body)),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": io.BytesIO(request.body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for name, value in request.headers.items():
+            if name not in ("content-type", "content-length"):
+                environ["HTTP_" + name.upper().replace("-", "_")] = value
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response["status"] = status
+            response["headers"] = headers
+
+        try:
+            result = self.wsgi_app(environ, start_response)
+            try:
+                body = b"".join(part.encode("utf-8") if isinstance(part, str) else part for part in result)
+            finally:
+                if hasattr(result, "close"):
+                    result.close()
+        except Exception as e:
+            logger.exception("[HTTPServer] wsgi app error: {}".format(e))
+            return "500 Internal Server Error", [], b""
+        return response.get("status", "500 Internal Server Error"), response.get("headers", []), body
+
+    async def _write_response(self, writer, status, headers, body, keep_alive):
+        lines = ["HTTP/1.1 " + status]
+        for name, value in headers:
+            if name.lower() not in ("content-length", "connection", "transfer-encoding"):
+                lines.append("{}: {}".format(name, value))
+        lines.append("Content-Length: {}".format(len(body)))
+        lines.append("Connection: {}".format("keep-alive" if keep_alive else "close"))
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+
+class ThreadedWSGIServer:
+    """cheroot线程池服务，web.py的runsimple也基于cheroot，但线程数等参数不可配置"""
+
+    def __init__(self, wsgi_app, host="0.0.0.0", port=8080, max_workers=32, max_connections=1000, keepalive_timeout=75):
+        from cheroot import wsgi
+
+        self.server = wsgi.Server(
+            (host, port),
+            wsgi_app,
+            numthreads=max_workers,
+            request_queue_size=min(max_connections, 4096),
+            timeout=keepalive_timeout,
+            server_name="localhost",
+        )
+        self.server.nodelay = True
+        self.host = host
+        self.port = port
+        self.max_workers = max_workers
+
+    def serve_forever(self):
+        logger.info("[HTTPServer] threaded server listening on {}:{}, max_workers={}".format(self.host, self.port, self.max_workers))
+        try:
+            self.server.start()
+        except (KeyboardInterrupt, SystemExit):
+            self.server.stop()
+            raise
+
+    def shutdown(self, timeout=10):
+        # cheroot在stop时会等待工作线程处理完当前请求，最多shutdown_timeout秒
+        self.server.shutdown_timeout = timeout
+        self.server.stop()
+
+
+def serve_wsgi(wsgi_app, port, host="0.0.0.0", stream_routes=None):
+    """
+    按配置的后端启动HTTP服务，阻塞直到服务停止
+    :param stream_routes: 流式路由，仅async后端支持，设置时总是使用async后端
+    """
+    backend = conf().get("http_server", "threaded")
+    if stream_routes and backend != "async":
+        logger.info("[HTTPServer] stream routes require async server, use async instead of {}".format(backend))
+        backend = "async"
+    options = {
+        "max_workers": conf().get("http_server_threads", 32),
+        "max_connections": conf().get("http_server_max_connections", 1000),
+        "keepalive_timeout": conf().get("http_server_keepalive_timeout", 75),
+    }
+    if backend == "simple":
+        import web
+
+        web.httpserver.runsimple(wsgi_app, (host, port))
+        return
+    if backend == "async":
+        server = AsyncWSGIServer(wsgi_app, host, port, stream_routes=stream_routes, **options)
+    else:
+        server = ThreadedWSGIServer(wsgi_app, host, port, **options)
+    _servers.append(server)
+    try:
+        server.serve_forever()
+    finally:
+        if server in _servers:
+            _servers.remove(server)
+
+
+def shutdown_all():
+    """停止所有服务，等待处理中的请求完成，用于收到退出信号时"""
+    timeout = conf().get("http_server_drain_timeout", 10)
+    for server in list(_servers):
+        logger.info("[HTTPServer] draining server on port {}, timeout={}s".format(server.port, timeout))
+        server.shutdown(timeout)
+        if server in _servers:
+            _servers.remove(server)
+
+
+async def wait_disconnect(request: HTTPRequest):
+    """等待客户端断开连接，用于流式接口及时释放资源"""
+    try:
+        while await request.reader.read(1024):
+            pass
+    except ConnectionError:
+        pass
@@ -2,7 +2,7 @@ from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
 from linkai import LinkAIClient, PushMsg
-from config import conf, pconf, plugin_config, available_setting, write_plugin_config
+from config import conf, pconf, plugin_config, available_setting, write_plugin_config, update_config
 from plugins import PluginManager
 import time
 
@@ -33,22 +33,25 @@ class ChatClient(LinkAIClient):
         if config.get("enabled") != "Y":
             return
 
-        local_config = conf()
+        # 远程配置项收集完毕后一次性替换，避免消息处理中读到部分更新的配置
+        changes = {}
         for key in config.keys():
             if key in available_setting and config.get(key) is not None:
-                local_config[key] = config.get(key)
+                changes[key] = config.get(key)
         # 语音配置
         reply_voice_mode = config.get("reply_voice_mode")
         if reply_voice_mode:
             if reply_voice_mode == "voice_reply_voice":
-                local_config["voice_reply_voice"] = True
-                local_config["always_reply_voice"] = False
+                changes["voice_reply_voice"] = True
+                changes["always_reply_voice"] = False
             elif reply_voice_mode == "always_reply_voice":
-                local_config["always_reply_voice"] = True
-                local_config["voice_reply_voice"] = True
+                changes["always_reply_voice"] = True
+                changes["voice_reply_voice"] = True
             elif reply_voice_mode == "no_reply_voice":
-                local_config["always_reply_voice"] = False
-                local_config["voice_reply_voice"] = False
+                changes["always_reply_voice"] = False
+                changes["voice_reply_voice"] = False
+        if changes:
+            update_config(changes)
 
         if config.get("admin_password"):
             if not pconf("Godcmd"):
@@ -0,0 +1,270 @@
+"""
+各渠道共用的媒体下载与缓存
+下载的图片、视频按内容的sha256保存在磁盘上，总大小超过上限时淘汰最久未使用的文件；
+URL到内容摘要的映射在内存中缓存，同一URL重复发送时不再下载，同时下载同一URL只会请求一次
+渠道上传后得到的媒体id(公众号media_id、飞书image_key等)按内容摘要缓存，重复发送时跳过上传
+"""
+
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from common import http_client
+from common.expired_dict import ExpiredDict
+from common.log import logger
+from config import conf, get_appdata_dir
+
+
+class MediaTooLarge(Exception):
+    pass
+
+
+class MediaFile:
+    def __init__(self, path, digest, size, content_type="", url=None, cache=None):
+        self.path = path
+        self.digest = digest
+        self.size = size
+        self.content_type = content_type
+        self.url = url
+        self.cache = cache
+
+    def read(self) -> bytes:
+        """读取文件内容，文件已被淘汰时重新获取"""
+        try:
+            with open(self.path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            if self.cache is None or self.url is None:
+                raise
+            logger.warning("[MediaCache] cached file removed, fetch again, url={}".format(self.url))
+            media = self.cache.fetch(self.url)
+            with open(media.path, "rb") as f:
+                return f.read()
+
+    def open(self) -> io.BytesIO:
+        """读取为BytesIO，供需要文件对象的发送接口使用"""
+        return io.BytesIO(self.read())
+
+
+class MediaCache:
+    """
+    :param directory: 缓存目录
+    :param max_bytes: 缓存文件总大小上限
+    :param chunk_size: 流式下载的块大小
+    :param url_ttl: URL到内容的映射保存时间，单位秒，从下载时开始计算，读取不会延长；响应的Cache-Control为no-store/no-cache时不复用，max-age更短时以max-age为准
+    :param max_urls: 最多保存的URL映射数量
+    """
+
+    LEASE_SECONDS = 60  # 刚返回给调用方的文件在这段时间内不淘汰，避免读取前被删除
+
+    def __init__(self, directory, max_bytes, chunk_size=256 * 1024, url_ttl=86400, max_urls=10000):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.url_ttl = url_ttl
+        self.max_urls = max_urls
+        self.urls = OrderedDict()  # url -> (digest, content_type, 过期时间)，按下载时间排序
+        self.files = OrderedDict()  # digest -> size，按最近使用排序
+        self.total = 0
+        self.leases = {}  # digest -> 租约到期时间
+        self.lock = threading.Lock()
+        self.downloading = {}  # url -> 该URL的下载锁
+        self.upload_ids = {}  # namespace -> ExpiredDict(digest -> media_id)
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    def fetch(self, url, max_size=0) -> MediaFile:
+        """
+        获取URL对应的媒体文件，缓存未命中时流式下载
+        :param max_size: 大小上限，超过时抛出MediaTooLarge，0表示不限制
+        """
+        media = self._lookup(url)
+        if media is None:
+            with self.lock:
+                url_lock = self.downloading.setdefault(url, threading.Lock())
+            with url_lock:
+                try:
+                    media = self._lookup(url)  # 等待期间其他线程可能已下载完成
+                    if media is None:
+                        media = self._download(url, max_size)
+                finally:
+                    with self.lock:
+                        self.downloading.pop(url, None)
+        if max_size and media.size > max_size:
+            raise MediaTooLarge("media size {} exceeds {}".format(media.size, max_size))
+        return media
+
+    def _lookup(self, url):
+        with self.lock:
+            item = self.urls.get(url)
+            if item is None:
+                return None
+            digest, content_type, expiry = item
+            if expiry <= time.monotonic():
+                del self.urls[url]
+                return None
+            size = self.files.get(digest)
+            if size is None:  # 文件已被淘汰
+                return None
+            self.files.move_to_end(digest)
+            self.leases[digest] = time.monotonic() + self.LEASE_SECONDS
+        return MediaFile(self._path(digest), digest, size, content_type, url, self)
+
+    def _download(self, url, max_size):
+        response = http_client.get(url, stream=True)
+        try:
+            response.raise_for_status()
+            content_type = response.headers.get("Content-Type", "")
+            url_ttl = self._url_ttl(response.headers)
+            sha256 = hashlib.sha256()
+            size = 0
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".part")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    for block in response.iter_content(self.chunk_size):
+                        size += len(block)
+                        if max_size and size > max_size:
+                            raise MediaTooLarge("media size exceeds {}".format(max_size))
+                        sha256.update(block)
+                        f.write(block)
+                digest = sha256.hexdigest()
+                path = self._path(digest)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)  # 内容相同的文件直接覆盖
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        finally:
+            response.close()
+        logger.debug("[MediaCache] downloaded url={}, size={}, digest={}".format(url, size, digest[:12]))
+        self._add(digest, size)
+        self._remember_url(url, digest, content_type, url_ttl)
+        return MediaFile(path, digest, size, content_type, url, self)
+
+    def _url_ttl(self, headers):
+        """按响应的Cache-Control确定URL映射的保存时间，0表示不复用"""
+        directives = [directive.strip().lower() for directive in headers.get("Cache-Control", "").split(",")]
+        if "no-store" in directives or "no-cache" in directives:
+            return 0
+        for directive in directives:
+            if directive.startswith("max-age="):
+                try:
+                    return min(self.url_ttl, int(directive[len("max-age=") :]))
+                except ValueError:
+                    break
+        return self.url_ttl
+
+    def _remember_url(self, url, digest, content_type, ttl):
+        now = time.monotonic()
+        with self.lock:
+            self.urls.pop(url, None)
+            if ttl > 0:
+                self.urls[url] = (digest, content_type, now + ttl)
+            # 从最早下载的映射开始清理已过期的，数量超过上限时淘汰最早下载的
+            while self.urls:
+                oldest = next(iter(self.urls))
+                if self.urls[oldest][2] > now and len(self.urls) <= self.max_urls:
+                    break
+                del self.urls[oldest]
+
+    def _add(self, digest, size):
+        evicted = []
+        with self.lock:
+            now = time.monotonic()
+            self.leases[digest] = now + self.LEASE_SECONDS
+            if digest in self.files:
+                self.files.move_to_end(digest)
+                return
+            self.files[digest] = size
+            self.total += size
+            self.leases = {d: expiry for d, expiry in self.leases.items() if expiry > now}
+            # 刚写入和刚返回给调用方的文件不淘汰，即使因此暂时超过上限
+            for old in list(self.files):
+                if self.total <= self.max_bytes:
+                    break
+                if old in self.leases:
+                    continue
+                self.total -= self.files.pop(old)
+                evicted.append(old)
+        for old in evicted:
+            try:
+                os.remove(self._path(old))
+            except OSError:
+                pass
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def _scan(self):
+        # 启动时按修改时间恢复已缓存的文件
+        entries = []
+        for sub in os.listdir(self.directory):
+            sub_dir = os.path.join(self.directory, sub)
+            if not os.path.isdir(sub_dir):
+                if sub.endswith(".part"):
+                    os.remove(sub_dir)
+                continue
+            for name in os.listdir(sub_dir):
+                stat = os.stat(os.path.join(sub_dir, name))
+                entries.append((stat.st_mtime, name, stat.st_size))
+        for _, digest, size in sorted(entries):
+            self._add(digest, size)
+
+    def get_upload_id(self, namespace, digest):
+        ids = self.upload_ids.get(namespace)
+        return ids.get(digest) if ids is not None else None
+
+    def set_upload_id(self, namespace, digest, media_id, expires_in):
+        with self.lock:
+            ids = self.upload_ids.get(namespace)
+            if ids is None:
+                ids = ExpiredDict(expires_in, maxsize=10000)
+                self.upload_ids[namespace] = ids
+        ids[digest] = media_id
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_media_cache() -> MediaCache:
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                directory = conf().get("media_cache_dir") or os.path.join(get_appdata_dir(), "media_cache")
+                _cache = MediaCache(
+                    directory,
+                    max_bytes=conf().get("media_cache_max_size", 200) * 1024 * 1024,
+                    chunk_size=conf().get("media_download_chunk_size", 256 * 1024),
+                    url_ttl=conf().get("media_cache_url_ttl", 86400),
+                )
+    return _cache
+
+
+def fetch_media(url, max_size=0) -> MediaFile:
+    """下载或从缓存获取媒体文件，参数同MediaCache.fetch"""
+    return get_media_cache().fetch(url, max_size)
+
+
+def cached_upload(namespace, media: MediaFile, upload, expires_in=None):
+    """
+    按内容摘要缓存渠道上传得到的媒体id
+    :param namespace: 渠道及账号，如 wechatcom:{corp_id}:{agent_id}
+    :param upload: 上传函数，返回媒体id，失败时返回None或抛出异常
+    :param expires_in: 媒体id的有效期，默认为media_id_cache_seconds
+    """
+    cache = get_media_cache()
+    media_id = cache.get_upload_id(namespace, media.digest)
+    if media_id:
+        logger.debug("[MediaCache] reuse uploaded media, namespace={}, media_id={}".format(namespace, media_id))
+        return media_id
+    media_id = upload()
+    if media_id:
+        cache.set_upload_id(namespace, media.digest, media_id, expires_in or conf().get("media_id_cache_seconds", 2 * 24 * 3600))
+    return media_id
@@ -0,0 +1,194 @@
+"""
+消息处理各阶段的耗时统计
+按 (阶段, 渠道, 机器人, 插件, 消息类型) 记录耗时直方图，可通过HTTP端口以Prometheus文本格式导出
+未开启时span返回共享的空对象，调用方只多一次函数调用
+"""
+
+import threading
+import time
+from bisect import bisect_left
+
+from common.log import logger
+from config import conf, subscribe
+
+METRIC_NAME = "cow_stage_duration_seconds"
+LABELS = ("stage", "channel", "bot", "plugin", "ctype")
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum", "count", "lock")
+
+    def __init__(self, bounds=DEFAULT_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # 最后一个为超过所有上界的计数
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.sum, self.count
+
+
+_histograms = {}  # 标签元组 -> Histogram
+_histograms_lock = threading.Lock()
+_enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def _get_histogram(key):
+    histogram = _histograms.get(key)
+    if histogram is None:
+        with _histograms_lock:
+            histogram = _histograms.get(key)
+            if histogram is None:
+                histogram = _histograms[key] = Histogram()
+    return histogram
+
+
+def observe(seconds, stage, channel="", bot="", plugin="", ctype=""):
+    # 消息类型在导出时才转为字符串，记录时直接以枚举值作为key
+    _get_histogram((stage, channel, bot, plugin, ctype)).observe(seconds)
+
+
+class Span:
+    __slots__ = ("key", "start")
+
+    def __init__(self, key):
+        self.key = key
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        histogram = _histograms.get(self.key) or _get_histogram(self.key)
+        histogram.observe(elapsed)
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+def span(stage, channel="", bot="", plugin="", ctype=""):
+    """
+    统计一段代码的耗时，用法: with metrics.span("send", channel, ctype=context.type): ...
+    """
+    if not _enabled:
+        return NULL_SPAN
+    return Span((stage, channel, bot, plugin, ctype))
+
+
+def reset():
+    with _histograms_lock:
+        _histograms.clear()
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _merge(histograms):
+    # 同一组标签可能对应多个key，例如渠道名为None与空字符串
+    counts, total, count = histograms[0].snapshot()
+    for histogram in histograms[1:]:
+        other_counts, other_total, other_count = histogram.snapshot()
+        counts = [a + b for a, b in zip(counts, other_counts)]
+        total += other_total
+        count += other_count
+    return counts, total, count
+
+
+def render() -> str:
+    """导出为Prometheus文本格式"""
+    lines = [
+        "# HELP {} Latency of message pipeline stages.".format(METRIC_NAME),
+        "# TYPE {} histogram".format(METRIC_NAME),
+    ]
+    with _histograms_lock:
+        items = list(_histograms.items())
+    merged = {}
+    for key, histogram in items:
+        labels = tuple(str(value) if value else "" for value in key)
+        merged.setdefault(labels, []).append(histogram)
+    for labels in sorted(merged):
+        counts, total, count = _merge(merged[labels])
+        label_str = ",".join('{}="{}"'.format(name, _escape(value)) for name, value in zip(LABELS, labels))
+        cumulative = 0
+        for bound, c in zip(DEFAULT_BUCKETS, counts):
+            cumulative += c
+            lines.append('{}_bucket{{{},le="{}"}} {}'.format(METRIC_NAME, label_str, bound, cumulative))
+        lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(METRIC_NAME, label_str, count))
+        lines.append("{}_sum{{{}}} {}".format(METRIC_NAME, label_str, total))
+        lines.append("{}_count{{{}}} {}".format(METRIC_NAME, label_str, count))
+    return "\n".join(lines) + "\n"
+
+
+_server = None
+
+
+def start_metrics_server():
+    """metrics_enabled开启且配置了metrics_port时，在后台线程提供 /metrics 接口"""
+    global _server
+    port = conf().get("metrics_port", 0)
+    if not _enabled or not port or _server is not None:
+        return None
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class _MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    try:
+        _server = ThreadingHTTPServer((conf().get("metrics_host", "0.0.0.0"), port), _MetricsHandler)
+    except OSError as e:
+        logger.error("[Metrics] start server on port {} failed: {}".format(port, e))
+        return None
+    _server.daemon_threads = True
+    thread = threading.Thread(target=_server.serve_forever, name="metrics-server")
+    thread.setDaemon(True)
+    thread.start()
+    logger.info("[Metrics] serving on port {}".format(port))
+    return _server
+
+
+@subscribe
+def _on_config(config):
+    global _enabled
+    _enabled = bool(config.get("metrics_enabled", False))
+
+
+_on_config(conf())
@@ -1,39 +1,204 @@
+"""
+令牌桶限流
+令牌数在每次获取时按经过的时间惰性补充，不需要后台线程；令牌不足时预约后续的令牌并返回需要等待的时间，
+等待方按预约顺序依次获得令牌
+RateLimiter按 全局 -> 机器人 -> 群 -> 用户 分层限流，每层可同时限制每分钟请求数和每分钟的提示词token数
+"""
+
 import threading
 import time
 
+from common.log import logger
+from config import conf, subscribe
+
 
 class TokenBucket:
     def __init__(self, tpm, timeout=None):
         self.capacity = int(tpm)  # 令牌桶容量
-        self.tokens = 0  # 初始令牌数为0
+        self.tokens = float(self.capacity)  # 初始为满桶
         self.rate = int(tpm) / 60  # 令牌每秒生成速率
-        self.timeout = timeout  # 等待令牌超时时间
-        self.cond = threading.Condition()  # 条件变量
-        self.is_running = True
-        # 开启令牌生成线程
-        threading.Thread(target=self._generate_tokens).start()
-
-    def _generate_tokens(self):
-        """生成令牌"""
-        while self.is_running:
-            with self.cond:
-                if self.tokens < self.capacity:
-                    self.tokens += 1
-                self.cond.notify()  # 通知获取令牌的线程
-            time.sleep(1 / self.rate)
-
-    def get_token(self):
-        """获取令牌"""
-        with self.cond:
-            while self.tokens <= 0:
-                flag = self.cond.wait(self.timeout)
-                if not flag:  # 超时
-                    return False
-            self.tokens -= 1
+        self.timeout = timeout  # 等待令牌超时时间，None表示一直等待
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, cost=1, max_wait=None):
+        """
+        预约令牌，返回需要等待的秒数，等待时间超过max_wait时不预约并返回None
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            cost = min(cost, self.capacity)  # 单次消耗超过容量时按满桶计算，避免永远无法获取
+            wait = max(0.0, (cost - self.tokens) / self.rate)
+            if max_wait is not None and wait > max_wait:
+                return None
+            self.tokens -= cost
+            return wait
+
+    def get_token(self, cost=1):
+        """获取令牌，令牌不足时等待，超时返回False"""
+        wait = self.reserve(cost, self.timeout)
+        if wait is None:
+            return False
+        if wait > 0:
+            time.sleep(wait)
         return True
 
     def close(self):
-        self.is_running = False
+        # 令牌惰性补充，没有需要停止的线程，保留接口兼容旧调用
+        pass
+
+
+LEVELS = ["global", "bot", "group", "user"]
+
+
+class RateLimiter:
+    """
+    分层限流器，每个限流维度按key保存 (剩余令牌, 上次补充时间)
+    key数量增长一倍时清理已补满的桶，补满的桶与不存在的桶等价，因此内存只与近期活跃的key数量有关
+    :param limits: {层级: (每分钟请求数, 每分钟token数)}，0表示不限制
+    """
+
+    def __init__(self, limits):
+        self.lock = threading.Lock()
+        self.rates = {}  # (层级, 维度) -> (容量, 每秒补充速率)
+        self.tables = {}  # (层级, 维度) -> {key: (剩余令牌, 上次补充时间)}
+        self.prune_at = {}  # (层级, 维度) -> 下次清理时的key数量
+        self.rejected = 0
+        self.configure(limits)
+
+    def configure(self, limits):
+        """更新限额，已有桶的状态保留"""
+        with self.lock:
+            rates = {}
+            for level, (rpm, tpm) in limits.items():
+                for dim, per_minute in (("rpm", rpm), ("tpm", tpm)):
+                    if per_minute and per_minute > 0:
+                        rates[(level, dim)] = (float(per_minute), per_minute / 60)
+                        self.tables.setdefault((level, dim), {})
+                        self.prune_at.setdefault((level, dim), 1024)
+            for name in list(self.tables):
+                if name not in rates:
+                    del self.tables[name]
+                    del self.prune_at[name]
+            self.rates = rates
+
+    @property
+    def enabled(self):
+        return bool(self.rates)
+
+    def reserve(self, scope, cost=0, max_wait=0):
+        """
+        在scope的所有层级上同时预约一次请求和cost个token，任一层级不足时按最长的等待时间一起等待
+        :param scope: [(层级, key)]，如 [("global", ""), ("user", user_id)]
+        :param cost: 估算的提示词token数
+        :return: 需要等待的秒数，超过max_wait时不预约并返回None
+        """
+        now = time.monotonic()
+        plan = []
+        wait = 0.0
+        with self.lock:
+            for level, key in scope:
+                for dim, amount in (("rpm", 1), ("tpm", cost)):
+                    spec = self.rates.get((level, dim))
+                    if spec is None or amount <= 0:
+                        continue
+                    capacity, rate = spec
+                    table = self.tables[(level, dim)]
+                    state = table.get(key)
+                    tokens = capacity if state is None else min(capacity, state[0] + (now - state[1]) * rate)
+                    amount = min(amount, capacity)
+                    if amount > tokens:
+                        wait = max(wait, (amount - tokens) / rate)
+                    plan.append((level, dim, table, key, tokens - amount))
+            if wait > max_wait:
+                self.rejected += 1
+                return None
+            for level, dim, table, key, tokens in plan:
+                table[key] = (tokens, now)
+                if len(table) > self.prune_at[(level, dim)]:
+                    self._prune((level, dim), now)
+        return wait
+
+    def _prune(self, name, now):
+        capacity, rate = self.rates[name]
+        table = self.tables[name]
+        for key in [k for k, (tokens, last) in table.items() if tokens + (now - last) * rate >= capacity]:
+            del table[key]
+        self.prune_at[name] = max(1024, len(table) * 2)
+
+
+def estimate_tokens(messages):
+    """
+    粗略估算消息的token数：非ASCII字符(主要是中文)按每字1个token，ASCII字符按每4个1个token
+    只用于限流，避免逐字统计或调用分词器
+    """
+    total = 0
+    for message in messages:
+        content = message.get("content") if isinstance(message, dict) else message
+        if not isinstance(content, str):
+            content = str(content)
+        chars = len(content)
+        # UTF-8下中文为3字节，多出的字节数除以2即为非ASCII字符数
+        non_ascii = (len(content.encode("utf-8")) - chars) // 2
+        total += non_ascii + (chars - non_ascii) // 4 + 1
+    return total
+
+
+def _limits_from_config(config):
+    return {level: (config.get("rate_limit_{}_rpm".format(level), 0), config.get("rate_limit_{}_tpm".format(level), 0)) for level in LEVELS}
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> RateLimiter:
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                _limiter = RateLimiter(_limits_from_config(conf()))
+    return _limiter
+
+
+@subscribe
+def _on_config(config):
+    if _limiter is not None:
+        _limiter.configure(_limits_from_config(config))
+
+
+def request_scope(bot_type, context):
+    """按消息上下文生成限流层级，群消息同时计入群和发送者"""
+    scope = [("global", ""), ("bot", bot_type)]
+    msg = context.get("msg")
+    if context.get("isgroup", False):
+        group_id = msg.other_user_id if msg is not None else context.get("receiver")
+        scope.append(("group", group_id))
+        user_id = msg.actual_user_id if msg is not None else context.get("session_id")
+    else:
+        user_id = msg.from_user_id if msg is not None else context.get("session_id")
+    scope.append(("user", user_id))
+    return scope
+
+
+def reserve_request(bot_type, context, messages):
+    """
+    为一次对话请求预约配额
+    :param messages: 本次请求会发给模型的消息，用于估算token数
+    :return: 需要等待的秒数，超过rate_limit_wait时返回None表示拒绝
+    """
+    limiter = get_rate_limiter()
+    if not limiter.enabled:
+        return 0
+    scope = request_scope(bot_type, context)
+    wait = limiter.reserve(scope, estimate_tokens(messages), conf().get("rate_limit_wait", 10))
+    if wait is None:
+        logger.warning("[RateLimiter] request rejected, scope={}".format(scope))
+    elif wait > 0:
+        logger.debug("[RateLimiter] wait {:.2f}s, scope={}".format(wait, scope))
+    return wait
 
 
 if __name__ == "__main__":
@@ -0,0 +1,164 @@
+"""
+各平台access_token的共享缓存，按平台和凭证区分
+在过期前由后台线程提前刷新，同一个token同时只会有一个线程去获取
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+from common.log import logger
+from config import conf, get_appdata_dir
+
+
+class TokenEntry:
+    def __init__(self, fetcher):
+        self.fetcher = fetcher  # 返回 (token, expires_in)，获取失败时token为None
+        self.token = None
+        self.expires_at = 0  # 使用time.time()，便于持久化后在重启时继续使用
+        self.refresh_at = 0
+        self.lock = threading.Lock()  # 同一个token只允许一个线程获取
+        self.refreshing = False
+
+    def valid(self, now):
+        return self.token is not None and now < self.expires_at
+
+
+class TokenCache:
+    refresh_check_interval = 30  # 后台刷新线程的检查间隔，单位秒
+
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.persist = conf().get("token_cache_persist", False)
+        self.path = os.path.join(get_appdata_dir(), "access_tokens.json")
+        self.persisted = self._load() if self.persist else {}
+        self.refresher = None
+
+    def get(self, provider: str, credentials, fetcher):
+        """
+        获取access_token，缓存不存在或已过期时同步获取
+        :param provider: 平台名称，如 baidu_wenxin、feishu
+        :param credentials: 区分token的凭证，如 (api_key, secret_key)，只以摘要形式保存
+        :param fetcher: 获取token的函数，返回 (token, expires_in)
+        :return: token，获取失败时返回None
+        """
+        key = self._key(provider, credentials)
+        entry = self.entries.get(key)
+        if entry is None:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is None:
+                    entry = TokenEntry(fetcher)
+                    self._restore(key, entry)
+                    self.entries[key] = entry
+                    self._start_refresher()
+        now = time.time()
+        if entry.valid(now):
+            return entry.token
+        with entry.lock:
+            if entry.valid(time.time()):  # 等待锁期间已被其他线程获取
+                return entry.token
+            self._fetch(key, entry)
+            return entry.token
+
+    def invalidate(self, provider: str, credentials):
+        """token被服务端拒绝时调用，下次get会重新获取"""
+        entry = self.entries.get(self._key(provider, credentials))
+        if entry is not None:
+            entry.expires_at = 0
+
+    def _fetch(self, key, entry):
+        try:
+            token, expires_in = entry.fetcher()
+        except Exception as e:
+            logger.error("[TokenCache] fetch token failed, provider={}, error={}".format(key.split(":")[0], e))
+            return
+        if not token:
+            return
+        now = time.time()
+        expires_in = int(expires_in or 0) or 3600
+        ahead = min(conf().get("token_refresh_ahead", 600), expires_in / 2)
+        entry.token = token
+        entry.expires_at = now + expires_in
+        entry.refresh_at = now + expires_in - ahead
+        logger.debug("[TokenCache] token refreshed, provider={}, expires_in={}".format(key.split(":")[0], expires_in))
+        if self.persist:
+            self._save()
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.refresh_check_interval)
+            now = time.time()
+            for key, entry in list(self.entries.items()):
+                if entry.token is None or now < entry.refresh_at:
+                    continue
+                if not entry.lock.acquire(blocking=False):  # 已有线程在获取
+                    continue
+                try:
+                    # 刷新失败时保留旧token直到过期
+                    self._fetch(key, entry)
+                finally:
+                    entry.lock.release()
+
+    def _start_refresher(self):
+        if self.refresher is None:
+            self.refresher = threading.Thread(target=self._refresh_loop, name="token-refresher")
+            self.refresher.setDaemon(True)
+            self.refresher.start()
+
+    @staticmethod
+    def _key(provider, credentials):
+        digest = hashlib.sha256(json.dumps(credentials, ensure_ascii=False).encode("utf-8")).hexdigest()[:16]
+        return "{}:{}".format(provider, digest)
+
+    def _restore(self, key, entry):
+        saved = self.persisted.get(key)
+        if saved and saved.get("expires_at", 0) > time.time():
+            entry.token = saved["token"]
+            entry.expires_at = saved["expires_at"]
+            entry.refresh_at = saved.get("refresh_at", entry.expires_at)
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.warning("[TokenCache] load {} failed: {}".format(self.path, e))
+            return {}
+
+    def _save(self):
+        with self.lock:
+            data = {k: {"token": e.token, "expires_at": e.expires_at, "refresh_at": e.refresh_at} for k, e in self.entries.items() if e.token}
+            try:
+                tmp_path = self.path + ".tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(data, f)
+                os.replace(tmp_path, self.path)
+            except Exception as e:
+                logger.warning("[TokenCache] save {} failed: {}".format(self.path, e))
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_access_token(provider: str, credentials, fetcher):
+    """
+    从共享缓存中获取access_token，参数同TokenCache.get
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = TokenCache()
+    return _cache.get(provider, credentials, fetcher)
+
+
+def invalidate_access_token(provider: str, credentials):
+    if _cache is not None:
+        _cache.invalidate(provider, credentials)
@@ -2,7 +2,6 @@ import io
 import os
 import re
 from urllib.parse import urlparse
-from PIL import Image
 from common.log import logger
 
 def fsize(file):
@@ -23,6 +22,7 @@ def fsize(file):
 def compress_imgfile(file, max_size):
     if fsize(file) <= max_size:
         return file
+    from PIL import Image
     file.seek(0)
     img = Image.open(file)
     rgb_image = img.convert("RGB")
@@ -76,3 +76,29 @@ def remove_markdown_symbol(text: str):
     if not text:
         return text
     return re.sub(r'\*\*(.*?)\*\*', r'\1', text)
+
+
+SENTENCE_END_PATTERN = re.compile(r"[。！？!?；;…\n]+|[.](?=\s)")
+
+
+def iter_sentences(chunks, min_length=10):
+    """
+    将流式输出的文本片段重新切分为句子级别的段落，每段在句末标点处结束且至少包含min_length个字符
+    :param chunks: 文本片段迭代器
+    :param min_length: 每段的最少字符数
+    """
+    buffer = ""
+    for chunk in chunks:
+        if not chunk:
+            continue
+        buffer += chunk
+        if len(buffer) < min_length:
+            continue
+        end = 0
+        for match in SENTENCE_END_PATTERN.finditer(buffer, min_length - 1 if min_length > 0 else 0):
+            end = match.end()
+        if end:
+            yield buffer[:end]
+            buffer = buffer[end:]
+    if buffer:
+        yield buffer
@@ -0,0 +1,117 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from common.log import logger
+from config import conf
+
+# 处理消息的线程池: plugin处理插件回复和管理指令, llm处理模型调用, media处理语音转换、图片下载等
+HANDLER_POOL_PLUGIN = "plugin"
+HANDLER_POOL_LLM = "llm"
+HANDLER_POOL_MEDIA = "media"
+DEFAULT_HANDLER_POOLS = {HANDLER_POOL_PLUGIN: 4, HANDLER_POOL_LLM: 8, HANDLER_POOL_MEDIA: 4}
+
+_pools = {}
+_pools_lock = threading.Lock()
+_local = threading.local()
+
+
+class WorkerPool:
+    """带统计信息的线程池，记录排队数、活跃线程数和任务等待时间"""
+
+    def __init__(self, name: str, max_workers: int):
+        self.name = name
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pool-" + name)
+        self.lock = threading.Lock()
+        self.pending = 0  # 已提交但未开始执行的任务数
+        self.active = 0  # 正在执行的任务数
+        self.completed = 0  # 已执行完毕的任务数
+        self.total_wait = 0.0  # 任务从提交到开始执行的累计等待时间
+        self.max_wait = 0.0
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        with self.lock:
+            self.pending += 1
+        future = self.executor.submit(self._run, time.monotonic(), fn, args, kwargs)
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _run(self, submit_time, fn, args, kwargs):
+        wait = time.monotonic() - submit_time
+        with self.lock:
+            self.pending -= 1
+            self.active += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+        _local.pool = self.name
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.pool = None
+            with self.lock:
+                self.active -= 1
+                self.completed += 1
+
+    def _on_done(self, future: Future):
+        if future.cancelled():  # 未开始执行就被取消的任务不会进入_run
+            with self.lock:
+                self.pending -= 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            started = self.completed + self.active
+            return {
+                "name": self.name,
+                "max_workers": self.max_workers,
+                "queue_depth": self.pending,
+                "active": self.active,
+                "completed": self.completed,
+                "avg_wait_ms": self.total_wait / started * 1000 if started else 0.0,
+                "max_wait_ms": self.max_wait * 1000,
+            }
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+def get_worker_pool(name: str, max_workers: int = 8) -> WorkerPool:
+    """
+    获取指定名称的线程池，不存在时按max_workers创建
+    :param name: 线程池名称
+    :param max_workers: 线程池大小，仅在首次创建时生效
+    """
+    pool = _pools.get(name)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(name)
+            if pool is None:
+                pool = WorkerPool(name, max_workers)
+                _pools[name] = pool
+                logger.info("[WorkerPool] create pool {}, max_workers={}".format(name, max_workers))
+    return pool
+
+
+def get_handler_pool(name: str) -> WorkerPool:
+    """获取处理消息的线程池，大小按handler_pools配置，未配置时使用DEFAULT_HANDLER_POOLS"""
+    pool_sizes = conf().get("handler_pools") or {}
+    return get_worker_pool(name, pool_sizes.get(name, DEFAULT_HANDLER_POOLS.get(name, 8)))
+
+
+def worker_pools() -> list:
+    return list(_pools.values())
+
+
+def current_worker_pool():
+    """返回当前线程所属的线程池名称，不在线程池中时返回None"""
+    return getattr(_local, "pool", None)
+
+
+def format_pool_stats() -> str:
+    lines = []
+    for pool in worker_pools():
+        s = pool.stats()
+        lines.append(
+            "{name}: 线程 {active}/{max_workers}, 排队 {queue_depth}, 完成 {completed}, 平均等待 {avg_wait_ms:.1f}ms, 最大等待 {max_wait_ms:.1f}ms".format(**s)
+        )
+    return "\n".join(lines) if lines else "暂无线程池"
@@ -4,6 +4,7 @@ import json
 import logging
 import os
 import pickle
+import threading
 import copy
 
 from common.log import logger
@@ -49,16 +50,68 @@ available_setting = {
     "image_proxy": True,  # 是否需要图片代理，国内访问LinkAI时需要
     "image_create_prefix": ["画", "看", "找"],  # 开启图片回复的前缀
     "concurrency_in_session": 1,  # 同一会话最多有多少条消息在处理中，大于1可能乱序
+    "stream_reply": False,  # 是否开启流式回复，仅对支持的通道(web, 钉钉AI卡片, 公众号主动回复)和模型生效
+    "stream_segment_min_len": 10,  # 流式回复时每段至少包含的字符数，达到后在句末标点处发送
+    "handler_pools": {"plugin": 4, "llm": 8, "media": 4},  # 消息处理线程池大小，plugin处理插件回复和管理指令，llm处理模型调用，media处理语音转换、图片下载等
+    "handler_pool_routes": {},  # 插件中断事件后由指定线程池继续处理，key为插件名，value为线程池名，如 {"linkai": "llm"}
+    "async_pipeline": False,  # 是否开启异步模式，开启后模型调用在asyncio事件循环中执行，不再占用llm线程池
+    "async_max_inflight": 1000,  # 异步模式下同时进行中的模型调用数上限
+    "http_pool_maxsize": 20,  # 每个host保持的最大HTTP连接数
+    "http_connect_timeout": 10,  # 未指定超时的HTTP请求的连接超时，单位秒
+    "http_read_timeout": 300,  # 未指定超时的HTTP请求的读取超时，单位秒
+    "http_max_retries": 2,  # HTTP请求连接失败或返回502/503/504时的重试次数
+    "http_retry_backoff": 0.5,  # HTTP重试的退避系数
+    "http_retry_methods": ["GET", "HEAD", "OPTIONS"],  # 允许重试的请求方法，默认不重试POST以免重复提交
+    "token_refresh_ahead": 600,  # access_token在过期前多少秒开始后台刷新
+    "token_cache_persist": False,  # 是否将access_token保存到数据目录，重启后继续使用
+    # 渠道发送图片、视频时的下载缓存
+    "media_cache_dir": "",  # 缓存目录，默认为数据目录下的media_cache
+    "media_cache_max_size": 200,  # 缓存文件总大小上限，单位MB
+    "media_cache_url_ttl": 86400,  # 同一URL直接使用缓存内容的时间，单位秒，从下载时开始计算，响应的Cache-Control为no-store或max-age更短时以响应为准
+    "media_download_chunk_size": 262144,  # 流式下载的块大小，单位字节
+    "media_id_cache_seconds": 172800,  # 上传后得到的临时媒体id的复用时间，公众号和企业微信的临时素材有效期为3天
+    # webhook渠道(wechatmp, wechatcom_app, feishu, web)的HTTP服务配置
+    "http_server": "threaded",  # 服务后端，支持 simple(web.py开发服务器), threaded(线程池), async(asyncio，web渠道固定使用)
+    "http_server_threads": 32,  # 处理请求的线程数
+    "http_server_max_connections": 1000,  # 最大并发连接数
+    "http_server_keepalive_timeout": 75,  # keep-alive连接的空闲超时，单位秒
+    "http_server_drain_timeout": 10,  # 退出时等待处理中请求完成的最长时间，单位秒
+    # 消息处理各阶段耗时统计
+    "metrics_enabled": False,  # 是否统计消息处理各阶段(构造context、插件事件、模型调用、装饰回复、发送)的耗时
+    "metrics_port": 0,  # 以Prometheus文本格式导出统计的HTTP端口，访问路径为/metrics，0表示不开启
+    "metrics_host": "0.0.0.0",  # 导出统计的监听地址
+    "plugin_lazy_load": True,  # 插件目录下有manifest.json时延迟到收到匹配的消息时才导入插件
+    "plugin_profile": False,  # 是否统计每个插件处理函数的耗时，可通过管理员指令#profile查看和开关
     "image_create_size": "256x256",  # 图片大小,可选有 256x256, 512x512, 1024x1024 (dall-e-3默认为1024x1024)
     "group_chat_exit_group": False,
     # chatgpt会话参数
     "expires_in_seconds": 3600,  # 无操作会话的过期时间
+    "session_store": "memory",  # 会话存储方式，支持 memory, sqlite, redis，使用sqlite或redis时重启后可恢复会话，redis可供多副本共享
+    "session_store_path": "",  # sqlite数据库文件路径，默认为数据目录下的sessions.db
+    "session_store_redis_url": "redis://localhost:6379/0",  # redis连接地址
+    "session_store_flush_interval": 1,  # 会话批量写入存储的间隔，单位秒
     # 人格描述
     "character_desc": "你是ChatGPT, 一个由OpenAI训练的大型语言模型, 你旨在回答并解决人们的任何问题，并且可以使用多种语言与人交流。",
     "conversation_max_tokens": 1000,  # 支持上下文记忆的最多字符数
+    # 无上下文问答的回复缓存，相同模型、人设下的相同问题直接返回缓存的回复
+    "reply_cache": False,  # 是否开启回复缓存
+    "reply_cache_ttl": 3600,  # 缓存的回复保存时间，单位秒
+    "reply_cache_max_entries": 1000,  # 缓存的回复数量上限
+    "reply_cache_group_white_list": ["ALL_GROUP"],  # 开启缓存的群名称，ALL_GROUP表示所有群
+    "reply_cache_single_chat": True,  # 私聊是否使用缓存
     # chatgpt限流配置
     "rate_limit_chatgpt": 20,  # chatgpt的调用频率限制
     "rate_limit_dalle": 50,  # openai dalle的调用频率限制
+    # 对话请求的分层限流，rpm为每分钟请求数，tpm为每分钟估算的提示词token数，0表示不限制
+    "rate_limit_global_rpm": 0,  # 所有请求
+    "rate_limit_global_tpm": 0,
+    "rate_limit_bot_rpm": 0,  # 每种对话机器人
+    "rate_limit_bot_tpm": 0,
+    "rate_limit_group_rpm": 0,  # 每个群
+    "rate_limit_group_tpm": 0,
+    "rate_limit_user_rpm": 0,  # 每个用户
+    "rate_limit_user_tpm": 0,
+    "rate_limit_wait": 10,  # 超出限额时最多排队等待的秒数，需要等待更久时直接拒绝
     # chatgpt api参数 参考https://platform.openai.com/docs/api-reference/chat/create
     "temperature": 0.9,
     "top_p": 1,
@@ -101,6 +154,10 @@ available_setting = {
     "always_reply_voice": False,  # 是否一直使用语音回复
     "voice_to_text": "openai",  # 语音识别引擎，支持openai,baidu,google,azure,xunfei,ali
     "text_to_voice": "openai",  # 语音合成引擎，支持openai,baidu,google,azure,xunfei,ali,pytts(offline),elevenlabs,edge(online)
+    "audio_transcode_workers": 2,  # 语音转码进程数，0表示在消息处理线程中直接转码
+    "audio_transcode_timeout": 30,  # 单条语音的转码超时时间，单位秒
+    "tts_cache_max_size": 100,  # 语音合成结果缓存的总大小上限，单位MB，0表示不缓存
+    "tts_cache_dir": "",  # 语音合成缓存目录，默认为数据目录下的tts_cache
     "text_to_voice_model": "tts-1",
     "tts_voice_id": "alloy",
     # baidu 语音api配置， 使用百度语音识别和语音合成时需要
@@ -156,8 +213,20 @@ available_setting = {
     # chatgpt指令自定义触发词
     "clear_memory_commands": ["#清除记忆"],  # 重置会话指令，必须以#开头
     # channel配置
-    "channel_type": "",  # 通道类型，支持：{wx,wxy,terminal,wechatmp,wechatmp_service,wechatcom_app,dingtalk}
+    "channel_type": "",  # 通道类型，支持：{wx,wxy,terminal,loadtest,wechatmp,wechatmp_service,wechatcom_app,dingtalk}
     "subscribe_msg": "",  # 订阅消息, 支持: wechatmp, wechatmp_service, wechatcom_app
+    # 压测渠道配置，channel_type为loadtest时生效，群消息需要group_name_white_list包含ALL_GROUP
+    "loadtest_rate": 20,  # 每秒发送的消息数
+    "loadtest_duration": 60,  # 合成消息时的发送时长，单位秒
+    "loadtest_poisson": True,  # 是否按泊松过程发送，关闭时匀速发送
+    "loadtest_sessions": 1000,  # 模拟的用户数
+    "loadtest_groups": 50,  # 模拟的群数
+    "loadtest_mix": {},  # 各类消息的权重，可选single,group,group_at,command,voice,image，为空时使用默认比例
+    "loadtest_seed": 0,  # 随机种子，相同配置生成相同的消息序列
+    "loadtest_replay_file": "",  # 回放的消息文件，每行一个json: {"kind": "single", "content": "你好", "user": "u1", "group": "g1", "offset": 0.5}
+    "loadtest_drain_timeout": 60,  # 发送结束后等待处理完成的时间，超时未完成的消息计为丢弃
+    "loadtest_report_interval": 10,  # 压测过程中输出进度的间隔，单位秒，0为不输出
+    "loadtest_report_file": "",  # 压测报告的json输出路径
     "debug": False,  # 是否开启debug模式，开启后会打印更多日志
     "appdata_dir": "",  # 数据目录
     # 插件配置
@@ -180,18 +249,31 @@ available_setting = {
     "Minimax_group_id": "",
     "Minimax_base_url": "",
     "web_port": 9899,
+    "web_sse_heartbeat": 15,  # SSE连接空闲时的心跳间隔，单位秒
+    "web_sse_max_pending": 1000,  # 每个用户最多缓存的待推送消息数
 }
 
 
 class Config(dict):
+    """
+    配置快照，构造完成后不可修改，修改配置请使用update_config或load_config生成新的快照
+    conf().get(key, default)保持原有语义，conf().key直接返回已合并available_setting默认值的配置
+    """
+
     def __init__(self, d=None):
         super().__init__()
+        self._frozen = False
         if d is None:
             d = {}
         for k, v in d.items():
             self[k] = v
         # user_datas: 用户数据，key为用户名，value为用户数据，也是dict
         self.user_datas = {}
+        # 预先合并默认值并写入实例属性，conf().key 与普通属性访问开销相同
+        for k, v in available_setting.items():
+            if not hasattr(Config, k):
+                self.__dict__[k] = dict.get(self, k, v)
+        self._frozen = True
 
     def __getitem__(self, key):
         if key not in available_setting:
@@ -201,15 +283,19 @@ class Config(dict):
     def __setitem__(self, key, value):
         if key not in available_setting:
             raise Exception("key {} not in available_setting".format(key))
+        if self._frozen:
+            raise TypeError("config snapshot is read-only, use update_config to change {}".format(key))
         return super().__setitem__(key, value)
 
+    def __deepcopy__(self, memo):
+        snapshot = Config(copy.deepcopy(dict(self), memo))
+        snapshot.user_datas = self.user_datas
+        return snapshot
+
     def get(self, key, default=None):
-        try:
-            return self[key]
-        except KeyError as e:
-            return default
-        except Exception as e:
-            raise e
+        if key not in available_setting:
+            raise Exception("key {} not in available_setting".format(key))
+        return dict.get(self, key, default)
 
     # Make sure to return a dictionary to ensure atomic
     def get_user_data(self, user) -> dict:
@@ -238,6 +324,8 @@ class Config(dict):
 
 
 config = Config()
+_config_lock = threading.RLock()
+_subscribers = []
 
 
 def drag_sensitive(config):
@@ -252,7 +340,7 @@ def drag_sensitive(config):
             return json.dumps(conf_dict_copy, indent=4)
 
         elif isinstance(config, dict):
-            config_copy = copy.deepcopy(config)
+            config_copy = copy.deepcopy(dict(config))
             for key in config:
                 if "key" in key or "secret" in key:
                     if isinstance(config_copy[key], str):
@@ -265,7 +353,6 @@ def drag_sensitive(config):
 
 
 def load_config():
-    global config
     config_path = "./config.json"
     if not os.path.exists(config_path):
         logger.info("配置文件不存在，将使用config-template.json模板")
@@ -275,7 +362,7 @@ def load_config():
     logger.debug("[INIT] config str: {}".format(drag_sensitive(config_str)))
 
     # 将json字符串反序列化为dict类型
-    config = Config(json.loads(config_str))
+    config_dict = json.loads(config_str)
 
     # override config with environment variables.
     # Some online deployment platforms (e.g. Railway) deploy project from github directly. So you shouldn't put your secrets like api key in a config file, instead use environment variables to override the default config.
@@ -284,22 +371,62 @@ def load_config():
         if name in available_setting:
             logger.info("[INIT] override config by environ args: {}={}".format(name, value))
             try:
-                config[name] = eval(value)
+                config_dict[name] = eval(value)
             except:
                 if value == "false":
-                    config[name] = False
+                    config_dict[name] = False
                 elif value == "true":
-                    config[name] = True
+                    config_dict[name] = True
                 else:
-                    config[name] = value
+                    config_dict[name] = value
 
-    if config.get("debug", False):
+    # 新快照构建完成后再整体替换，处理中的请求不会读到一半新一半旧的配置
+    new_config = Config(config_dict)
+    if new_config.get("debug", False):
         logger.setLevel(logging.DEBUG)
         logger.debug("[INIT] set log level to DEBUG")
 
-    logger.info("[INIT] load config: {}".format(drag_sensitive(config)))
+    logger.info("[INIT] load config: {}".format(drag_sensitive(new_config)))
+
+    new_config.load_user_datas()
+    _swap_config(new_config)
+
+
+def update_config(changes: dict):
+    """
+    在当前配置基础上修改部分配置项，生成新快照并原子替换
+    :param changes: 需要修改的配置项
+    """
+    with _config_lock:
+        new_config = Config({**config, **changes})
+        new_config.user_datas = config.user_datas
+        _swap_config(new_config)
+    return new_config
+
+
+def _swap_config(new_config):
+    global config
+    with _config_lock:
+        config = new_config
+        for callback in list(_subscribers):
+            try:
+                callback(new_config)
+            except Exception as e:
+                logger.exception("[Config] subscriber {} error: {}".format(callback, e))
+
+
+def subscribe(callback):
+    """
+    订阅配置变更，配置重新加载或修改后以新配置调用 callback(config)，可用作装饰器
+    """
+    if callback not in _subscribers:
+        _subscribers.append(callback)
+    return callback
+
 
-    config.load_user_datas()
+def unsubscribe(callback):
+    if callback in _subscribers:
+        _subscribers.remove(callback)
 
 
 def get_root():
@@ -9,7 +9,7 @@ from bridge.reply import Reply, ReplyType
 from common.log import logger
 from plugins import *
 
-from .lib.WordsSearch import WordsSearch
+from .lib.ArrayWordsSearch import ArrayWordsSearch
 
 
 @plugins.register(
@@ -35,7 +35,6 @@ class Banwords(Plugin):
                     with open(config_path, "w") as f:
                         json.dump(conf, f, indent=4)
 
-            self.searchr = WordsSearch()
             self.action = conf["action"]
             banwords_path = os.path.join(curdir, "banwords.txt")
             with open(banwords_path, "r", encoding="utf-8") as f:
@@ -44,7 +43,7 @@ class Banwords(Plugin):
                     word = line.strip()
                     if word:
                         words.append(word)
-            self.searchr.SetKeywords(words)
+            self.searchr = self._load_searcher(words, os.path.join(curdir, "banwords.ac"))
             self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
             if conf.get("reply_filter", True):
                 self.handlers[Event.ON_DECORATE_REPLY] = self.on_decorate_reply
@@ -54,6 +53,24 @@ class Banwords(Plugin):
             logger.warn("[Banwords] init failed, ignore or see https://github.com/zhayujie/chatgpt-on-wechat/tree/master/plugins/banwords .")
             raise e
 
+    def _load_searcher(self, words, cache_path):
+        # 词库未变化时直接mmap加载上次构建的自动机，避免每次启动重新构建
+        if os.path.exists(cache_path):
+            try:
+                searcher = ArrayWordsSearch.Load(cache_path, words)
+                if searcher:
+                    logger.debug("[Banwords] load automaton from {}".format(cache_path))
+                    return searcher
+            except Exception as e:
+                logger.warn("[Banwords] load automaton cache failed: {}".format(e))
+        searcher = ArrayWordsSearch()
+        searcher.SetKeywords(words)
+        try:
+            searcher.Save(cache_path)
+        except Exception as e:
+            logger.warn("[Banwords] save automaton cache failed: {}".format(e))
+        return searcher
+
     def on_handle_context(self, e_context: EventContext):
         if e_context["context"].type not in [
             ContextType.TEXT,
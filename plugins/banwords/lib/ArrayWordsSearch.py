@@ -0,0 +1,237 @@
+# encoding:utf-8
+"""
+基于扁平数组的Aho-Corasick自动机，接口与WordsSearch一致
+状态转移、失败指针和输出均保存在int32数组中，不为每个节点创建对象，
+构建结果可以保存为文件并通过mmap直接加载，多个进程共享同一份页缓存
+
+文件格式: 头部(魔数、各数组长度) + 各int32数组 + 以\\n分隔的utf-8关键词
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left
+
+__all__ = ["ArrayWordsSearch"]
+
+_MAGIC = b"ACW1"
+_HEADER = struct.Struct("<4s8I")  # 魔数, 字节序标记, 状态数, 边数, 输出数, 关键词数, 关键词字节数, 缓存摘要长度, 保留
+_BYTE_ORDER = 1 if sys.byteorder == "little" else 2
+_ARRAYS = ("edge_start", "edge_char", "edge_next", "fail", "match", "out_start", "out_words", "out_link")
+
+
+class ArrayWordsSearch:
+    def __init__(self):
+        self._keywords = []
+        self._indexs = []
+        self._root = {}  # 根节点的转移，扫描时最常用，单独用dict加速
+        self._alphabet = frozenset()  # 关键词中出现过的字符，其余字符直接回到根节点
+        self._mmap = None
+        for name in _ARRAYS:
+            setattr(self, name, array("i"))
+
+    def SetKeywords(self, keywords):
+        self._keywords = list(keywords)
+        self._indexs = list(range(len(self._keywords)))
+        self._build()
+        self._prepare()
+
+    # 构建
+    def _build(self):
+        # 按字典序插入关键词，同一节点的子节点自然按字符升序产生，无需为节点建立dict
+        order = sorted((w, i) for i, w in enumerate(self._keywords) if w)
+        parent, char = array("i", [0]), array("i", [0])
+        own_words = {}  # 状态 -> 以该状态结尾的关键词序号
+        path = [0]  # 上一个关键词经过的状态
+        prev = ""
+        for word, idx in order:
+            lcp = 0
+            limit = min(len(prev), len(word))
+            while lcp < limit and prev[lcp] == word[lcp]:
+                lcp += 1
+            del path[lcp + 1:]
+            for j in range(lcp, len(word)):
+                state = len(parent)
+                parent.append(path[-1])
+                char.append(ord(word[j]))
+                path.append(state)
+            own_words.setdefault(path[len(word)], []).append(idx)
+            prev = word
+        n = len(parent)
+
+        # 按父节点分组得到CSR格式的边，父节点内的字符已有序
+        edge_start = array("i", bytes(4 * (n + 1)))
+        for s in range(1, n):
+            edge_start[parent[s] + 1] += 1
+        for s in range(n):
+            edge_start[s + 1] += edge_start[s]
+        fill = array("i", edge_start)
+        edge_char = array("i", bytes(4 * (n - 1)))
+        edge_next = array("i", bytes(4 * (n - 1)))
+        for s in range(1, n):
+            p = parent[s]
+            i = fill[p]
+            edge_char[i] = char[s]
+            edge_next[i] = s
+            fill[p] = i + 1
+        self.edge_start, self.edge_char, self.edge_next = edge_start, edge_char, edge_next
+
+        # 广度优先计算失败指针和输出链
+        fail = array("i", bytes(4 * n))
+        self.fail = fail
+        out_link = array("i", [-1]) * n
+        match = array("i", [-1]) * n
+        for s, words in own_words.items():
+            match[s] = words[0]
+        queue = array("i", edge_next[edge_start[0]:edge_start[1]])
+        head = 0
+        while head < len(queue):
+            u = queue[head]
+            head += 1
+            for i in range(edge_start[u], edge_start[u + 1]):
+                c, v = edge_char[i], edge_next[i]
+                f = self._goto(fail[u], c)
+                fail[v] = f
+                out_link[v] = f if f in own_words else out_link[f]
+                if match[v] < 0 and out_link[v] >= 0:
+                    match[v] = match[out_link[v]]
+                queue.append(v)
+        self.out_link, self.match = out_link, match
+
+        out_start = array("i", bytes(4 * (n + 1)))
+        out_words = array("i")
+        for s in range(n):
+            out_words.extend(own_words.get(s, ()))
+            out_start[s + 1] = len(out_words)
+        self.out_start, self.out_words = out_start, out_words
+
+    def _goto(self, state, c):
+        # 沿失败指针查找字符c的转移，找不到时返回根节点
+        edge_start, edge_char = self.edge_start, self.edge_char
+        while True:
+            lo, hi = edge_start[state], edge_start[state + 1]
+            if lo < hi:
+                i = bisect_left(edge_char, c, lo, hi)
+                if i < hi and edge_char[i] == c:
+                    return self.edge_next[i]
+            if state == 0:
+                return 0
+            state = self.fail[state]
+
+    def _prepare(self):
+        lo, hi = self.edge_start[0], self.edge_start[1]
+        self._root = {self.edge_char[i]: self.edge_next[i] for i in range(lo, hi)}
+        self._alphabet = frozenset(self.edge_char)
+
+    # 持久化
+    @staticmethod
+    def Digest(keywords):
+        """关键词列表的摘要，用于判断缓存文件是否过期"""
+        return hashlib.sha256("\n".join(keywords).encode("utf-8")).hexdigest().encode("ascii")
+
+    def Save(self, path):
+        keywords = "\n".join(self._keywords).encode("utf-8")
+        digest = self.Digest(self._keywords)
+        header = _HEADER.pack(
+            _MAGIC, _BYTE_ORDER, len(self.fail), len(self.edge_char), len(self.out_words), len(self._keywords), len(keywords), len(digest), 0
+        )
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(header)
+            f.write(digest)
+            for name in _ARRAYS:
+                getattr(self, name).tofile(f)
+            f.write(keywords)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def Load(cls, path, keywords=None):
+        """
+        通过mmap加载Save保存的自动机
+        :param keywords: 若提供，则在缓存与关键词不一致时返回None
+        """
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, byte_order, n, n_edges, n_out, n_words, words_len, digest_len, _ = _HEADER.unpack_from(mm, 0)
+        if magic != _MAGIC or byte_order != _BYTE_ORDER:
+            mm.close()
+            return None
+        offset = _HEADER.size
+        digest = mm[offset:offset + digest_len]
+        if keywords is not None and digest != cls.Digest(keywords):
+            mm.close()
+            return None
+        offset += digest_len
+        search = cls()
+        view = memoryview(mm)
+        sizes = {"edge_start": n + 1, "edge_char": n_edges, "edge_next": n_edges, "fail": n, "match": n,
+                 "out_start": n + 1, "out_words": n_out, "out_link": n}
+        for name in _ARRAYS:
+            size = sizes[name] * 4
+            setattr(search, name, view[offset:offset + size].cast("i"))
+            offset += size
+        search._keywords = bytes(view[offset:offset + words_len]).decode("utf-8").split("\n") if n_words else []
+        search._indexs = list(range(n_words))
+        search._mmap = mm
+        search._prepare()
+        return search
+
+    # 查询
+    def _scan(self, text):
+        """逐字符推进自动机，在有关键词结束的位置产出 (位置, 状态)"""
+        # 转移逻辑与_goto相同，内联以减少每个字符的函数调用开销
+        root_get, alphabet, match = self._root.get, self._alphabet, self.match
+        edge_start, edge_char, edge_next, fail = self.edge_start, self.edge_char, self.edge_next, self.fail
+        state = 0
+        for index, ch in enumerate(text):
+            c = ord(ch)
+            if c not in alphabet:
+                state = 0
+                continue
+            while state:
+                lo, hi = edge_start[state], edge_start[state + 1]
+                if lo < hi:
+                    i = bisect_left(edge_char, c, lo, hi)
+                    if i < hi and edge_char[i] == c:
+                        state = edge_next[i]
+                        break
+                state = fail[state]
+            else:
+                state = root_get(c, 0)
+            if match[state] >= 0:
+                yield index, state
+
+    def _result(self, item, index):
+        keyword = self._keywords[item]
+        return {"Keyword": keyword, "Success": True, "End": index, "Start": index + 1 - len(keyword), "Index": self._indexs[item]}
+
+    def FindFirst(self, text):
+        for index, state in self._scan(text):
+            return self._result(self.match[state], index)
+        return None
+
+    def FindAll(self, text):
+        results = []
+        for index, state in self._scan(text):
+            s = state if self.out_start[state] < self.out_start[state + 1] else self.out_link[state]
+            while s >= 0:
+                for i in range(self.out_start[s], self.out_start[s + 1]):
+                    results.append(self._result(self.out_words[i], index))
+                s = self.out_link[s]
+        return results
+
+    def ContainsAny(self, text):
+        for _ in self._scan(text):
+            return True
+        return False
+
+    def Replace(self, text, replaceChar="*"):
+        result = list(text)
+        for index, state in self._scan(text):
+            start = index + 1 - len(self._keywords[self.match[state]])
+            for j in range(start, index + 1):
+                result[j] = replaceChar
+        return "".join(result)
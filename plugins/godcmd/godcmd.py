@@ -12,8 +12,12 @@ import plugins
 from bridge.bridge import Bridge
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from bridge.reply_cache import format_reply_cache_stats
 from common import const
-from config import conf, load_config, global_config
+from common.http_client import format_http_stats
+from common.worker_pool import format_pool_stats
+from voice.tts_cache import format_tts_stats
+from config import conf, load_config, global_config, update_config
 from plugins import *
 
 # 定义指令集
@@ -131,6 +135,23 @@ ADMIN_COMMANDS = {
         "alias": ["debug", "调试模式", "DEBUG"],
         "desc": "开启机器调试日志",
     },
+    "pools": {
+        "alias": ["pools", "线程池"],
+        "desc": "查看消息处理线程池状态",
+    },
+    "http": {
+        "alias": ["http", "连接池"],
+        "desc": "查看HTTP连接池状态",
+    },
+    "cache": {
+        "alias": ["cache", "缓存"],
+        "desc": "查看缓存命中率",
+    },
+    "profile": {
+        "alias": ["profile", "插件耗时"],
+        "args": ["[on|off|reset]"],
+        "desc": "查看插件处理耗时，on/off开启或关闭统计，reset清空统计",
+    },
 }
 
 
@@ -272,7 +293,7 @@ class Godcmd(Plugin):
                         if args[0] not in const.MODEL_LIST:
                             ok, result = False, "模型名称不存在"
                         else:
-                            conf()["model"] = self.model_mapping(args[0])
+                            update_config({"model": self.model_mapping(args[0])})
                             Bridge().reset_bot()
                             model = conf().get("model") or const.GPT35
                             ok, result = True, "模型设置为: " + str(model)
@@ -352,6 +373,30 @@ class Godcmd(Plugin):
                             else:
                                 logger.setLevel(logging.DEBUG)
                                 ok, result = True, "DEBUG模式已开启"
+                        elif cmd == "pools":
+                            ok, result = True, format_pool_stats()
+                        elif cmd == "http":
+                            ok, result = True, format_http_stats()
+                        elif cmd == "cache":
+                            ok, result = True, format_reply_cache_stats() + "\n" + format_tts_stats()
+                        elif cmd == "profile":
+                            action = args[0].lower() if args else ""
+                            if action == "on":
+                                PluginManager().set_profiling(True)
+                                ok, result = True, "插件耗时统计已开启"
+                            elif action == "off":
+                                PluginManager().set_profiling(False)
+                                ok, result = True, "插件耗时统计已关闭"
+                            elif action == "reset":
+                                if PluginManager().profiler:
+                                    PluginManager().profiler.reset()
+                                ok, result = True, "插件耗时统计已清空"
+                            elif action:
+                                ok, result = False, "参数错误，可选 on, off, reset"
+                            elif PluginManager().profiler is None:
+                                ok, result = False, "插件耗时统计未开启，请使用 #profile on 开启"
+                            else:
+                                ok, result = True, PluginManager().profiler.format()
                         elif cmd == "plist":
                             plugins = PluginManager().list_plugins()
                             ok = True
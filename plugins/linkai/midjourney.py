@@ -1,7 +1,7 @@
 from enum import Enum
 from config import conf
 from common.log import logger
-import requests
+from common import http_client
 import threading
 import time
 from bridge.reply import Reply, ReplyType
@@ -76,7 +76,14 @@ class MJBot:
         self.tasks = {}
         self.temp_dict = {}
         self.tasks_lock = threading.Lock()
-        self.event_loop = asyncio.new_event_loop()
+        self._event_loop = None
+
+    @property
+    def event_loop(self):
+        # 事件循环只在需要时创建，未使用Midjourney时不占用资源
+        if self._event_loop is None:
+            self._event_loop = asyncio.new_event_loop()
+        return self._event_loop
 
     def judge_mj_task_type(self, e_context: EventContext):
         """
@@ -199,7 +206,7 @@ class MJBot:
         body = {"prompt": prompt, "mode": mode, "auto_translate": self.config.get("auto_translate")}
         if not self.config.get("img_proxy"):
             body["img_proxy"] = False
-        res = requests.post(url=self.base_url + "/generate", json=body, headers=self.headers, timeout=(5, 40))
+        res = http_client.post(url=self.base_url + "/generate", json=body, headers=self.headers, timeout=(5, 40))
         if res.status_code == 200:
             res = res.json()
             logger.debug(f"[MJ] image generate, res={res}")
@@ -240,7 +247,7 @@ class MJBot:
             body["index"] = index
         if not self.config.get("img_proxy"):
             body["img_proxy"] = False
-        res = requests.post(url=self.base_url + "/operate", json=body, headers=self.headers, timeout=(5, 40))
+        res = http_client.post(url=self.base_url + "/operate", json=body, headers=self.headers, timeout=(5, 40))
         logger.debug(res)
         if res.status_code == 200:
             res = res.json()
@@ -274,7 +281,7 @@ class MJBot:
             time.sleep(10)
             url = f"{self.base_url}/tasks/{task.id}"
             try:
-                res = requests.get(url, headers=self.headers, timeout=8)
+                res = http_client.get(url, headers=self.headers, timeout=8)
                 if res.status_code == 200:
                     res_json = res.json()
                     logger.debug(f"[MJ] task check res sync, task_id={task.id}, status={res.status_code}, "
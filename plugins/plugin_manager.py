@@ -5,13 +5,18 @@ import importlib.util
 import json
 import os
 import sys
+import threading
+import time
 
+from common import metrics
 from common.log import logger
 from common.singleton import singleton
 from common.sorted_dict import SortedDict
 from config import conf, remove_plugin_config, write_plugin_config
 
 from .event import *
+from .plugin import Plugin
+from .profiler import PluginProfiler
 
 
 @singleton
@@ -23,6 +28,10 @@ class PluginManager:
         self.pconf = {}
         self.current_plugin_path = None
         self.loaded = {}
+        self.dispatch = {}  # event -> [(插件名, 处理函数)]，按优先级排序且只包含已启用的插件
+        self.profiler = None  # 开启插件耗时统计时为PluginProfiler
+        self.load_stats = {}  # 插件名 -> {"import": 导入耗时, "init": 初始化耗时, "rss": 导入增加的内存(KB), "lazy": 是否延迟加载}
+        self.lazy_lock = threading.RLock()
 
     def register(self, name: str, desire_priority: int = 0, **kwargs):
         def wrapper(plugincls):
@@ -88,30 +97,20 @@ class PluginManager:
         logger.info("Scaning plugins ...")
         plugins_dir = "./plugins"
         raws = [self.plugins[name] for name in self.plugins]
+        lazy_load = conf().get("plugin_lazy_load", True)
         for plugin_name in os.listdir(plugins_dir):
             plugin_path = os.path.join(plugins_dir, plugin_name)
             if os.path.isdir(plugin_path):
                 # 判断插件是否包含同名__init__.py文件
                 main_module_path = os.path.join(plugin_path, "__init__.py")
                 if os.path.isfile(main_module_path):
-                    # 导入插件
-                    import_path = "plugins.{}".format(plugin_name)
-                    try:
-                        self.current_plugin_path = plugin_path
-                        if plugin_path in self.loaded:
-                            if plugin_name.upper() != 'GODCMD':
-                                logger.info("reload module %s" % plugin_name)
-                                self.loaded[plugin_path] = importlib.reload(sys.modules[import_path])
-                                dependent_module_names = [name for name in sys.modules.keys() if name.startswith(import_path + ".")]
-                                for name in dependent_module_names:
-                                    logger.info("reload module %s" % name)
-                                    importlib.reload(sys.modules[name])
-                        else:
-                            self.loaded[plugin_path] = importlib.import_module(import_path)
-                        self.current_plugin_path = None
-                    except Exception as e:
-                        logger.warn("Failed to import plugin %s: %s" % (plugin_name, e))
-                        continue
+                    if plugin_path not in self.loaded and lazy_load:
+                        manifest = self._read_manifest(plugin_path)
+                        if manifest:
+                            # 声明了事件和触发条件的插件先注册占位，收到匹配的事件时再导入
+                            self._register_lazy(plugin_path, manifest)
+                            continue
+                    self._import_plugin(plugin_name, plugin_path)
         pconf = self.pconf
         news = [self.plugins[name] for name in self.plugins]
         new_plugins = list(set(news) - set(raws))
@@ -131,11 +130,146 @@ class PluginManager:
                 self.plugins._update_heap(name)  # 更新下plugins中的顺序
         if modified:
             self.save_config()
+        self._rebuild_dispatch()
         return new_plugins
 
+    def _import_plugin(self, plugin_name, plugin_path):
+        import_path = "plugins.{}".format(plugin_name)
+        start, rss = time.perf_counter(), _current_rss_kb()
+        try:
+            self.current_plugin_path = plugin_path
+            if plugin_path in self.loaded:
+                if plugin_name.upper() != 'GODCMD':
+                    logger.info("reload module %s" % plugin_name)
+                    self.loaded[plugin_path] = importlib.reload(sys.modules[import_path])
+                    dependent_module_names = [name for name in sys.modules.keys() if name.startswith(import_path + ".")]
+                    for name in dependent_module_names:
+                        logger.info("reload module %s" % name)
+                        importlib.reload(sys.modules[name])
+            else:
+                self.loaded[plugin_path] = importlib.import_module(import_path)
+        except Exception as e:
+            logger.warn("Failed to import plugin %s: %s" % (plugin_name, e))
+            return False
+        finally:
+            self.current_plugin_path = None
+        for name, plugincls in self.plugins.items():
+            if plugincls.path == plugin_path:
+                stats = self.load_stats.setdefault(name, {})
+                stats.update({"import": time.perf_counter() - start, "rss": _current_rss_kb() - rss, "lazy": False})
+        return True
+
+    @staticmethod
+    def _read_manifest(plugin_path):
+        manifest_path = os.path.join(plugin_path, "manifest.json")
+        if not os.path.isfile(manifest_path):
+            return None
+        try:
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except Exception as e:
+            logger.warn("Failed to read plugin manifest %s: %s" % (manifest_path, e))
+            return None
+        if not manifest.get("name") or not manifest.get("events"):
+            return None
+        unknown = [event for event in manifest["events"] if event not in Event.__members__]
+        if unknown:
+            logger.warn("Unknown events %s in plugin manifest %s, load it eagerly" % (unknown, manifest_path))
+            return None
+        return manifest
+
+    def _register_lazy(self, plugin_path, manifest):
+        name = manifest["name"]
+        if name.upper() in self.plugins:
+            return
+        plugincls = type(
+            "Lazy" + name.capitalize(),
+            (LazyPlugin,),
+            {
+                "manifest": manifest,
+                "events": [Event[event] for event in manifest["events"]],
+                "context_types": manifest.get("context_types"),
+                "trigger_prefixes": manifest.get("trigger_prefixes"),
+            },
+        )
+        self.current_plugin_path = plugin_path
+        try:
+            kwargs = {k: manifest.get(k) for k in ["desc", "author", "version", "namecn", "hidden"]}
+            self.register(name, manifest.get("priority", 0), **kwargs)(plugincls)
+        finally:
+            self.current_plugin_path = None
+        self.load_stats[name.upper()] = {"lazy": True}
+
+    def load_lazy_plugin(self, name: str):
+        """
+        导入延迟加载的插件并生成实例，返回实例，失败时返回None
+        导入失败(如缺少依赖)只在本进程内移除占位实例，不写入plugins.json，安装依赖后重启即可恢复；初始化失败与activate_plugins一样禁用插件
+        插件注册时会替换掉占位的类，导入后按plugins.json恢复启用状态和优先级
+        """
+        name = name.upper()
+        with self.lazy_lock:
+            plugincls = self.plugins.get(name)
+            if plugincls is None or not plugincls.enabled:
+                return None
+            if not issubclass(plugincls, LazyPlugin):
+                return self.instances.get(name)
+            plugin_path = plugincls.path
+            if not self._import_plugin(os.path.basename(plugin_path), plugin_path) or issubclass(self.plugins[name], LazyPlugin):
+                logger.error("[PluginManager] lazy plugin %s failed to load, skipped until restart" % name)
+                self.instances.pop(name, None)
+                for event in self.listening_plugins:
+                    if name in self.listening_plugins[event]:
+                        self.listening_plugins[event].remove(name)
+                self._rebuild_dispatch()
+                return None
+            rawname = self.plugins[name].name
+            if rawname in self.pconf["plugins"]:
+                self.plugins[name].enabled = self.pconf["plugins"][rawname]["enabled"]
+                self.plugins[name].priority = self.pconf["plugins"][rawname]["priority"]
+                self.plugins._update_heap(name)
+            start = time.perf_counter()
+            try:
+                instance = self.plugins[name]()
+            except Exception as e:
+                logger.warn("Failed to init %s, diabled. %s" % (name, e))
+                self.disable_plugin(name)
+                return None
+            stats = self.load_stats.setdefault(name, {})
+            stats.update({"init": time.perf_counter() - start, "lazy": True})
+            logger.info("[PluginManager] lazy plugin %s loaded, %s" % (name, _format_load_stats(stats)))
+            self.instances[name] = instance
+            for event in instance.handlers:
+                if name not in self.listening_plugins.setdefault(event, []):
+                    self.listening_plugins[event].append(name)
+            self.refresh_order()
+            return instance
+
+    def format_load_report(self) -> str:
+        lines = ["插件加载耗时:"]
+        for name, plugincls in self.plugins.items():
+            stats = self.load_stats.get(name)
+            if stats is not None:
+                lines.append("{}: {}".format(plugincls.name, _format_load_stats(stats)))
+        return "\n".join(lines)
+
     def refresh_order(self):
         for event in self.listening_plugins.keys():
             self.listening_plugins[event].sort(key=lambda name: self.plugins[name].priority, reverse=True)
+        self._rebuild_dispatch()
+
+    def _rebuild_dispatch(self):
+        """
+        预先生成每个事件的处理函数列表，插件启用、禁用、重载或调整优先级时重建
+        整体替换字典，处理中的事件继续使用旧列表
+        """
+        dispatch = {}
+        for name, plugincls in self.plugins.items():
+            instance = self.instances.get(name)
+            if not plugincls.enabled or instance is None:
+                continue
+            for event, handler in instance.handlers.items():
+                dispatch.setdefault(event, []).append((name, handler))
+        self.dispatch = dispatch
 
     def activate_plugins(self):  # 生成新开启的插件实例
         failed_plugins = []
@@ -144,6 +278,7 @@ class PluginManager:
                 if 'GODCMD' in self.instances and name == 'GODCMD':
                     continue
                 # if name not in self.instances:
+                start = time.perf_counter()
                 try:
                     instance = plugincls()
                 except Exception as e:
@@ -151,13 +286,16 @@ class PluginManager:
                     self.disable_plugin(name)
                     failed_plugins.append(name)
                     continue
+                if not isinstance(instance, LazyPlugin):
+                    self.load_stats.setdefault(name, {})["init"] = time.perf_counter() - start
                 if name in self.instances:
                     self.instances[name].handlers.clear()
                 self.instances[name] = instance
                 for event in instance.handlers:
                     if event not in self.listening_plugins:
                         self.listening_plugins[event] = []
-                    self.listening_plugins[event].append(name)
+                    if name not in self.listening_plugins[event]:
+                        self.listening_plugins[event].append(name)
         self.refresh_order()
         return failed_plugins
 
@@ -171,7 +309,7 @@ class PluginManager:
             if name in self.instances:
                 self.instances[name].handlers.clear()
             del self.instances[name]
-            self.activate_plugins()
+            self.activate_plugins()  # 重新生成实例并重建事件处理列表
             return True
         return False
 
@@ -185,20 +323,64 @@ class PluginManager:
         for name, plugin in pconf["plugins"].items():
             if name.upper() not in self.plugins:
                 logger.error("Plugin %s not found, but found in plugins.json" % name)
+        self.set_profiling(conf().get("plugin_profile", False))
         self.activate_plugins()
+        logger.info(self.format_load_report())
 
     def emit_event(self, e_context: EventContext, *args, **kwargs):
-        if e_context.event in self.listening_plugins:
-            for name in self.listening_plugins[e_context.event]:
-                if self.plugins[name].enabled and e_context.action == EventAction.CONTINUE:
-                    logger.debug("Plugin %s triggered by event %s" % (name, e_context.event))
-                    instance = self.instances[name]
-                    instance.handlers[e_context.event](e_context, *args, **kwargs)
-                    if e_context.is_break():
-                        e_context["breaked_by"] = name
-                        logger.debug("Plugin %s breaked event %s" % (name, e_context.event))
+        handlers = self.dispatch.get(e_context.event)
+        if not handlers:
+            return e_context
+        if self.profiler is not None or metrics.is_enabled():
+            return self._emit_timed(handlers, e_context, *args, **kwargs)
+        for name, handler in handlers:
+            logger.debug("Plugin %s triggered by event %s", name, e_context.event)
+            handler(e_context, *args, **kwargs)
+            if e_context.is_break():
+                e_context["breaked_by"] = name
+                logger.debug("Plugin %s breaked event %s", name, e_context.event)
+                break
+        return e_context
+
+    def _emit_timed(self, handlers, e_context: EventContext, *args, **kwargs):
+        profiler = self.profiler
+        timed = metrics.is_enabled()
+        if timed:
+            labels = self._metric_labels(e_context)
+        event_start = time.perf_counter()
+        for name, handler in handlers:
+            logger.debug("Plugin %s triggered by event %s", name, e_context.event)
+            start = time.perf_counter()
+            try:
+                handler(e_context, *args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                if profiler is not None:
+                    profiler.record(name, e_context.event, elapsed)
+                if timed:
+                    metrics.observe(elapsed, labels[0], labels[1], plugin=name, ctype=labels[2])
+            if e_context.is_break():
+                e_context["breaked_by"] = name
+                logger.debug("Plugin %s breaked event %s", name, e_context.event)
+                break
+        if timed:
+            metrics.observe(time.perf_counter() - event_start, labels[0], labels[1], ctype=labels[2])
         return e_context
 
+    def set_profiling(self, enabled: bool):
+        """开启或关闭插件耗时统计，重复开启时保留已有的统计"""
+        if enabled and self.profiler is None:
+            self.profiler = PluginProfiler()
+        elif not enabled:
+            self.profiler = None
+
+    @staticmethod
+    def _metric_labels(e_context: EventContext):
+        # 阶段名为事件名，插件标签为空的记录表示该事件所有插件的总耗时
+        channel = e_context.econtext.get("channel")
+        context = e_context.econtext.get("context")
+        return e_context.event.name.lower(), getattr(channel, "channel_type", ""), context.type if context is not None else ""
+
     def set_plugin_priority(self, name: str, priority: int):
         name = name.upper()
         if name not in self.plugins:
@@ -238,6 +420,7 @@ class PluginManager:
             rawname = self.plugins[name].name
             self.pconf["plugins"][rawname]["enabled"] = False
             self.save_config()
+            self._rebuild_dispatch()
             return True
         return True
 
@@ -337,9 +520,98 @@ class PluginManager:
                     self.listening_plugins[event].remove(name)
             del self.plugins[name]
             del self.pconf["plugins"][rawname]
+            self.instances.pop(name, None)
+            self._rebuild_dispatch()
             self.loaded[dirname] = None
             self.save_config()
             return True, "卸载插件成功"
         except Exception as e:
             logger.error("Failed to uninstall plugin, {}".format(e))
             return False, "卸载插件失败，请手动删除文件夹完成卸载，" + str(e)
+
+
+class LazyPlugin(Plugin):
+    """
+    延迟加载插件的占位实例，由插件目录下的manifest.json生成:
+        name, priority, desc, version, author, namecn, hidden: 与plugins.register的参数相同
+        events: 监听的事件，如 ["ON_HANDLE_CONTEXT"]
+        context_types: 触发加载的消息类型，如 ["TEXT"]，不填表示所有类型
+        trigger_prefixes: 触发加载的消息前缀，{trigger_prefix}会替换为plugin_trigger_prefix，不填表示不限制
+    收到匹配的事件时导入真正的插件，并把本次事件交给它处理
+    """
+
+    manifest = {}
+    events = []
+    context_types = None
+    trigger_prefixes = None
+
+    def __init__(self):
+        super().__init__()
+        for event in self.events:
+            self.handlers[event] = self._make_handler(event)
+
+    def _make_handler(self, event):
+        def handler(e_context: EventContext, *args, **kwargs):
+            if not self._match(e_context):
+                return
+            instance = PluginManager().load_lazy_plugin(self.name)
+            if instance is not None and event in instance.handlers:
+                instance.handlers[event](e_context, *args, **kwargs)
+
+        return handler
+
+    def _match(self, e_context: EventContext):
+        context = e_context.econtext.get("context")
+        if context is None:
+            return True
+        if self.context_types and context.type.name not in self.context_types:
+            return False
+        if self.trigger_prefixes:
+            if not isinstance(context.content, str):
+                return False
+            trigger_prefix = conf().get("plugin_trigger_prefix", "$")
+            prefixes = tuple(prefix.replace("{trigger_prefix}", trigger_prefix) for prefix in self.trigger_prefixes)
+            return context.content.startswith(prefixes)
+        return True
+
+    def _loaded(self):
+        instance = PluginManager().instances.get(self.name.upper())
+        return instance if instance is not None and not isinstance(instance, LazyPlugin) else None
+
+    def get_help_text(self, verbose=False, **kwargs):
+        if not verbose:
+            return self.manifest.get("help") or self.desc or ""
+        instance = self._loaded() or PluginManager().load_lazy_plugin(self.name)
+        return instance.get_help_text(verbose=verbose, **kwargs) if instance is not None else "插件加载失败"
+
+    def reload(self):
+        # 未加载时无需处理，导入时会读取最新配置
+        instance = self._loaded()
+        if instance is not None:
+            instance.reload()
+
+
+def _current_rss_kb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except Exception:
+        try:
+            import resource
+
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # 非Linux系统只能取峰值
+        except Exception:
+            return 0
+
+
+def _format_load_stats(stats):
+    parts = []
+    if "import" in stats:
+        parts.append("import {:.1f}ms".format(stats["import"] * 1000))
+    if "init" in stats:
+        parts.append("init {:.1f}ms".format(stats["init"] * 1000))
+    if "rss" in stats:
+        parts.append("rss {:+d}KB".format(stats["rss"]))
+    if stats.get("lazy") and "import" not in stats:
+        parts.append("延迟加载，尚未导入")
+    return ", ".join(parts)
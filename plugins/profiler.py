@@ -0,0 +1,55 @@
+# encoding:utf-8
+
+import threading
+from collections import deque
+
+
+class PluginProfiler:
+    """
+    记录每个插件事件处理函数的调用次数和耗时，保留最近的样本用于计算分位数
+    :param max_samples: 每个处理函数保留的最近样本数
+    """
+
+    def __init__(self, max_samples=1024):
+        self.max_samples = max_samples
+        self.stats = {}  # (插件名, 事件) -> [调用次数, 总耗时, 最近样本]
+        self.lock = threading.Lock()
+
+    def record(self, name, event, seconds):
+        key = (name, event)
+        with self.lock:
+            stat = self.stats.get(key)
+            if stat is None:
+                stat = self.stats[key] = [0, 0.0, deque(maxlen=self.max_samples)]
+            stat[0] += 1
+            stat[1] += seconds
+            stat[2].append(seconds)
+
+    def reset(self):
+        with self.lock:
+            self.stats.clear()
+
+    def report(self):
+        """返回 [(插件名, 事件, 调用次数, p50, p99, 总耗时)]，按总耗时降序"""
+        with self.lock:
+            items = [(key, stat[0], stat[1], sorted(stat[2])) for key, stat in self.stats.items()]
+        rows = []
+        for (name, event), count, total, samples in items:
+            rows.append((name, event, count, _percentile(samples, 0.5), _percentile(samples, 0.99), total))
+        rows.sort(key=lambda row: row[5], reverse=True)
+        return rows
+
+    def format(self) -> str:
+        rows = self.report()
+        if not rows:
+            return "插件耗时统计: 暂无记录"
+        lines = ["插件耗时统计(毫秒):"]
+        for name, event, count, p50, p99, total in rows:
+            lines.append("{} {}: 调用 {}, p50 {:.2f}, p99 {:.2f}, 总计 {:.0f}".format(name, event.name.lower(), count, p50 * 1000, p99 * 1000, total * 1000))
+        return "\n".join(lines)
+
+
+def _percentile(samples, q):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
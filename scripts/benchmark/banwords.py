@@ -0,0 +1,121 @@
+# encoding:utf-8
+"""
+敏感词引擎基准测试，对比原WordsSearch与数组实现的ArrayWordsSearch
+每个引擎在独立子进程中运行，分别统计构建耗时、常驻内存增量和长文本扫描吞吐
+用法:
+    python scripts/benchmark/banwords.py --words 50000 --reply-len 2000
+    python scripts/benchmark/banwords.py --file plugins/banwords/banwords.txt
+"""
+
+import argparse
+import importlib.util
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+LIB_DIR = os.path.join(ROOT, "plugins", "banwords", "lib")
+
+
+def load_engine(module_name):
+    # 直接按路径加载，避免导入插件包时触发插件注册
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(LIB_DIR, module_name + ".py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return getattr(module, module_name)
+
+
+def rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def gen_words(count, seed):
+    rnd = random.Random(seed)
+    chars = [chr(c) for c in range(0x4E00, 0x4E00 + 3000)]
+    return ["".join(rnd.choice(chars) for _ in range(rnd.randint(2, 6))) for _ in range(count)]
+
+
+def gen_replies(count, length, seed):
+    rnd = random.Random(seed)
+    chars = [chr(c) for c in range(0x4E00, 0x4E00 + 3000)] + list("，。！？ abcdefg0123456789\n")
+    return ["".join(rnd.choice(chars) for _ in range(length)) for _ in range(count)]
+
+
+def run_engine(engine, words, replies, cache_path, queue):
+    cls = load_engine(engine)
+    base = rss_mb()
+    start = time.perf_counter()
+    search = cls()
+    search.SetKeywords(words)
+    build_s = time.perf_counter() - start
+    build_rss = rss_mb() - base
+    result = {"engine": engine, "build_s": build_s, "rss_mb": build_rss}
+
+    if cache_path:
+        search.Save(cache_path)
+        del search
+        base = rss_mb()
+        start = time.perf_counter()
+        search = cls.Load(cache_path, words)
+        result["load_s"] = time.perf_counter() - start
+        result["load_rss_mb"] = rss_mb() - base
+
+    total_chars = sum(len(r) for r in replies)
+    for name in ("ContainsAny", "FindFirst", "Replace"):
+        fn = getattr(search, name)
+        start = time.perf_counter()
+        for reply in replies:
+            fn(reply)
+        elapsed = time.perf_counter() - start
+        result[name] = total_chars / elapsed / 1e6
+    queue.put(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="banwords engine benchmark")
+    parser.add_argument("--words", type=int, default=50000, help="随机生成的敏感词数量")
+    parser.add_argument("--file", default="", help="使用真实词库文件，每行一个词")
+    parser.add_argument("--replies", type=int, default=200, help="扫描的回复条数")
+    parser.add_argument("--reply-len", type=int, default=2000, help="每条回复的字符数")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, encoding="utf-8") as f:
+            words = [line.strip() for line in f if line.strip()]
+    else:
+        words = gen_words(args.words, args.seed)
+    replies = gen_replies(args.replies, args.reply_len, args.seed + 1)
+    print("words={}, replies={}x{} chars".format(len(words), args.replies, args.reply_len))
+
+    tmp_dir = tempfile.mkdtemp()
+    for engine, cache in (("WordsSearch", None), ("ArrayWordsSearch", os.path.join(tmp_dir, "banwords.ac"))):
+        queue = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=run_engine, args=(engine, words, replies, cache, queue))
+        proc.start()
+        r = queue.get()
+        proc.join()
+        line = "{engine:<17} build {build_s:7.2f}s  rss +{rss_mb:7.1f}MB".format(**r)
+        if "load_s" in r:
+            line += "  mmap load {load_s:6.3f}s rss +{load_rss_mb:6.1f}MB".format(**r)
+        line += "  | ContainsAny {ContainsAny:5.2f}M chars/s  FindFirst {FindFirst:5.2f}M chars/s  Replace {Replace:5.2f}M chars/s".format(**r)
+        print(line)
+    for name in os.listdir(tmp_dir):
+        os.remove(os.path.join(tmp_dir, name))
+    os.rmdir(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# encoding:utf-8
+"""
+ChatChannel消息调度延迟基准测试
+
+统计从produce入队到_handle开始执行的延迟，用法:
+    python scripts/benchmark/chat_channel_dispatch.py --sessions 1000 10000 --messages 20000
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+from queue import Queue
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from bridge.context import Context, ContextType
+from channel.chat_channel import ChatChannel
+
+
+class BenchChannel(ChatChannel):
+    def __init__(self, total):
+        # 每轮测试使用独立的会话状态，避免上一轮的消费线程处理本轮消息
+        self.sessions = {}
+        self.futures = {}
+        self.ready_queue = Queue()
+        super().__init__()
+        self.total = total
+        self.latencies = []
+        self.done = threading.Event()
+        self.result_lock = threading.Lock()
+
+    def _handle(self, context: Context):
+        latency = time.perf_counter() - context["enqueue_time"]
+        with self.result_lock:
+            self.latencies.append(latency)
+            if len(self.latencies) >= self.total:
+                self.done.set()
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def run(session_cnt, message_cnt, rate):
+    channel = BenchChannel(message_cnt)
+    interval = 1 / rate if rate > 0 else 0
+    start = time.perf_counter()
+    for i in range(message_cnt):
+        if interval:
+            delay = start + i * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        context = Context(ContextType.TEXT, "hello", kwargs={"session_id": "session_{}".format(i % session_cnt)})
+        context["enqueue_time"] = time.perf_counter()
+        channel.produce(context)
+    if not channel.done.wait(timeout=max(60, message_cnt * interval * 2)):
+        print("timeout, handled {}/{}".format(len(channel.latencies), message_cnt))
+    elapsed = time.perf_counter() - start
+    latencies = [t * 1000 for t in channel.latencies]
+    print(
+        "sessions={:<6} messages={:<6} elapsed={:.2f}s  p50={:.3f}ms  p95={:.3f}ms  p99={:.3f}ms  max={:.3f}ms".format(
+            session_cnt,
+            len(latencies),
+            elapsed,
+            percentile(latencies, 50),
+            percentile(latencies, 95),
+            percentile(latencies, 99),
+            max(latencies) if latencies else 0.0,
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark enqueue-to-handle latency of ChatChannel")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1000, 10000], help="number of distinct session ids")
+    parser.add_argument("--messages", type=int, default=20000, help="number of messages per run")
+    parser.add_argument("--rate", type=float, default=5000, help="messages per second, 0 means burst")
+    args = parser.parse_args()
+    for n in args.sessions:
+        run(n, args.messages, args.rate)
@@ -0,0 +1,93 @@
+# encoding:utf-8
+"""
+ExpiredDict微基准测试，与旧版基于datetime的实现对比
+用法:
+    python scripts/benchmark/expired_dict.py --size 10000 100000
+"""
+
+import argparse
+import os
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from common.expired_dict import ExpiredDict
+
+
+class LegacyExpiredDict(dict):
+    """旧版实现，仅用于对比"""
+
+    def __init__(self, expires_in_seconds):
+        super().__init__()
+        self.expires_in_seconds = expires_in_seconds
+
+    def __getitem__(self, key):
+        value, expiry_time = super().__getitem__(key)
+        if datetime.now() > expiry_time:
+            del self[key]
+            raise KeyError("expired {}".format(key))
+        self.__setitem__(key, value)
+        return value
+
+    def __setitem__(self, key, value):
+        expiry_time = datetime.now() + timedelta(seconds=self.expires_in_seconds)
+        super().__setitem__(key, (value, expiry_time))
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def keys(self):
+        keys = list(super().keys())
+        return [key for key in keys if key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def __iter__(self):
+        return self.keys().__iter__()
+
+
+def bench(cls, size, number):
+    d = cls(3600)
+    for i in range(size):
+        d["msg_{}".format(i)] = True
+    key = "msg_{}".format(size // 2)
+    results = {
+        "set": timeit.timeit(lambda: d.__setitem__(key, True), number=number) / number,
+        "get": timeit.timeit(lambda: d.get(key), number=number) / number,
+        "contains": timeit.timeit(lambda: key in d, number=number) / number,
+        "keys": timeit.timeit(lambda: d.keys(), number=10) / 10,
+    }
+    # 短过期时间下持续写入不同的key，统计未被访问的过期key是否被清理
+    d = cls(0)
+    for i in range(size):
+        d["msg_{}".format(i)] = True
+    results["retained"] = dict.__len__(d)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark ExpiredDict against the legacy implementation")
+    parser.add_argument("--size", type=int, nargs="+", default=[10000, 100000], help="number of keys")
+    parser.add_argument("--number", type=int, default=100000, help="iterations of single key operations")
+    args = parser.parse_args()
+    for size in args.size:
+        for cls in [LegacyExpiredDict, ExpiredDict]:
+            r = bench(cls, size, args.number)
+            print(
+                "{:<18} size={:<7} set={:.3f}us  get={:.3f}us  contains={:.3f}us  keys={:.3f}ms  retained_after_expiry={}".format(
+                    cls.__name__, size, r["set"] * 1e6, r["get"] * 1e6, r["contains"] * 1e6, r["keys"] * 1e3, r["retained"]
+                )
+            )
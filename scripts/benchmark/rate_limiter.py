@@ -0,0 +1,103 @@
+# encoding:utf-8
+"""
+分层限流器微基准测试，与旧版每个令牌桶一个补充线程的实现对比
+用法:
+    python scripts/benchmark/rate_limiter.py --keys 10000 --number 200000
+"""
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from common.token_bucket import RateLimiter, TokenBucket, estimate_tokens
+
+
+class LegacyTokenBucket:
+    """旧版实现，仅用于对比"""
+
+    def __init__(self, tpm, timeout=None):
+        self.capacity = int(tpm)
+        self.tokens = 0
+        self.rate = int(tpm) / 60
+        self.timeout = timeout
+        self.cond = threading.Condition()
+        self.is_running = True
+        threading.Thread(target=self._generate_tokens, daemon=True).start()
+
+    def _generate_tokens(self):
+        while self.is_running:
+            with self.cond:
+                if self.tokens < self.capacity:
+                    self.tokens += 1
+                self.cond.notify()
+            time.sleep(1 / self.rate)
+
+    def get_token(self):
+        with self.cond:
+            while self.tokens <= 0:
+                if not self.cond.wait(self.timeout):
+                    return False
+            self.tokens -= 1
+        return True
+
+    def close(self):
+        self.is_running = False
+
+
+def bench_limiter(keys, number):
+    # 上层限额足够大，统计的主要是通过路径的开销
+    limiter = RateLimiter({"global": (10 ** 7, 10 ** 9), "bot": (10 ** 7, 10 ** 9), "group": (10 ** 6, 10 ** 8), "user": (20, 4000)})
+    messages = [{"role": "system", "content": "你是一个乐于助人的助手"}, {"role": "user", "content": "请问怎么退款？ how to refund"}]
+    cost = estimate_tokens(messages)
+    rnd = random.Random(0)
+    scopes = []
+    for _ in range(number):
+        user = rnd.randrange(keys)
+        scopes.append([("global", ""), ("bot", "chatGPT"), ("group", "group_{}".format(user % 100)), ("user", "user_{}".format(user))])
+    rejected = 0
+    start = time.perf_counter()
+    for scope in scopes:
+        if limiter.reserve(scope, cost, 10) is None:
+            rejected += 1
+    elapsed = time.perf_counter() - start
+    tracked = sum(len(t) for t in limiter.tables.values())
+    return elapsed / number, rejected, tracked
+
+
+def bench_estimate(number):
+    messages = [{"role": "user", "content": "你好，请介绍一下你自己。Please introduce yourself. " * 20}] * 10
+    start = time.perf_counter()
+    for _ in range(number):
+        estimate_tokens(messages)
+    return (time.perf_counter() - start) / number
+
+
+def bench_buckets(cls, count):
+    before = threading.active_count()
+    start = time.perf_counter()
+    buckets = [cls(60, 0) for _ in range(count)]
+    created = time.perf_counter() - start
+    threads = threading.active_count() - before
+    for bucket in buckets:
+        bucket.close()
+    return created, threads
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the hierarchical rate limiter")
+    parser.add_argument("--keys", type=int, nargs="+", default=[10000], help="number of distinct users")
+    parser.add_argument("--number", type=int, default=200000, help="number of reservations")
+    parser.add_argument("--buckets", type=int, default=200, help="number of per-key buckets created for the legacy comparison")
+    args = parser.parse_args()
+    for keys in args.keys:
+        per_op, rejected, tracked = bench_limiter(keys, args.number)
+        print("RateLimiter        keys={:<7} reserve={:.3f}us  rejected={}  tracked_buckets={}".format(keys, per_op * 1e6, rejected, tracked))
+    print("estimate_tokens    10 messages={:.3f}us".format(bench_estimate(10000) * 1e6))
+    for cls in [LegacyTokenBucket, TokenBucket]:
+        created, threads = bench_buckets(cls, args.buckets)
+        print("{:<18} buckets={:<5} create={:.3f}ms  threads={}".format(cls.__name__, args.buckets, created * 1e3, threads))
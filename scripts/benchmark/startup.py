@@ -0,0 +1,170 @@
+# encoding:utf-8
+"""
+各渠道的启动耗时基准测试
+每次在新进程中执行与app.py相同的启动流程(加载配置、创建渠道、加载插件)，到可以接收消息为止，不调用channel.startup()
+计时运行取中位数，另外用 python -X importtime 运行一次，列出耗时最多的顶层导入和启动时已导入的重量级依赖
+用法:
+    python scripts/benchmark/startup.py --channels terminal web wechatmp --repeat 5
+    python scripts/benchmark/startup.py --save startup.json
+    python scripts/benchmark/startup.py --compare startup.json --threshold 0.2
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+CHANNELS = ["terminal", "loadtest", "web", "wx", "wxy", "wechatmp", "wechatmp_service", "wechatcom_app", "wework", "feishu", "dingtalk"]
+
+# 应在第一次使用时才导入的依赖，启动完成时出现在sys.modules中说明被提前导入了
+HEAVY_MODULES = [
+    "openai",
+    "tiktoken",
+    "PIL",
+    "pydub",
+    "pysilk",
+    "pilk",
+    "requests",
+    "numpy",
+    "dashscope",
+    "zhipuai",
+    "broadscope_bailian",
+    "qianfan",
+    "google.generativeai",
+    "azure.cognitiveservices.speech",
+    "edge_tts",
+    "langid",
+]
+
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {root!r})
+import app
+app.load_config()
+app.prepare_channel({channel!r})
+ready = time.perf_counter() - start
+try:
+    with open("/proc/self/statm") as f:
+        rss_kb = int(f.read().split()[1]) * 4
+except OSError:
+    import resource
+    rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+heavy = [name for name in {heavy!r} if name in sys.modules]
+sys.__stdout__.write("\\n@@STARTUP@@" + json.dumps({{"ready": ready, "rss_kb": rss_kb, "heavy": heavy}}) + "\\n")
+sys.__stdout__.flush()
+"""
+
+
+def run_once(channel, importtime=False, timeout=120):
+    """
+    在新进程中启动一次，返回 (结果, -X importtime 输出)，启动失败时结果中带error
+    wall为从创建进程到可以接收消息的总耗时，包含解释器启动
+    """
+    command = [sys.executable]
+    if importtime:
+        command += ["-X", "importtime"]
+    command += ["-c", CHILD.format(root=ROOT, channel=channel, heavy=HEAVY_MODULES)]
+    env = dict(os.environ, CHANNEL_TYPE=channel)
+    start = time.perf_counter()
+    proc = subprocess.run(command, cwd=ROOT, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+    wall = time.perf_counter() - start
+    stdout = proc.stdout.decode("utf-8", "ignore")
+    stderr = proc.stderr.decode("utf-8", "ignore")
+    for line in stdout.splitlines():
+        if line.startswith("@@STARTUP@@"):
+            result = json.loads(line[len("@@STARTUP@@") :])
+            result["wall"] = wall
+            return result, stderr
+    error = [line for line in stderr.splitlines() if line and not line.startswith("import time:")]
+    return {"error": error[-1] if error else "exit code {}".format(proc.returncode)}, stderr
+
+
+def parse_importtime(stderr, top):
+    """返回耗时最多的顶层导入 [(模块, 累计微秒)]"""
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:") :].split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2]
+        if name.startswith("  "):  # 只统计顶层导入，缩进的是被其他模块间接导入的
+            continue
+        modules.append((name.strip(), int(parts[1])))
+    modules.sort(key=lambda item: item[1], reverse=True)
+    return modules[:top]
+
+
+def bench_channel(channel, repeat, top):
+    runs = []
+    for _ in range(repeat):
+        result, _ = run_once(channel)
+        if "error" in result:
+            return result
+        runs.append(result)
+    _, stderr = run_once(channel, importtime=True)
+    return {
+        "wall": statistics.median(run["wall"] for run in runs),
+        "ready": statistics.median(run["ready"] for run in runs),
+        "rss_kb": statistics.median(run["rss_kb"] for run in runs),
+        "heavy": runs[-1]["heavy"],
+        "imports": parse_importtime(stderr, top),
+    }
+
+
+def compare(results, baseline, threshold):
+    """与保存的结果对比，返回变慢超过阈值的渠道"""
+    regressions = []
+    for channel, result in results.items():
+        base = baseline.get(channel)
+        if "error" in result or base is None or "error" in base:
+            continue
+        change = result["wall"] / base["wall"] - 1
+        print("{:<18} wall {:.0f}ms -> {:.0f}ms ({:+.0%})".format(channel, base["wall"] * 1000, result["wall"] * 1000, change))
+        if change > threshold:
+            regressions.append(channel)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark time-to-ready of app.py for each channel_type")
+    parser.add_argument("--channels", nargs="+", default=CHANNELS, help="channel types to start")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per channel, the median is reported")
+    parser.add_argument("--top", type=int, default=8, help="number of top-level imports listed from -X importtime")
+    parser.add_argument("--save", help="write results to this json file")
+    parser.add_argument("--compare", help="compare with a json file written by --save")
+    parser.add_argument("--threshold", type=float, default=0.2, help="slowdown ratio treated as a regression")
+    args = parser.parse_args()
+
+    results = {}
+    for channel in args.channels:
+        result = bench_channel(channel, args.repeat, args.top)
+        results[channel] = result
+        if "error" in result:
+            print("{:<18} unavailable: {}".format(channel, result["error"]))
+            continue
+        print(
+            "{:<18} wall={:.0f}ms  ready={:.0f}ms  rss={:.1f}MB  heavy={}".format(
+                channel, result["wall"] * 1000, result["ready"] * 1000, result["rss_kb"] / 1024, ",".join(result["heavy"]) or "-"
+            )
+        )
+        for name, cumulative in result["imports"]:
+            print("    {:<40} {:.1f}ms".format(name, cumulative / 1000))
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("regression: {}".format(", ".join(regressions)))
+            sys.exit(1)
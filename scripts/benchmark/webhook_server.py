@@ -0,0 +1,144 @@
+# encoding:utf-8
+"""
+webhook渠道HTTP服务基准测试，对比不同http_server后端在/wx和/message上的每秒请求数
+服务端在子进程中运行:
+    /wx: 公众号服务器校验，与passive_reply.Query.GET相同，调用verify_server校验签名
+    /message: web渠道的WebChannel.post_message，消息进入队列后不调用模型
+用法:
+    python scripts/benchmark/webhook_server.py --backend simple threaded async --concurrency 64 --requests 5000
+"""
+
+import argparse
+import hashlib
+import http.client
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+sys.path.insert(0, ROOT)
+
+TOKEN = "benchmark"
+
+
+def run_server(backend, port, threads, ready):
+    import config
+
+    config.config = config.Config({"http_server": backend, "http_server_threads": threads, "wechatmp_token": TOKEN, "debug": False})
+    from common.log import logger
+
+    logger.setLevel("WARN")
+    sys.stderr = open(os.devnull, "w")  # simple后端会把每个请求打印到stderr
+    import web
+
+    from channel.web.web_channel import WebChannel
+    from channel.wechatmp.common import verify_server
+    from common.http_server import serve_wsgi
+
+    channel = WebChannel()
+    channel.produce = lambda context: None  # 只测量HTTP处理，不进入消息处理流程
+
+    class WxHandler:
+        def GET(self):
+            return verify_server(web.input())
+
+    class MessageHandler:
+        def POST(self):
+            return channel.post_message()
+
+    app = web.application(("/wx", "WxHandler", "/message", "MessageHandler"), {"WxHandler": WxHandler, "MessageHandler": MessageHandler}, autoreload=False)
+    ready.set()
+    serve_wsgi(app.wsgifunc(), port, host="127.0.0.1")
+
+
+def wx_request():
+    timestamp, nonce = str(int(time.time())), "123456"
+    signature = hashlib.sha1("".join(sorted([TOKEN, timestamp, nonce])).encode()).hexdigest()
+    return "GET", "/wx?signature={}&timestamp={}&nonce={}&echostr=hello".format(signature, timestamp, nonce), None
+
+
+def message_request():
+    return "POST", "/message", json.dumps({"user_id": "bench", "message": "hello"})
+
+
+def run_client(port, endpoint, total, concurrency):
+    make = wx_request if endpoint == "wx" else message_request
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    counter = [0]
+
+    def worker():
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        local = []
+        while True:
+            with lock:
+                if counter[0] >= total:
+                    break
+                counter[0] += 1
+            method, path, body = make()
+            start = time.perf_counter()
+            try:
+                conn.request(method, path, body=body, headers={"Content-Type": "application/json"})
+                resp = conn.getresponse()
+                resp.read()
+                if resp.status != 200:
+                    errors[0] += 1
+                if resp.getheader("Connection", "").lower() == "close":
+                    conn.close()
+                    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+            except Exception:
+                errors[0] += 1
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+            local.append(time.perf_counter() - start)
+        conn.close()
+        with lock:
+            latencies.extend(local)
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "rps": len(latencies) / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000,
+        "errors": errors[0],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="webhook http server benchmark")
+    parser.add_argument("--backend", nargs="+", default=["simple", "threaded", "async"])
+    parser.add_argument("--endpoint", nargs="+", default=["wx", "message"])
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--threads", type=int, default=32, help="服务端线程数，simple后端固定为10")
+    parser.add_argument("--port", type=int, default=18080)
+    args = parser.parse_args()
+
+    for i, backend in enumerate(args.backend):
+        port = args.port + i
+        ready = multiprocessing.Event()
+        proc = multiprocessing.Process(target=run_server, args=(backend, port, args.threads, ready), daemon=True)
+        proc.start()
+        ready.wait(30)
+        time.sleep(1)
+        for endpoint in args.endpoint:
+            run_client(port, endpoint, min(200, args.requests), 8)  # 预热
+            r = run_client(port, endpoint, args.requests, args.concurrency)
+            print("{:<9} /{:<8} {:8.0f} req/s  p50 {:6.1f}ms  p99 {:7.1f}ms  errors {}".format(backend, endpoint, r["rps"], r["p50_ms"], r["p99_ms"], r["errors"]))
+        proc.terminate()
+        proc.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import threading
+
+import pytest
+
+from bot import session_store
+from bot.session_store import RedisSessionStore, WriteBehindSessionStore, create_session_store
+from config import Config, _swap_config, conf
+
+
+@pytest.fixture
+def config():
+    old = conf()
+    yield lambda **kwargs: _swap_config(Config(kwargs))
+    _swap_config(old)
+    session_store._stores.clear()
+
+
+class BlockingStore(WriteBehindSessionStore):
+    """写入时阻塞直到release被设置，用于观察写入过程中的状态"""
+
+    def __init__(self):
+        self.rows = {}
+        self.writing = threading.Event()
+        self.release = threading.Event()
+        super().__init__(flush_interval=3600)
+
+    def _read(self, session_id):
+        return self.rows.get(session_id)
+
+    def _write(self, items, deleted):
+        self.writing.set()
+        self.release.wait(5)
+        self.rows.update(items)
+        for k in deleted:
+            self.rows.pop(k, None)
+
+    def _clear(self):
+        self.rows.clear()
+
+
+def test_write_behind_load_sees_inflight_batch():
+    store = BlockingStore()
+    store.rows["u1"] = '{"messages": []}'
+    store.save("u1", {"messages": [1]})
+    flush = threading.Thread(target=store.flush)
+    flush.start()
+    assert store.writing.wait(5)
+    assert store.load("u1") == {"messages": [1]}
+    store.release.set()
+    flush.join()
+    assert store.load("u1") == {"messages": [1]}
+
+
+def test_write_behind_clear_waits_for_inflight_batch():
+    store = BlockingStore()
+    store.save("u1", {"messages": [1]})
+    flush = threading.Thread(target=store.flush)
+    flush.start()
+    assert store.writing.wait(5)
+    clear = threading.Thread(target=store.clear)
+    clear.start()
+    store.release.set()
+    flush.join()
+    clear.join()
+    assert store.load("u1") is None
+    assert store.rows == {}
+
+
+def test_redis_store_round_trip():
+    fakeredis = pytest.importorskip("fakeredis")
+    client = fakeredis.FakeRedis()
+    store = RedisSessionStore("ChatGPTSession", client=client, expires_in_seconds=60, flush_interval=3600)
+    data = {"system_prompt": "prompt", "messages": [{"role": "user", "content": "你好"}]}
+
+    store.save("u1", data)
+    assert client.get("cow:session:ChatGPTSession:u1") is None  # 写入先进入待写队列
+    assert store.load("u1") == data
+
+    store.flush()
+    assert store.load("u1") == data
+    assert 0 < client.ttl("cow:session:ChatGPTSession:u1") <= 60
+
+    store.delete("u1")
+    assert store.load("u1") is None
+    store.flush()
+    assert client.get("cow:session:ChatGPTSession:u1") is None
+
+
+def test_redis_store_clear_keeps_other_namespaces():
+    fakeredis = pytest.importorskip("fakeredis")
+    client = fakeredis.FakeRedis()
+    chat = RedisSessionStore("ChatGPTSession", client=client, flush_interval=3600)
+    other = RedisSessionStore("BaiduWenxinSession", client=client, flush_interval=3600)
+    chat.save("u1", {"messages": []})
+    other.save("u1", {"messages": []})
+    chat.flush()
+    other.flush()
+
+    chat.clear()
+    assert chat.load("u1") is None
+    assert other.load("u1") == {"messages": []}
+
+
+def test_create_session_store_reuses_store(config, tmp_path):
+    config(session_store="sqlite", session_store_path=str(tmp_path / "sessions.db"), expires_in_seconds=60)
+    store = create_session_store("ChatGPTSession")
+    assert create_session_store("ChatGPTSession") is store
+    assert create_session_store("BaiduWenxinSession") is not store
+
+    config(session_store="sqlite", session_store_path=str(tmp_path / "sessions.db"), expires_in_seconds=120)
+    assert create_session_store("ChatGPTSession") is store
+    assert store.expires_in_seconds == 120
@@ -15,7 +15,8 @@ import time
 
 from bridge.reply import Reply, ReplyType
 from common.log import logger
-from voice.audio_convert import get_pcm_from_wav
+from common.token_cache import get_access_token
+from voice.audio_convert import load_audio
 from voice.voice import Voice
 from voice.ali.ali_api import AliyunTokenGenerator, speech_to_text_aliyun, text_to_speech_aliyun
 from config import conf
@@ -31,8 +32,6 @@ class AliVoice(Voice):
             config_path = os.path.join(curdir, "config.json")
             with open(config_path, "r") as fr:
                 config = json.load(fr)
-            self.token = None
-            self.token_expire_time = 0
             # 默认复用阿里云千问的 access_key 和 access_secret
             self.api_url_voice_to_text = config.get("api_url_voice_to_text")
             self.api_url_text_to_voice = config.get("api_url_text_to_voice")
@@ -42,6 +41,9 @@ class AliVoice(Voice):
         except Exception as e:
             logger.warn("AliVoice init failed: %s, ignore " % e)
 
+    def tts_voice_key(self):
+        return "{}:{}".format(self.api_url_text_to_voice, self.app_key)
+
     def textToVoice(self, text):
         """
         将文本转换为语音文件。
@@ -72,7 +74,7 @@ class AliVoice(Voice):
         # 提取有效的token
         token_id = self.get_valid_token()
         logger.debug("[Ali] voice file name={}".format(voice_file))
-        pcm = get_pcm_from_wav(voice_file)
+        pcm = load_audio(voice_file, self.asr_sample_rate).pcm
         text = speech_to_text_aliyun(self.api_url_voice_to_text, pcm, self.app_key, token_id)
         if text:
             logger.info("[Ali] VoicetoText = {}".format(text))
@@ -87,15 +89,11 @@ class AliVoice(Voice):
 
         :return: 返回有效的token字符串。
         """
-        current_time = time.time()
-        if self.token is None or current_time >= self.token_expire_time:
-            get_token = AliyunTokenGenerator(self.access_key_id, self.access_key_secret)
-            token_str = get_token.get_token()
-            token_data = json.loads(token_str)
-            self.token = token_data["Token"]["Id"]
-            # 将过期时间减少一小段时间（例如5分钟），以避免在边界条件下的过期
-            self.token_expire_time = token_data["Token"]["ExpireTime"] - 300
-            logger.debug(f"新获取的阿里云token：{self.token}")
-        else:
-            logger.debug("使用缓存的token")
-        return self.token
+        return get_access_token("aliyun_nls", (self.access_key_id, self.access_key_secret), self._fetch_token)
+
+    def _fetch_token(self):
+        get_token = AliyunTokenGenerator(self.access_key_id, self.access_key_secret)
+        token_data = json.loads(get_token.get_token())
+        logger.debug("新获取的阿里云token：{}".format(token_data["Token"]["Id"]))
+        # ExpireTime为过期时间戳，提前刷新由token缓存处理
+        return token_data["Token"]["Id"], token_data["Token"]["ExpireTime"] - time.time()
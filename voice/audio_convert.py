@@ -1,16 +1,146 @@
+import io
+import multiprocessing
+import os
 import shutil
+import subprocess
+import threading
 import wave
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 from common.log import logger
+from config import conf
 
-try:
-    import pysilk
-except ImportError:
-    logger.debug("import pysilk failed, wechaty voice message will not be supported.")
+# pydub、pysilk只在转码时导入，未收到语音消息时不拖慢启动，未安装pysilk时仅silk格式不可用
+sil_supports = [8000, 12000, 16000, 24000, 32000, 44100, 48000]  # slk转wav时，支持的采样率
+silk_suffixes = (".sil", ".silk", ".slk")
 
-from pydub import AudioSegment
 
-sil_supports = [8000, 12000, 16000, 24000, 32000, 44100, 48000]  # slk转wav时，支持的采样率
+class AudioBuffer:
+    """
+    内存中的PCM音频，16位有符号小端
+    语音识别直接使用pcm，或通过wav_bytes/wav_file得到wav格式，不再落盘
+    """
+
+    sample_width = 2
+
+    def __init__(self, pcm: bytes, sample_rate: int, channels: int = 1, name: str = "voice"):
+        self.pcm = pcm
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.name = name
+
+    def __repr__(self):
+        return "AudioBuffer(name={}, sample_rate={}, channels={}, duration_ms={})".format(self.name, self.sample_rate, self.channels, self.duration_ms)
+
+    @property
+    def duration_ms(self):
+        return len(self.pcm) * 1000 // (self.sample_rate * self.channels * self.sample_width)
+
+    def wav_bytes(self) -> bytes:
+        buf = io.BytesIO()
+        with wave.open(buf, "wb") as wav:
+            wav.setnchannels(self.channels)
+            wav.setsampwidth(self.sample_width)
+            wav.setframerate(self.sample_rate)
+            wav.writeframes(self.pcm)
+        return buf.getvalue()
+
+    def wav_file(self) -> io.BytesIO:
+        """wav格式的文件对象，带name属性，可直接用于multipart上传和wave.open"""
+        buf = io.BytesIO(self.wav_bytes())
+        buf.name = self.name + ".wav"
+        return buf
+
+
+def _decode_pcm(source, suffix, sample_rate, channels, timeout):
+    """
+    解码为指定采样率和声道数的pcm，在转码进程池中执行
+    :param source: 文件路径或音频数据
+    :param suffix: 音频格式的扩展名，如 .silk .amr .mp3
+    """
+    if suffix in silk_suffixes:
+        import pysilk
+
+        if isinstance(source, bytes):
+            data = source
+        else:
+            with open(source, "rb") as f:
+                data = f.read()
+        pcm = pysilk.decode(data, to_wav=False, sample_rate=sample_rate)
+        if channels == 1:
+            return pcm
+        source, suffix = AudioBuffer(pcm, sample_rate).wav_bytes(), ".wav"
+    if suffix == ".wav":
+        with wave.open(io.BytesIO(source) if isinstance(source, bytes) else source, "rb") as wav:
+            if wav.getframerate() == sample_rate and wav.getnchannels() == channels and wav.getsampwidth() == 2:
+                return wav.readframes(wav.getnframes())
+    # ffmpeg一次完成解码、重采样和声道转换，输入输出都走管道
+    from pydub import AudioSegment
+
+    command = [AudioSegment.converter, "-hide_banner", "-loglevel", "error"]
+    command += ["-i", "pipe:0" if isinstance(source, bytes) else source]
+    command += ["-f", "s16le", "-acodec", "pcm_s16le", "-ac", str(channels), "-ar", str(sample_rate), "pipe:1"]
+    result = subprocess.run(
+        command, input=source if isinstance(source, bytes) else None, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout, check=False
+    )
+    if result.returncode != 0:
+        raise RuntimeError("ffmpeg decode failed: {}".format(result.stderr.decode("utf-8", "ignore").strip()))
+    return result.stdout
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                workers = conf().get("audio_transcode_workers", 2)
+                if workers <= 0:
+                    return None
+                # spawn避免在多线程进程中fork
+                _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def decode_audio(source, sample_rate=16000, channels=1, suffix=None) -> AudioBuffer:
+    """
+    把语音文件或数据解码为内存中的pcm，转码在有上限的进程池中执行，不占用消息处理线程的CPU
+    :param source: 文件路径或音频数据
+    :param suffix: source为数据时的格式扩展名
+    """
+    global _pool
+    if suffix is None:
+        suffix = os.path.splitext(source)[1] if isinstance(source, str) else ".wav"
+    suffix = suffix.lower()
+    name = os.path.splitext(os.path.basename(source))[0] if isinstance(source, str) else "voice"
+    timeout = conf().get("audio_transcode_timeout", 30)
+    args = (source, suffix, sample_rate, channels, timeout)
+    pool = _get_pool()
+    if pool is None:
+        pcm = _decode_pcm(*args)
+    else:
+        try:
+            pcm = pool.submit(_decode_pcm, *args).result(timeout + 5)
+        except BrokenProcessPool:
+            logger.warning("[audio] transcode pool broken, recreate it")
+            with _pool_lock:
+                if _pool is pool:
+                    _pool = None
+            pcm = _decode_pcm(*args)
+    return AudioBuffer(pcm, sample_rate, channels, name)
+
+
+def load_audio(voice, sample_rate=16000, channels=1) -> AudioBuffer:
+    """语音识别实现的入口，voice可以是AudioBuffer或文件路径，格式不符时重新转码"""
+    if isinstance(voice, AudioBuffer):
+        if voice.sample_rate == sample_rate and voice.channels == channels:
+            return voice
+        return decode_audio(voice.wav_bytes(), sample_rate, channels, suffix=".wav")
+    return decode_audio(voice, sample_rate, channels)
 
 
 def find_closest_sil_supports(sample_rate):
@@ -50,6 +180,8 @@ def any_to_mp3(any_path, mp3_path):
     if any_path.endswith(".sil") or any_path.endswith(".silk") or any_path.endswith(".slk"):
         sil_to_wav(any_path, any_path)
         any_path = mp3_path
+    from pydub import AudioSegment
+
     audio = AudioSegment.from_file(any_path)
     audio.export(mp3_path, format="mp3")
 
@@ -61,12 +193,10 @@ def any_to_wav(any_path, wav_path):
     if any_path.endswith(".wav"):
         shutil.copy2(any_path, wav_path)
         return
-    if any_path.endswith(".sil") or any_path.endswith(".silk") or any_path.endswith(".slk"):
-        return sil_to_wav(any_path, wav_path)
-    audio = AudioSegment.from_file(any_path)
-    audio.set_frame_rate(8000)    # 百度语音转写支持8000采样率, pcm_s16le, 单通道语音识别
-    audio.set_channels(1)
-    audio.export(wav_path, format="wav", codec='pcm_s16le')
+    # 16000采样率, pcm_s16le, 单通道，与语音识别接口一致
+    audio = decode_audio(any_path, 16000, 1)
+    with open(wav_path, "wb") as f:
+        f.write(audio.wav_bytes())
 
 
 def any_to_sil(any_path, sil_path):
@@ -76,6 +206,9 @@ def any_to_sil(any_path, sil_path):
     if any_path.endswith(".sil") or any_path.endswith(".silk") or any_path.endswith(".slk"):
         shutil.copy2(any_path, sil_path)
         return 10000
+    import pysilk
+    from pydub import AudioSegment
+
     audio = AudioSegment.from_file(any_path)
     rate = find_closest_sil_supports(audio.frame_rate)
     # Convert to PCM_s16
@@ -97,6 +230,8 @@ def any_to_amr(any_path, amr_path):
         return
     if any_path.endswith(".sil") or any_path.endswith(".silk") or any_path.endswith(".slk"):
         raise NotImplementedError("Not support file type: {}".format(any_path))
+    from pydub import AudioSegment
+
     audio = AudioSegment.from_file(any_path)
     audio = audio.set_frame_rate(8000)  # only support 8000
     audio.export(amr_path, format="amr")
@@ -107,6 +242,8 @@ def sil_to_wav(silk_path, wav_path, rate: int = 24000):
     """
     silk 文件转 wav
     """
+    import pysilk
+
     wav_data = pysilk.decode_file(silk_path, to_wav=True, sample_rate=rate)
     with open(wav_path, "wb") as f:
         f.write(wav_data)
@@ -116,6 +253,8 @@ def split_audio(file_path, max_segment_length_ms=60000):
     """
     分割音频文件
     """
+    from pydub import AudioSegment
+
     audio = AudioSegment.from_file(file_path)
     audio_length_ms = len(audio)
     if audio_length_ms <= max_segment_length_ms:
@@ -12,6 +12,7 @@ from bridge.reply import Reply, ReplyType
 from common.log import logger
 from common.tmp_dir import TmpDir
 from config import conf
+from voice.audio_convert import AudioBuffer
 from voice.voice import Voice
 
 """
@@ -57,7 +58,15 @@ class AzureVoice(Voice):
             logger.warn("AzureVoice init failed: %s, ignore " % e)
 
     def voiceToText(self, voice_file):
-        audio_config = speechsdk.AudioConfig(filename=voice_file)
+        if isinstance(voice_file, AudioBuffer):
+            # 直接推送内存中的pcm，不经过文件
+            stream_format = speechsdk.audio.AudioStreamFormat(samples_per_second=voice_file.sample_rate, bits_per_sample=16, channels=voice_file.channels)
+            stream = speechsdk.audio.PushAudioInputStream(stream_format=stream_format)
+            stream.write(voice_file.pcm)
+            stream.close()
+            audio_config = speechsdk.AudioConfig(stream=stream)
+        else:
+            audio_config = speechsdk.AudioConfig(filename=voice_file)
         speech_recognizer = speechsdk.SpeechRecognizer(speech_config=self.speech_config, audio_config=audio_config)
         result = speech_recognizer.recognize_once()
         if result.reason == speechsdk.ResultReason.RecognizedSpeech:
@@ -69,6 +78,10 @@ class AzureVoice(Voice):
             reply = Reply(ReplyType.ERROR, "抱歉，语音识别失败")
         return reply
 
+    def tts_voice_key(self):
+        # 自动识别语言时音色由文本决定，文本已在缓存key中
+        return json.dumps({k: v for k, v in self.config.items() if k == "auto_detect" or k.startswith("speech_synthesis")}, sort_keys=True)
+
     def textToVoice(self, text):
         if self.config.get("auto_detect"):
             lang = classify(text)[0]
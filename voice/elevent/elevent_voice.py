@@ -20,6 +20,9 @@ class ElevenLabsVoice(Voice):
     def voiceToText(self, voice_file):
         pass
 
+    def tts_voice_key(self):
+        return "{}:eleven_multilingual_v2".format(name)
+
     def textToVoice(self, text):
         audio = client.generate(
             text=text,
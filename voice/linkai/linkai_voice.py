@@ -2,7 +2,7 @@
 google voice service
 """
 import random
-import requests
+from common import http_client
 from voice import audio_convert
 from bridge.reply import Reply, ReplyType
 from common.log import logger
@@ -24,21 +24,24 @@ class LinkAIVoice(Voice):
             model = None
             if not conf().get("text_to_voice") or conf().get("voice_to_text") == "openai":
                 model = const.WHISPER_1
-            if voice_file.endswith(".amr"):
-                try:
-                    mp3_file = os.path.splitext(voice_file)[0] + ".mp3"
-                    audio_convert.any_to_mp3(voice_file, mp3_file)
-                    voice_file = mp3_file
-                except Exception as e:
-                    logger.warn(f"[LinkVoice] amr file transfer failed, directly send amr voice file: {format(e)}")
-            file = open(voice_file, "rb")
+            if isinstance(voice_file, audio_convert.AudioBuffer):
+                file = voice_file.wav_file()
+            else:
+                if voice_file.endswith(".amr"):
+                    try:
+                        mp3_file = os.path.splitext(voice_file)[0] + ".mp3"
+                        audio_convert.any_to_mp3(voice_file, mp3_file)
+                        voice_file = mp3_file
+                    except Exception as e:
+                        logger.warn(f"[LinkVoice] amr file transfer failed, directly send amr voice file: {format(e)}")
+                file = open(voice_file, "rb")
             file_body = {
                 "file": file
             }
             data = {
                 "model": model
             }
-            res = requests.post(url, files=file_body, headers=headers, data=data, timeout=(5, 60))
+            res = http_client.post(url, files=file_body, headers=headers, data=data, timeout=(5, 60))
             if res.status_code == 200:
                 text = res.json().get("text")
             else:
@@ -52,6 +55,12 @@ class LinkAIVoice(Voice):
             return None
         return reply
 
+    def tts_voice_key(self):
+        model = const.TTS_1
+        if not conf().get("text_to_voice") or conf().get("text_to_voice") in ["openai", const.TTS_1, const.TTS_1_HD]:
+            model = conf().get("text_to_voice_model") or const.TTS_1
+        return "{}:{}:{}".format(model, conf().get("tts_voice_id"), conf().get("linkai_app_code"))
+
     def textToVoice(self, text):
         try:
             url = conf().get("linkai_api_base", "https://api.link-ai.tech") + "/v1/audio/speech"
@@ -65,7 +74,7 @@ class LinkAIVoice(Voice):
                 "voice": conf().get("tts_voice_id"),
                 "app_code": conf().get("linkai_app_code")
             }
-            res = requests.post(url, headers=headers, json=data, timeout=(5, 120))
+            res = http_client.post(url, headers=headers, json=data, timeout=(5, 120))
             if res.status_code == 200:
                 tmp_file_name = "tmp/" + datetime.datetime.now().strftime('%Y%m%d%H%M%S') + str(random.randint(0, 1000)) + ".mp3"
                 with open(tmp_file_name, 'wb') as f:
@@ -8,8 +8,9 @@ import openai
 from bridge.reply import Reply, ReplyType
 from common.log import logger
 from config import conf
+from voice.audio_convert import AudioBuffer
 from voice.voice import Voice
-import requests
+from common import http_client
 from common import const
 import datetime, random
 
@@ -20,7 +21,7 @@ class OpenaiVoice(Voice):
     def voiceToText(self, voice_file):
         logger.debug("[Openai] voice file name={}".format(voice_file))
         try:
-            file = open(voice_file, "rb")
+            file = voice_file.wav_file() if isinstance(voice_file, AudioBuffer) else open(voice_file, "rb")
             api_base = conf().get("open_ai_api_base") or "https://api.openai.com/v1"
             url = f'{api_base}/audio/transcriptions'
             headers = {
@@ -33,7 +34,7 @@ class OpenaiVoice(Voice):
             data = {
                 "model": "whisper-1",
             }
-            response = requests.post(url, headers=headers, files=files, data=data)
+            response = http_client.post(url, headers=headers, files=files, data=data)
             response_data = response.json()
             text = response_data['text']
             reply = Reply(ReplyType.TEXT, text)
@@ -44,6 +45,9 @@ class OpenaiVoice(Voice):
             return reply
 
 
+    def tts_voice_key(self):
+        return "{}:{}".format(conf().get("text_to_voice_model") or const.TTS_1, conf().get("tts_voice_id") or "alloy")
+
     def textToVoice(self, text):
         try:
             api_base = conf().get("open_ai_api_base") or "https://api.openai.com/v1"
@@ -57,7 +61,7 @@ class OpenaiVoice(Voice):
                 'input': text,
                 'voice': conf().get("tts_voice_id") or "alloy"
             }
-            response = requests.post(url, headers=headers, json=data)
+            response = http_client.post(url, headers=headers, json=data)
             file_name = "tmp/" + datetime.datetime.now().strftime('%Y%m%d%H%M%S') + str(random.randint(0, 1000)) + ".mp3"
             logger.debug(f"[OPENAI] text_to_Voice file_name={file_name}, input={text}")
             with open(file_name, 'wb') as f:
@@ -0,0 +1,166 @@
+"""
+语音合成结果缓存，所有语音合成引擎共用
+以 (引擎, 音色参数, 文本摘要) 为key把合成的语音保存在磁盘上，总大小超过上限时淘汰最久未使用的文件
+渠道发送后通常会删除语音文件，命中时返回缓存文件的副本
+"""
+
+import hashlib
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from bridge.reply import Reply, ReplyType
+from common.log import logger
+from common.tmp_dir import TmpDir
+from config import conf, get_appdata_dir
+
+
+class TTSCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (文件名, 大小)，按最近使用排序
+        self.total = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    @staticmethod
+    def make_key(provider, voice_key, text):
+        return hashlib.sha256("\n".join([provider, voice_key, text]).encode("utf-8")).hexdigest()[:32]
+
+    def get(self, key):
+        """命中时返回缓存文件的副本路径，未命中返回None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        filename = entry[0]
+        path = os.path.join(self.directory, filename)
+        copy_path = TmpDir().path() + "reply-" + str(int(time.time())) + "-" + uuid.uuid4().hex[:12] + os.path.splitext(filename)[1]
+        try:
+            shutil.copyfile(path, copy_path)
+            os.utime(path)  # 重启后按修改时间恢复使用顺序
+        except OSError as e:
+            logger.warning("[TTSCache] read cache failed: {}".format(e))
+            self._remove(key)
+            return None
+        return copy_path
+
+    def put(self, key, voice_path):
+        filename = key + os.path.splitext(voice_path)[1]
+        path = os.path.join(self.directory, filename)
+        tmp_path = "{}.{}.tmp".format(path, uuid.uuid4().hex[:8])
+        try:
+            shutil.copyfile(voice_path, tmp_path)
+            os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+        except OSError as e:
+            logger.warning("[TTSCache] write cache failed: {}".format(e))
+            return
+        self._add(key, filename, size)
+
+    def _add(self, key, filename, size):
+        evicted = []
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.total -= old[1]
+            self.entries[key] = (filename, size)
+            self.total += size
+            while self.total > self.max_bytes and len(self.entries) > 1:
+                _, (old_name, old_size) = self.entries.popitem(last=False)
+                self.total -= old_size
+                evicted.append(old_name)
+        for name in evicted:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    def _remove(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.total -= entry[1]
+
+    def _scan(self):
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".tmp"):
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            files.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(files):
+            self._add(os.path.splitext(name)[0], name, size)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0,
+            "files": len(self.entries),
+            "bytes": self.total,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_tts_cache():
+    """返回全局缓存，tts_cache_max_size为0时返回None"""
+    global _cache
+    max_size = conf().get("tts_cache_max_size", 100)
+    if not max_size:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                directory = conf().get("tts_cache_dir") or os.path.join(get_appdata_dir(), "tts_cache")
+                _cache = TTSCache(directory, max_size * 1024 * 1024)
+    return _cache
+
+
+def cached_text_to_voice(voice, provider, text) -> Reply:
+    """
+    先查缓存，未命中时调用引擎合成并写入缓存
+    :param voice: 语音合成引擎实例
+    :param provider: 引擎名称，如 openai、azure
+    """
+    cache = get_tts_cache()
+    try:
+        voice_key = voice.tts_voice_key()
+    except Exception as e:  # 引擎初始化失败时没有音色参数，交给引擎自行报错
+        logger.debug("[TTSCache] get voice key failed: {}".format(e))
+        cache = None
+    if cache is None:
+        return voice.textToVoice(text)
+    key = cache.make_key(provider, voice_key, text)
+    path = cache.get(key)
+    if path:
+        logger.info("[TTSCache] hit, provider={}, voice file name={}".format(provider, path))
+        return Reply(ReplyType.VOICE, path)
+    reply = voice.textToVoice(text)
+    if reply and reply.type == ReplyType.VOICE and isinstance(reply.content, str) and os.path.isfile(reply.content):
+        cache.put(key, reply.content)
+    return reply
+
+
+def format_tts_stats() -> str:
+    cache = _cache
+    if cache is None:
+        return "语音合成缓存: 未启用或暂无记录"
+    s = cache.stats()
+    return "语音合成缓存: 命中 {hits}, 未命中 {misses}, 命中率 {hit_rate:.0%}, 文件 {files}, 占用 {mb:.1f}MB".format(mb=s["bytes"] / 1024 / 1024, **s)
@@ -4,9 +4,14 @@ Voice service abstract class
 
 
 class Voice(object):
+    # 语音识别需要的pcm采样率和声道数，渠道按此把语音直接解码到内存
+    asr_sample_rate = 16000
+    asr_channels = 1
+
     def voiceToText(self, voice_file):
         """
         Send voice to voice service and get text
+        :param voice_file: 解码后的AudioBuffer，或转码失败时的原始文件路径
         """
         raise NotImplementedError
 
@@ -15,3 +20,9 @@ class Voice(object):
         Send text to voice service and get voice
         """
         raise NotImplementedError
+
+    def tts_voice_key(self) -> str:
+        """
+        影响合成结果的音色参数，作为语音合成缓存key的一部分，参数变化后不会命中旧的缓存
+        """
+        return ""
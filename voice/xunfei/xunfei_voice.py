@@ -28,7 +28,7 @@ from config import conf
 from voice.voice import Voice
 from .xunfei_asr import xunfei_asr
 from .xunfei_tts import xunfei_tts
-from voice.audio_convert import any_to_mp3
+from voice.audio_convert import any_to_mp3, load_audio
 import shutil
 from pydub import AudioSegment
 
@@ -65,7 +65,9 @@ class XunfeiVoice(Voice):
             #shutil.copy2(voice_file, 'tmp/test1.wav')
             #shutil.copy2(mp3_file, 'tmp/test1.mp3')
             #print("voice and mp3 file",voice_file,mp3_file)
-            text = xunfei_asr(self.APPID,self.APISecret,self.APIKey,self.BusinessArgsASR,voice_file)
+            # 讯飞按16k单声道pcm读取wav
+            audio = load_audio(voice_file, self.asr_sample_rate)
+            text = xunfei_asr(self.APPID,self.APISecret,self.APIKey,self.BusinessArgsASR,audio.wav_file())
             logger.info("讯飞语音识别到了: {}".format(text))
             reply = Reply(ReplyType.TEXT, text)
         except Exception as e:
@@ -73,6 +75,9 @@ class XunfeiVoice(Voice):
             reply = Reply(ReplyType.ERROR, "讯飞语音识别出错了；{0}")
         return reply
 
+    def tts_voice_key(self):
+        return json.dumps(self.BusinessArgsTTS, sort_keys=True)
+
     def textToVoice(self, text):
         try:
             # Avoid the same filename under multithreading